@@ -1,4 +1,11 @@
 from .exceptions import *
 from . import utilities
-from .plpy_wrappers import PLPYWrapper, Row, ResultSet
-from .trigger import Trigger, TriggerContext, TriggerReturnValue
+from .plpy_wrappers import (
+    PLPYWrapper,
+    Row,
+    ResultSet,
+    ResultSetDiff,
+    MaterializedResult,
+    CursorResult,
+)
+from .trigger import Trigger, TriggerContext, TriggerReturnValue, AggregateTrigger
@@ -0,0 +1,190 @@
+"""chunked reading and writing of large objects and ``bytea`` columns, see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.open_lob`
+and :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.read_chunks`.
+Only one chunk is held in python at a time, so objects of any size can be processed with bounded memory.
+"""
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
+from plpy_wrapper import PLPythonWrapperException, utilities
+
+#: default number of bytes read per chunk
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+def iter_buffered(
+    read: Callable[[int, int], Union[bytes, None]], chunk_size: int, offset: int = 0
+) -> Iterator[memoryview]:
+    """reads chunks into a single reused buffer until a chunk comes back short
+
+    :param read: called with ``(offset, length)``, returns up to ``length`` bytes starting at ``offset``
+    :param chunk_size: the length of each read
+    :param offset: where to start reading
+    :return: a generator of views into the buffer, each is only valid until the next chunk is read
+    """
+    if chunk_size < 1:
+        raise PLPythonWrapperException("chunk_size must be at least 1")
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        data = read(offset, chunk_size)
+        if not data:
+            return
+        length = len(data)
+        view[:length] = data
+        # dropping the bytes plpy returned before yielding so only the buffer stays around
+        del data
+        yield view[:length]
+        if length < chunk_size:
+            return
+        offset += length
+
+
+class LargeObject:
+    """a large object, read and written chunk by chunk with ``lo_get`` and ``lo_put``"""
+
+    def __init__(self, plpy_wrapper: "plpy_wrapper.PLPYWrapper", oid: int):
+        """
+        :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+        :param oid: the ``OID`` of the large object
+        """
+        self.plpy_wrapper = plpy_wrapper
+        self.oid = oid
+
+    def __repr__(self):
+        return "LargeObject=" + str(self.oid)
+
+    def read_chunks(
+        self, chunk_size: int = DEFAULT_CHUNK_SIZE, offset: int = 0
+    ) -> Iterator[memoryview]:
+        """reads the large object from ``offset`` to its end
+
+        >>> digest = hashlib.sha256()
+        >>> for chunk in wrapper.open_lob(oid).read_chunks():
+        >>>     digest.update(chunk)
+
+        .. important::
+
+         the views point into a buffer that is reused for every chunk, copy a chunk (``bytes(chunk)``) to keep it
+
+        :param chunk_size: the number of bytes per chunk
+        :param offset: the byte to start reading at
+        :return: a generator of ``memoryview`` s, the last chunk may be shorter
+        """
+        plan = self.plpy_wrapper._prepare_cached(
+            "select lo_get($1, $2, $3) as chunk", ["oid", "int8", "int4"]
+        )
+        return iter_buffered(
+            lambda at, length: self.plpy_wrapper.plpy.execute(
+                plan, [self.oid, at, length]
+            )[0]["chunk"],
+            chunk_size,
+            offset,
+        )
+
+    def write_chunks(self, chunks: Iterable[BytesLike], offset: int = 0) -> int:
+        """writes the chunks one after the other starting at ``offset``, overwriting what's there and extending the object as needed
+
+        :param chunks: the data to write, e.g. a generator reading a file piece by piece
+        :param offset: the byte to start writing at
+        :return: the number of bytes written
+        """
+        plan = self.plpy_wrapper._prepare_cached(
+            "select lo_put($1, $2, $3)", ["oid", "int8", "bytea"]
+        )
+        written = 0
+        for chunk in chunks:
+            # plpy only knows how to pass bytes
+            chunk = chunk if isinstance(chunk, bytes) else bytes(chunk)
+            self.plpy_wrapper.plpy.execute(plan, [self.oid, offset + written, chunk])
+            written += len(chunk)
+        return written
+
+    def unlink(self) -> None:
+        """deletes the large object"""
+        self.plpy_wrapper.execute_plan(
+            self.plpy_wrapper._prepare_cached("select lo_unlink($1)", ["oid"]),
+            [self.oid],
+        )
+
+
+def _key_condition(
+    key: Dict[str, Any], column_types: Dict[str, str], first_param: int
+) -> Tuple[str, List[str]]:
+    """the where clause matching ``key`` and the types of its parameters"""
+    columns = list(key)
+    missing = [c for c in columns if c not in column_types]
+    if missing:
+        raise PLPythonWrapperException(f"Unknown key columns {missing}")
+    condition = " and ".join(
+        "{c} = ${i}".format(c=utilities.quote_identifier(c), i=first_param + i)
+        for i, c in enumerate(columns)
+    )
+    return condition, [column_types[c] for c in columns]
+
+
+def read_column_chunks(
+    plpy_wrapper: "plpy_wrapper.PLPYWrapper",
+    schema: str,
+    table_name: str,
+    column: str,
+    key: Dict[str, Any],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[memoryview]:
+    """see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.read_chunks`"""
+    condition, key_types = _key_condition(
+        key, plpy_wrapper._table_column_types(schema, table_name), 3
+    )
+    plan = plpy_wrapper._prepare_cached(
+        "select substring({c} from $1 for $2) as chunk from {t} where {w}".format(
+            c=utilities.quote_identifier(column),
+            t=utilities.make_qualified_schema_name(schema, table_name),
+            w=condition,
+        ),
+        ["int4", "int4"] + key_types,
+    )
+    key_values = list(key.values())
+
+    def read(offset: int, length: int) -> Union[bytes, None]:
+        # substring counts from 1
+        result = plpy_wrapper.plpy.execute(plan, [offset + 1, length] + key_values)
+        if not len(result):
+            raise PLPythonWrapperException(
+                f"No row of {schema}.{table_name} matches {key}"
+            )
+        return result[0]["chunk"]
+
+    return iter_buffered(read, chunk_size)
+
+
+def write_column_chunks(
+    plpy_wrapper: "plpy_wrapper.PLPYWrapper",
+    schema: str,
+    table_name: str,
+    column: str,
+    key: Dict[str, Any],
+    chunks: Iterable[BytesLike],
+) -> int:
+    """see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.write_chunks`"""
+    condition, key_types = _key_condition(
+        key, plpy_wrapper._table_column_types(schema, table_name), 2
+    )
+    plan = plpy_wrapper._prepare_cached(
+        "update {t} set {c} = lo_get($1) where {w}".format(
+            c=utilities.quote_identifier(column),
+            t=utilities.make_qualified_schema_name(schema, table_name),
+            w=condition,
+        ),
+        ["oid"] + key_types,
+    )
+    # appending to a bytea rewrites the whole value every time, so the chunks are staged in a temporary large object
+    # and the column is written once, server side
+    staging = plpy_wrapper.create_lob()
+    try:
+        written = staging.write_chunks(chunks)
+        updated = plpy_wrapper.execute_plan(plan, [staging.oid] + list(key.values()))
+    finally:
+        staging.unlink()
+    if not updated.n_rows:
+        raise PLPythonWrapperException(f"No row of {schema}.{table_name} matches {key}")
+    return written
@@ -0,0 +1,270 @@
+"""helpers for writing column arrays back to postgres with set-based statements.
+These are used by :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.insert_arrays` and
+:meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.update_arrays` (among others), you shouldn't need to call them directly.
+"""
+
+import array
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+from plpy_wrapper import PLPythonWrapperException, utilities
+
+#: default amount of memory (in bytes) the array parameters of a single statement may take up
+DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+
+# approximate width (in bytes) of a single element of each type once converted to a postgres array
+_TYPE_WIDTHS = {
+    "bool": 1,
+    "int2": 2,
+    "int4": 4,
+    "int8": 8,
+    "float4": 4,
+    "float8": 8,
+    "numeric": 16,
+    "date": 4,
+    "timestamp": 8,
+    "timestamptz": 8,
+    "uuid": 16,
+}
+
+# the names format_type returns (which is what the types read from the catalog are) and the usual aliases, by the name
+# _TYPE_WIDTHS knows them by
+_TYPE_NAMES = {
+    "boolean": "bool",
+    "smallint": "int2",
+    "integer": "int4",
+    "int": "int4",
+    "bigint": "int8",
+    "real": "float4",
+    "double precision": "float8",
+    "float": "float8",
+    "decimal": "numeric",
+    "timestamp without time zone": "timestamp",
+    "timestamp with time zone": "timestamptz",
+}
+
+# every element also costs a pointer in the python list that holds it
+_ELEMENT_OVERHEAD = 8
+
+# how many values of variable width columns are looked at when estimating the width of a column
+_WIDTH_SAMPLE_SIZE = 1000
+
+_ARRAY_TYPECODES = {
+    "f": "float8",
+    "d": "float8",
+    "b": "int8",
+    "B": "int8",
+    "h": "int8",
+    "H": "int8",
+    "i": "int8",
+    "I": "int8",
+    "l": "int8",
+    "L": "int8",
+    "q": "int8",
+    "Q": "int8",
+    "u": "text",
+}
+
+_NUMPY_KINDS = {"f": "float8", "i": "int8", "u": "int8", "b": "bool", "U": "text"}
+
+# order matters since bool is a subclass of int
+_PYTHON_TYPES = [
+    (bool, "bool"),
+    (int, "int8"),
+    (float, "float8"),
+    (Decimal, "numeric"),
+    (str, "text"),
+    (bytes, "bytea"),
+]
+
+
+def infer_array_type(column_name: str, column: Any) -> str:
+    """guesses the postgres element type of a column
+
+    :param column_name: the name of the column, only used for error messages
+    :param column: a list, ``array.array`` or NumPy array
+    :return: the postgres type name of a single element e.g. ``float8``
+    :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the type can't be inferred
+    """
+    if isinstance(column, array.array):
+        if column.typecode in _ARRAY_TYPECODES:
+            return _ARRAY_TYPECODES[column.typecode]
+    # duck typing NumPy arrays so that NumPy doesn't become a dependency
+    elif hasattr(column, "dtype") and hasattr(column, "tolist"):
+        if column.dtype.kind in _NUMPY_KINDS:
+            return _NUMPY_KINDS[column.dtype.kind]
+    else:
+        for value in column:
+            if value is None:
+                continue
+            for python_type, postgres_type in _PYTHON_TYPES:
+                if isinstance(value, python_type):
+                    return postgres_type
+            break
+    raise PLPythonWrapperException(
+        f"Could not infer the postgres type of column {column_name}. Provide it explicitly using column_types"
+    )
+
+
+def column_to_list(column: Any) -> list:
+    """converts a column to a plain list, which is what plpy knows how to pass as an array parameter"""
+    if hasattr(column, "tolist"):
+        # both array.array and NumPy arrays convert their elements to python scalars here
+        return column.tolist()
+    if isinstance(column, list):
+        return column
+    return list(column)
+
+
+def estimate_row_width(columns: Dict[str, list], column_types: Dict[str, str]) -> int:
+    """estimates how many bytes a single row of the given columns takes up when passed as array parameters"""
+    width = 0
+    for name, values in columns.items():
+        type_name = column_types[name].lower()
+        type_width = _TYPE_WIDTHS.get(_TYPE_NAMES.get(type_name, type_name))
+        if type_width is None:
+            # variable width type, sample the actual values
+            sample = [v for v in values[:_WIDTH_SAMPLE_SIZE] if v is not None]
+            type_width = (
+                sum(len(str(v)) for v in sample) // len(sample) + 4 if sample else 4
+            )
+        width += type_width + _ELEMENT_OVERHEAD
+    return width
+
+
+def rows_per_chunk(
+    columns: Dict[str, list], column_types: Dict[str, str], memory_budget: int
+) -> int:
+    """the number of rows that fit into ``memory_budget`` bytes (always at least 1)"""
+    return max(1, memory_budget // max(1, estimate_row_width(columns, column_types)))
+
+
+def iter_chunks(columns: Dict[str, list], chunk_rows: int) -> Iterator[List[list]]:
+    """yields the column values in slices of ``chunk_rows`` rows, ordered like ``columns``"""
+    n_rows = len(next(iter(columns.values())))
+    for start in range(0, n_rows, chunk_rows):
+        yield [values[start : start + chunk_rows] for values in columns.values()]
+
+
+def prepare_columns(
+    columns: Dict[str, Sequence], column_types: Dict[str, str] = None
+) -> Tuple[Dict[str, list], Dict[str, str]]:
+    """validates the columns and resolves the postgres type of each one
+
+    :return: the columns as lists and the postgres element type per column
+    :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the columns are empty or of uneven length
+    """
+    if not columns:
+        raise PLPythonWrapperException("At least one column is required")
+    column_types = dict(column_types or {})
+    lists = {}
+    for name, column in columns.items():
+        if name not in column_types:
+            column_types[name] = infer_array_type(name, column)
+        lists[name] = column_to_list(column)
+    lengths = {len(values) for values in lists.values()}
+    if len(lengths) != 1:
+        raise PLPythonWrapperException(
+            "All columns must have the same length. Got lengths: {l}".format(
+                l={name: len(values) for name, values in lists.items()}
+            )
+        )
+    return lists, column_types
+
+
+def is_array_type(type_name: str) -> bool:
+    """whether a type name, either as ``format_type`` returns it (``integer[]``) or internal (``_int4``), is an array type"""
+    return type_name.endswith("[]") or type_name.startswith("_")
+
+
+def parameter_types(column_types: Dict[str, str], column_names: List[str]) -> List[str]:
+    """the type of the array parameter each column is passed as, ``integer[]`` for an ``integer`` column
+
+    :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if a column is an array itself. ``unnest`` flattens
+     multidimensional arrays element by element, so array columns can't be written this way
+    """
+    arrays = [c for c in column_names if is_array_type(column_types[c])]
+    if arrays:
+        raise PLPythonWrapperException(
+            f"The array columns {arrays} can't be written with unnest, write them with a statement per row instead"
+        )
+    return [column_types[c] + "[]" for c in column_names]
+
+
+def build_insert_sql(qualified_table_name: str, column_names: List[str]) -> str:
+    """builds an ``INSERT ... SELECT unnest(...)`` statement taking one array parameter per column"""
+    return "INSERT INTO {t} ({cols}) SELECT * FROM unnest({params})".format(
+        t=qualified_table_name,
+        cols=", ".join(utilities.quote_identifier(c) for c in column_names),
+        params=", ".join(f"${i}" for i in range(1, len(column_names) + 1)),
+    )
+
+
+def build_update_sql(
+    qualified_table_name: str, column_names: List[str], key_columns: List[str]
+) -> str:
+    """builds an ``UPDATE ... FROM unnest(...)`` statement taking one array parameter per column.
+    Rows are matched on ``key_columns`` and every other column is set
+    """
+    set_columns = [c for c in column_names if c not in key_columns]
+    return (
+        "UPDATE {t} AS _target SET {sets} FROM unnest({params}) AS _source({cols}) "
+        "WHERE {matches}"
+    ).format(
+        t=qualified_table_name,
+        sets=", ".join(
+            "{c} = _source.{c}".format(c=utilities.quote_identifier(c))
+            for c in set_columns
+        ),
+        params=", ".join(f"${i}" for i in range(1, len(column_names) + 1)),
+        cols=", ".join(utilities.quote_identifier(c) for c in column_names),
+        matches=" AND ".join(
+            "_target.{c} = _source.{c}".format(c=utilities.quote_identifier(c))
+            for c in key_columns
+        ),
+    )
+
+
+def build_delete_sql(
+    qualified_table_name: str, column_names: List[str], condition: str = None
+) -> str:
+    """builds a ``DELETE ... USING unnest(...)`` statement taking one array parameter per column.
+    Rows matching every column of an array entry (and ``condition`` if given, which can refer to ``_target``) are deleted
+    """
+    return (
+        "DELETE FROM {t} AS _target USING unnest({params}) AS _source({cols}) "
+        "WHERE {matches}"
+    ).format(
+        t=qualified_table_name,
+        params=", ".join(f"${i}" for i in range(1, len(column_names) + 1)),
+        cols=", ".join(utilities.quote_identifier(c) for c in column_names),
+        matches=" AND ".join(
+            [
+                "_target.{c} = _source.{c}".format(c=utilities.quote_identifier(c))
+                for c in column_names
+            ]
+            + ([f"({condition})"] if condition else [])
+        ),
+    )
+
+
+def build_increment_sql(
+    qualified_table_name: str, key_columns: List[str], increment_columns: List[str]
+) -> str:
+    """builds an ``INSERT ... SELECT unnest(...) ON CONFLICT DO UPDATE`` statement taking one array parameter per column.
+    Rows that don't exist yet are inserted, otherwise ``increment_columns`` are added to the existing values.
+    ``key_columns`` must make up the primary key or a unique constraint of the table
+    """
+    column_names = list(key_columns) + list(increment_columns)
+    return (
+        "INSERT INTO {t} AS _target ({cols}) SELECT * FROM unnest({params}) "
+        "ON CONFLICT ({keys}) DO UPDATE SET {sets}"
+    ).format(
+        t=qualified_table_name,
+        cols=", ".join(utilities.quote_identifier(c) for c in column_names),
+        params=", ".join(f"${i}" for i in range(1, len(column_names) + 1)),
+        keys=", ".join(utilities.quote_identifier(c) for c in key_columns),
+        sets=", ".join(
+            "{c} = _target.{c} + excluded.{c}".format(c=utilities.quote_identifier(c))
+            for c in increment_columns
+        ),
+    )
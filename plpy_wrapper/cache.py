@@ -0,0 +1,149 @@
+"""session wide cache used by :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.execute_cached`.
+The cache itself knows nothing about plpy, it's kept in ``GD`` by the wrapper which feeds it the current table versions
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, Tuple, Union
+
+#: default upper bound on the (estimated) memory used by the cached results of a session
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+#: name of the table holding the versions that invalidate cached results, see :func:`plpy_wrapper.utilities.install_cache_invalidation`
+TABLE_VERSION_TABLE = '"public".plpy_wrapper_table_version'
+
+#: hands out the versions. A sequence isn't transactional, so a version taken by a rolled back transaction is never reused
+TABLE_VERSION_SEQUENCE = '"public".plpy_wrapper_table_version_seq'
+
+#: the number of version rows per table. A writer only updates the row of its backend's slot, so concurrent writers to a
+#: table rarely wait on each other
+TABLE_VERSION_SLOTS = 16
+
+#: a table the cached result depends on, as ``(schema, table_name)``
+TableName = Tuple[str, str]
+
+
+@dataclass
+class _CacheEntry:
+    value: Any
+    size: int
+    expires_at: Union[float, None]
+    # the version of each table the value depends on at the time it was cached
+    table_versions: Dict[TableName, str] = field(default_factory=dict)
+
+
+class QueryCache:
+    """a memory bounded LRU cache with a TTL per entry and invalidation by table versions"""
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        default_ttl: Union[float, None] = None,
+        check_interval: Union[float, None] = None,
+    ):
+        """
+        :param max_bytes: once the estimated size of all entries goes over this, the least recently used entries are evicted
+        :param default_ttl: seconds an entry stays valid when no ttl is given, ``None`` means until it's evicted or invalidated
+        :param check_interval: seconds the role, ``search_path`` and table versions read for a lookup are reused by the
+         following lookups, which then don't query anything. Changes made in that time (including the session's own) may
+         not be noticed until it's over. ``None`` reads them for every lookup
+        """
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[Hashable, _CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "QueryCache=" + str(self.stats)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """hit, miss, eviction, expiration and invalidation counts plus the current number of entries and their estimated size"""
+        return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
+    def dependencies(self, key: Hashable) -> Tuple[TableName, ...]:
+        """the tables the entry under ``key`` depends on, empty if there is no such entry"""
+        entry = self._entries.get(key)
+        return tuple(entry.table_versions) if entry else ()
+
+    def get(
+        self, key: Hashable, current_versions: Union[Dict[TableName, str], None] = None
+    ) -> Tuple[bool, Any]:
+        """looks up an entry
+
+        :param key: the cache key
+        :param current_versions: the current version of the tables the entry depends on, see :meth:`.dependencies`
+        :return: ``(True, value)`` on a hit and ``(False, None)`` on a miss
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return False, None
+        if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return False, None
+        if current_versions is not None and any(
+            current_versions.get(table) != version
+            for table, version in entry.table_versions.items()
+        ):
+            self._remove(key)
+            self._stats["invalidations"] += 1
+            self._stats["misses"] += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return True, entry.value
+
+    def put(
+        self,
+        key: Hashable,
+        value: Any,
+        size: int,
+        ttl: Union[float, None] = None,
+        table_versions: Union[Dict[TableName, str], None] = None,
+    ) -> None:
+        """adds or replaces an entry, evicting least recently used entries if the cache grows beyond ``max_bytes``.
+        Values larger than ``max_bytes`` on their own are not cached at all
+
+        :param key: the cache key
+        :param value: the value to cache
+        :param size: the estimated size of ``value`` in bytes
+        :param ttl: seconds until the entry expires, defaults to ``default_ttl``
+        :param table_versions: the current version of each table the value depends on
+        """
+        if key in self._entries:
+            self._remove(key)
+        if size <= self.max_bytes:
+            ttl = self.default_ttl if ttl is None else ttl
+            self._entries[key] = _CacheEntry(
+                value=value,
+                size=size,
+                expires_at=time.monotonic() + ttl if ttl is not None else None,
+                table_versions=dict(table_versions or {}),
+            )
+            self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def clear(self) -> None:
+        """drops every entry, stats are kept"""
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        self._bytes -= self._entries.pop(key).size
@@ -30,3 +30,33 @@ class RowException(Exception):
     """Exception for Row"""
 
     pass
+
+
+class ResultSetException(Exception):
+    """Exception for ResultSet"""
+
+    pass
+
+
+class MemoryBudgetException(Exception):
+    """Exception for results exceeding the memory budget of PLPYWrapper"""
+
+    pass
+
+
+class TimeBudgetException(Exception):
+    """Exception for queries exceeding the time budget of PLPYWrapper"""
+
+    pass
+
+
+class PlanRegressionException(Exception):
+    """Exception for query plans that differ from their baselines"""
+
+    pass
+
+
+class SharedCacheException(Exception):
+    """Exception for unsafe directories and misused locks of SharedCache"""
+
+    pass
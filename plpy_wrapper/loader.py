@@ -0,0 +1,197 @@
+"""imports python modules from a table, see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.enable_module_loader`.
+Code kept in a function body is compiled again by every backend that calls the function. Modules in the table are compiled
+once per source hash instead: the marshalled bytecode is stored next to the source, so other backends only unmarshal it.
+Unmarshalling runs whatever the bytecode says, so it's only used when its signature (see :func:`.sign`) matches, which only
+the backends of the server can produce. Someone who can write the table but can't read the key can't make a backend run
+anything but the stored source.
+"""
+
+import hashlib
+import hmac
+import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import secrets
+import sys
+from types import CodeType, ModuleType
+from typing import Any, Dict, List, Union
+from plpy_wrapper.shared_cache import SharedCache
+
+#: identifies the bytecode format of the running python, bytecode of another version is compiled again
+PYTHON_MAGIC = importlib.util.MAGIC_NUMBER.hex()
+
+#: the :class:`plpy_wrapper.shared_cache.SharedCache` key of the key that bytecode is signed with
+SIGNING_KEY_NAME = "module_signing_key"
+
+
+def source_hash(source: str) -> str:
+    """the hash that compiled bytecode is stored under"""
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def signing_key(shared_cache: SharedCache) -> bytes:
+    """the key bytecode is signed with, created by the first backend that needs it. It's kept in a shared cache, whose
+    directory only the postgres user can read
+    """
+    with shared_cache.lock(SIGNING_KEY_NAME):
+        key = shared_cache.get_buffer(SIGNING_KEY_NAME)
+        if key is None:
+            key = secrets.token_bytes(32)
+            shared_cache.set_bytes(SIGNING_KEY_NAME, key)
+        return bytes(key)
+
+
+def sign(key: bytes, digest: str, bytecode: bytes) -> str:
+    """the signature stored with bytecode compiled from the source with the hash ``digest``"""
+    return hmac.new(
+        key, f"{PYTHON_MAGIC}:{digest}:".encode() + bytecode, hashlib.sha256
+    ).hexdigest()
+
+
+def compile_module(name: str, source: str) -> CodeType:
+    """compiles the source of a module, raises ``SyntaxError`` if it's invalid"""
+    return compile(source, _file_name(name), "exec", dont_inherit=True)
+
+
+def _file_name(name: str) -> str:
+    # shown in tracebacks, whose lines are read through DatabaseFinder.get_source
+    return name.replace(".", "/") + ".py"
+
+
+class DatabaseFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """finds and loads the modules of :attr:`plpy_wrapper.plpy_wrappers.PLPYWrapper.MODULE_TABLE`.
+    It's appended to ``sys.meta_path``, so installed packages and the standard library are always found first
+    """
+
+    def __init__(self, plpy_wrapper: "plpy_wrapper.PLPYWrapper", key: bytes):
+        """
+        :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper` the table is queried with
+        :param key: the key the bytecode in the table is signed with, see :func:`.signing_key`
+        """
+        self.plpy_wrapper = plpy_wrapper
+        self._key = key
+        #: the version of every module imported through the finder
+        self.versions: Dict[str, int] = {}
+        # source hash -> code, modules are usually imported once per backend but reloads of unchanged sources are free
+        self._code: Dict[str, CodeType] = {}
+
+    def __repr__(self):
+        return "DatabaseFinder=" + str(self.versions)
+
+    def find_spec(self, fullname: str, path: Any = None, target: Any = None):
+        row = self._fetch(fullname)
+        if row is None:
+            return None
+        return importlib.machinery.ModuleSpec(
+            fullname,
+            self,
+            origin=_file_name(fullname),
+            loader_state=row,
+            is_package=row["is_package"],
+        )
+
+    def create_module(self, spec: importlib.machinery.ModuleSpec) -> None:
+        # the default module creation
+        return None
+
+    def exec_module(self, module: ModuleType) -> None:
+        row = module.__spec__.loader_state or self._fetch(module.__name__)
+        module.__file__ = module.__spec__.origin
+        exec(self._code_for(row), module.__dict__)
+        self.versions[module.__name__] = row["version"]
+
+    def get_source(self, fullname: str) -> Union[str, None]:
+        row = self._fetch(fullname)
+        return row["source"] if row is not None else None
+
+    def refresh(self) -> List[str]:
+        """reloads the imported modules whose version was bumped since they were imported.
+        Modules that imported names from them (``from module import name``) keep the old objects until they're reloaded too
+
+        :return: the names of the reloaded modules
+        """
+        if not self.versions:
+            return []
+        wrapper = self.plpy_wrapper
+        rows = wrapper.execute_plan(
+            wrapper._prepare_cached(
+                f"select name, version from {wrapper.MODULE_TABLE} where name = any($1)",
+                ["text[]"],
+            ),
+            [list(self.versions)],
+        )
+        changed = sorted(
+            row.name
+            for row in rows
+            if row.version != self.versions[row.name] and row.name in sys.modules
+        )
+        for name in changed:
+            importlib.reload(sys.modules[name])
+        return changed
+
+    def unload(self) -> None:
+        """removes the modules imported through the finder from ``sys.modules``"""
+        for name in self.versions:
+            sys.modules.pop(name, None)
+        self.versions.clear()
+
+    def _fetch(self, name: str) -> Union[Dict[str, Any], None]:
+        wrapper = self.plpy_wrapper
+        rows = wrapper.plpy.execute(
+            wrapper._prepare_cached(
+                f"""select name, source, version, is_package, source_hash, bytecode, python_magic, signature
+                from {wrapper.MODULE_TABLE} where name = $1""",
+                ["text"],
+            ),
+            [name],
+        )
+        return rows[0] if len(rows) else None
+
+    def _code_for(self, row: Dict[str, Any]) -> CodeType:
+        """the code of a module, compiled only if neither this backend nor the table has it.
+        The bytecode of the table is only used if it's signed for the hash of the source (recomputed here) and this python
+        """
+        digest = source_hash(row["source"])
+        code = self._code.get(digest)
+        if code is not None:
+            return code
+        bytecode = row["bytecode"]
+        if (
+            bytecode is not None
+            and row["python_magic"] == PYTHON_MAGIC
+            and hmac.compare_digest(
+                row["signature"] or "", sign(self._key, digest, bytecode)
+            )
+        ):
+            code = marshal.loads(bytecode)
+        else:
+            code = compile_module(row["name"], row["source"])
+            self._store(row, digest, marshal.dumps(code))
+        self._code[digest] = code
+        return code
+
+    def _store(self, row: Dict[str, Any], digest: str, bytecode: bytes) -> None:
+        """stores freshly compiled bytecode and its signature in the table"""
+        wrapper = self.plpy_wrapper
+        try:
+            with wrapper.subtransaction():
+                wrapper.plpy.execute(
+                    wrapper._prepare_cached(
+                        f"""update {wrapper.MODULE_TABLE} set bytecode = $1, python_magic = $2, source_hash = $3,
+                        signature = $4 where name = $5 and source = $6""",
+                        ["bytea", "text", "text", "text", "text", "text"],
+                    ),
+                    [
+                        bytecode,
+                        PYTHON_MAGIC,
+                        digest,
+                        sign(self._key, digest, bytecode),
+                        row["name"],
+                        row["source"],
+                    ],
+                )
+        except wrapper.plpy.SPIError:
+            # e.g. a read only transaction, the next backend compiles it again
+            pass
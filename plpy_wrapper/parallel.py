@@ -0,0 +1,271 @@
+"""a pool of forked worker processes for CPU bound python, see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.parallel_map`.
+A backend runs python on a single core, the workers take chunks of rows off it and send back the results.
+
+The workers are forks of the backend, so they are detached from it before doing anything else: the signal handlers of
+postgres are reset, database modules are no longer imported from the table (see :mod:`plpy_wrapper.loader`) and on
+Linux they are killed as soon as the backend exits (``PR_SET_PDEATHSIG``). They never call ``plpy``, and they exit with
+``os._exit`` so that no exit handler of the backend runs in them. The pool uses no threads, which a backend doesn't
+expect either.
+"""
+
+import ctypes
+import os
+import pickle
+import signal
+import sys
+import traceback
+from multiprocessing.connection import Connection, Pipe, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+from plpy_wrapper import PLPythonWrapperException
+
+#: default number of rows sent to a worker at a time
+DEFAULT_CHUNK_SIZE = 1000
+
+#: default number of worker processes, kept small since every backend of the server may fork its own pool
+DEFAULT_WORKERS = 2
+
+# a chunk of rows: the column names and one list of values per column
+Chunk = Tuple[List[str], List[list]]
+
+_PR_SET_PDEATHSIG = 1
+
+# marks the end of the items of ProcessPool.imap
+_DONE = object()
+
+# signals postgres handles itself, the handlers would act on the backend's shared state
+_BACKEND_SIGNALS = [
+    signal.SIGTERM,
+    signal.SIGQUIT,
+    signal.SIGHUP,
+    signal.SIGUSR1,
+    signal.SIGUSR2,
+    signal.SIGALRM,
+    signal.SIGPIPE,
+    signal.SIGCHLD,
+]
+
+
+def columnar_chunks(
+    rows: Iterable[dict], colnames: List[str], chunk_size: int
+) -> Iterator[Chunk]:
+    """groups rows into chunks of columns, which pickle smaller and faster than the rows as dicts
+
+    :param rows: the rows as dicts, e.g. a ``PLyResult``
+    :param colnames: the columns to send
+    :param chunk_size: the number of rows per chunk
+    """
+    if chunk_size < 1:
+        raise PLPythonWrapperException("chunk_size must be at least 1")
+    columns = [[] for _ in colnames]
+    for row in rows:
+        for column, name in zip(columns, colnames):
+            column.append(row[name])
+        if len(columns[0]) == chunk_size:
+            yield colnames, columns
+            columns = [[] for _ in colnames]
+    if colnames and columns[0]:
+        yield colnames, columns
+
+
+def dump_task(task: Callable[[Any], Any]) -> bytes:
+    """pickles a task for :meth:`.ProcessPool.imap`, before forking a pool it would be sent to
+
+    :param task: a function defined at the top level of an importable module, or a ``functools.partial`` of one
+    :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if it can't be pickled
+    """
+    try:
+        return pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise PLPythonWrapperException(
+            f"The function can't be sent to the workers, it must be defined at the top level of an importable module: {e}"
+        ) from e
+
+
+def map_rows(
+    fn: Callable[[Any], Any], row_factory: Callable[[dict], Any], chunk: Chunk
+) -> list:
+    """runs in a worker, applies ``fn`` to every row of a chunk"""
+    colnames, columns = chunk
+    return [fn(row_factory(dict(zip(colnames, values)))) for values in zip(*columns)]
+
+
+class _Worker:
+    def __init__(self, pid: int, connection: Connection):
+        self.pid = pid
+        self.connection = connection
+
+
+class ProcessPool:
+    """worker processes forked from the backend for a call of ``parallel_map``, or kept in ``GD`` for the next calls"""
+
+    def __init__(self, workers: int):
+        """
+        :param workers: the number of processes to fork
+        """
+        if workers < 1:
+            raise PLPythonWrapperException("workers must be at least 1")
+        self._workers: List[_Worker] = []
+        for _ in range(workers):
+            self._workers.append(self._fork())
+
+    def __repr__(self):
+        return "ProcessPool=" + str([worker.pid for worker in self._workers])
+
+    @property
+    def workers(self) -> int:
+        return len(self._workers)
+
+    @property
+    def pids(self) -> List[int]:
+        return [worker.pid for worker in self._workers]
+
+    def _fork(self) -> _Worker:
+        parent_connection, child_connection = Pipe()
+        parent_pid = os.getpid()
+        # what's buffered would otherwise be written by the backend and the worker
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                parent_connection.close()
+                # the pipes of the other workers, the workers have to see EOF when the pool closes them
+                for worker in self._workers:
+                    worker.connection.close()
+                _detach_from_backend(parent_pid)
+                _serve(child_connection)
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+        child_connection.close()
+        return _Worker(pid, parent_connection)
+
+    def imap(self, task: bytes, items: Iterable[Any]) -> Iterator[Any]:
+        """runs ``task`` on every item in the workers
+
+        :param task: called with one item at a time, pickled with :func:`.dump_task`. The items must be picklable too
+        :param items: the arguments, consumed only as fast as the workers get through them
+        :return: a generator of the results, in the order of ``items``
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the task fails or a worker dies
+        """
+        items = iter(items)
+        idle = list(self._workers)
+        # connection -> (index of the item, worker)
+        pending: Dict[Connection, Tuple[int, _Worker]] = {}
+        results = {}
+        sent = returned = 0
+        error = None
+        try:
+            while True:
+                while idle and error is None:
+                    item = next(items, _DONE)
+                    if item is _DONE:
+                        break
+                    worker = idle.pop()
+                    self._send(
+                        worker, pickle.dumps((task, item), pickle.HIGHEST_PROTOCOL)
+                    )
+                    pending[worker.connection] = (sent, worker)
+                    sent += 1
+                if not pending:
+                    break
+                for connection in wait(list(pending)):
+                    index, worker = pending.pop(connection)
+                    ok, value = self._receive(worker)
+                    idle.append(worker)
+                    if not ok:
+                        # the other pending results are still collected, so the pipes stay in sync
+                        error = error or value
+                    results[index] = value
+                while error is None and returned in results:
+                    yield results.pop(returned)
+                    returned += 1
+        finally:
+            # also when the caller stopped early. A worker that died closed the pool and its pipes, so there is nothing
+            # left to collect and the error about the dead worker is the one raised
+            for connection, (_, worker) in pending.items():
+                try:
+                    self._receive(worker)
+                except PLPythonWrapperException:
+                    break
+        if error is not None:
+            raise PLPythonWrapperException("A worker failed:\n" + error)
+
+    def _send(self, worker: _Worker, message: bytes) -> None:
+        try:
+            worker.connection.send_bytes(message)
+        except OSError:
+            self._died(worker)
+
+    def _receive(self, worker: _Worker) -> Tuple[bool, Any]:
+        try:
+            return pickle.loads(worker.connection.recv_bytes())
+        except (EOFError, OSError):
+            self._died(worker)
+
+    def _died(self, worker: _Worker) -> None:
+        self.close()
+        raise PLPythonWrapperException(f"Worker {worker.pid} died, the pool was closed")
+
+    def close(self) -> None:
+        """stops the workers, closing their pipes makes them exit"""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.connection.close()
+        for worker in workers:
+            try:
+                os.waitpid(worker.pid, 0)
+            except ChildProcessError:
+                pass
+
+    @property
+    def alive(self) -> bool:
+        """whether every worker is still running"""
+        for worker in self._workers:
+            try:
+                if os.waitpid(worker.pid, os.WNOHANG) != (0, 0):
+                    return False
+            except ChildProcessError:
+                return False
+        return bool(self._workers)
+
+
+def _detach_from_backend(parent_pid: int) -> None:
+    """runs first thing in a worker"""
+    for signal_number in _BACKEND_SIGNALS:
+        signal.signal(signal_number, signal.SIG_DFL)
+    # queries are canceled in the backend, which then stops waiting for the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_SETMASK, [])
+    if sys.platform.startswith("linux"):
+        ctypes.CDLL(None, use_errno=True).prctl(_PR_SET_PDEATHSIG, signal.SIGKILL)
+        if os.getppid() != parent_pid:
+            # the backend exited before the death signal was set up
+            os._exit(1)
+    from plpy_wrapper.loader import DatabaseFinder
+
+    sys.meta_path[:] = [f for f in sys.meta_path if not isinstance(f, DatabaseFinder)]
+
+
+def _serve(connection: Connection) -> None:
+    """the loop of a worker, returns when the pool closes the pipe"""
+    tasks = {}
+    while True:
+        try:
+            message = connection.recv_bytes()
+        except EOFError:
+            return
+        try:
+            task, item = pickle.loads(message)
+            if task not in tasks:
+                # the same task is usually sent with every item
+                tasks.clear()
+                tasks[task] = pickle.loads(task)
+            result = (True, tasks[task](item))
+        except BaseException:
+            result = (False, traceback.format_exc())
+        try:
+            connection.send_bytes(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            connection.send_bytes(pickle.dumps((False, traceback.format_exc())))
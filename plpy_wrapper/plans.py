@@ -0,0 +1,289 @@
+"""detects query plan regressions, see :class:`.PlanRegressionHarness`.
+A plan is reduced to its shape (node types, join types and strategies, relations and indexes in the order they're
+joined) plus its estimated total cost, so a baseline stays comparable while the data it was recorded on changes
+within reason. A different shape or a cost outside the threshold means the planner changed its mind, e.g. after the data
+grew or after a postgres upgrade.
+"""
+
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Union
+from plpy_wrapper import PLPythonWrapperException, PlanRegressionException
+
+# the keys of an EXPLAIN node that make up its shape, costs, row counts and timings are left out
+_SHAPE_KEYS = [
+    "Node Type",
+    "Parent Relationship",
+    "Join Type",
+    "Strategy",
+    "Scan Direction",
+    "Relation Name",
+    "Alias",
+    "Index Name",
+    "CTE Name",
+    "Function Name",
+]
+
+
+def normalize_plan(node: Dict[str, Any]) -> Dict[str, Any]:
+    """the shape of a node of ``EXPLAIN (FORMAT JSON)`` output and of its children
+
+    :param node: a plan node, e.g. the ``Plan`` of the explain output
+    :return: the node without its costs, row estimates and timings
+    """
+    shape = {key: node[key] for key in _SHAPE_KEYS if key in node}
+    if node.get("Plans"):
+        shape["Plans"] = [normalize_plan(child) for child in node["Plans"]]
+    return shape
+
+
+def _describe(node: Dict[str, Any]) -> str:
+    if "Relation Name" in node:
+        return "{n} on {r}".format(n=node["Node Type"], r=node["Relation Name"])
+    return node["Node Type"]
+
+
+def compare_shapes(
+    baseline: Dict[str, Any], current: Dict[str, Any], path: str = ""
+) -> List[str]:
+    """describes how two plan shapes differ. The children of nodes whose type or number of children differ aren't compared
+
+    :param baseline: a shape returned by :func:`.normalize_plan`
+    :param current: the shape to compare it with
+    :param path: where in the plan the nodes are, used in the descriptions
+    :return: a description per difference, empty if the shapes are the same
+    """
+    path = (path + " > " if path else "") + _describe(baseline)
+    if baseline["Node Type"] != current["Node Type"]:
+        # everything below a replaced node differs as well
+        return [f"{path}: changed to {_describe(current)}"]
+    differences = [
+        f"{path}: {key} changed from {baseline.get(key)!r} to {current.get(key)!r}"
+        for key in _SHAPE_KEYS
+        if baseline.get(key) != current.get(key)
+    ]
+    baseline_children = baseline.get("Plans", [])
+    current_children = current.get("Plans", [])
+    if len(baseline_children) != len(current_children):
+        differences.append(
+            f"{path}: {len(baseline_children)} child nodes changed to {len(current_children)}"
+        )
+        return differences
+    for baseline_child, current_child in zip(baseline_children, current_children):
+        differences.extend(compare_shapes(baseline_child, current_child, path))
+    return differences
+
+
+@dataclass
+class PlanCapture:
+    """the plan of a registered query"""
+
+    #: see :func:`.normalize_plan`
+    shape: Dict[str, Any]
+    #: the planner's estimated total cost
+    total_cost: float
+    #: the execution time in milliseconds, only known if the harness runs ``EXPLAIN ANALYZE``
+    execution_time: Union[float, None] = None
+
+
+@dataclass
+class PlanRegression:
+    """a query whose plan differs from its baseline"""
+
+    name: str
+    #: what changed, see :func:`.compare_shapes`
+    differences: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        return self.name + ":\n  " + "\n  ".join(self.differences)
+
+
+class _Rollback(Exception):
+    """rolls back the subtransaction an analyzed query ran in"""
+
+    pass
+
+
+class PlanRegressionHarness:
+    """runs a registered set of queries through ``EXPLAIN (FORMAT JSON)`` and compares their plans to the baselines kept
+    in :attr:`plpy_wrapper.plpy_wrappers.PLPYWrapper.PLAN_BASELINE_TABLE` (see :func:`plpy_wrapper.utilities.install_plan_baseline_table`)
+
+    >>> from plpy_wrapper import PLPYWrapper
+    >>> from plpy_wrapper.plans import PlanRegressionHarness
+    >>> wrapper = PLPYWrapper(globals())
+    >>> harness = PlanRegressionHarness(wrapper, cost_threshold=0.5)
+    >>> harness.register('contacts_of_company', 'select * from customer.contact where company_id = $1', [1], ['int'])
+    >>> harness.record_baselines()
+    >>> # after the data grew or postgres was upgraded
+    >>> harness.assert_no_regressions()
+    """
+
+    def __init__(
+        self,
+        plpy_wrapper: "plpy_wrapper.PLPYWrapper",
+        cost_threshold: float = 0.5,
+        analyze: bool = False,
+        min_cost_change: float = 1.0,
+    ):
+        """
+        :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+        :param cost_threshold: how much the estimated total cost may change relative to the baseline, 0.5 is +/-50%
+        :param analyze: run ``EXPLAIN ANALYZE`` to capture execution times as well. The queries are run in a subtransaction
+         that is rolled back, so data modifying queries can be registered too
+        :param min_cost_change: cost changes up to this many cost units are never reported, so cheap plans whose baseline
+         cost is (close to) 0 aren't flagged for every change
+        """
+        self.plpy_wrapper = plpy_wrapper
+        self.cost_threshold = cost_threshold
+        self.analyze = analyze
+        self.min_cost_change = min_cost_change
+        # name -> (query, args, argtypes)
+        self._queries: Dict[str, tuple] = {}
+
+    def __repr__(self):
+        return "PlanRegressionHarness=" + str(list(self._queries))
+
+    def register(
+        self,
+        name: str,
+        query: str,
+        args: Union[List[Any], None] = None,
+        argtypes: Union[List[str], None] = None,
+    ) -> None:
+        """adds a query to the set that is checked
+
+        :param name: identifies the query and its baseline
+        :param query: the SQL, with ``$n`` parameters if ``args`` are given
+        :param args: the parameter values the plan is captured with
+        :param argtypes: the parameter types
+        """
+        self._queries[name] = (query, args or [], argtypes or [])
+
+    def capture(self, name: str) -> PlanCapture:
+        """explains a registered query
+
+        :param name: the name it was registered with
+        :return: its current plan
+        """
+        if name not in self._queries:
+            raise PLPythonWrapperException(f"No query is registered as {name}")
+        query, args, argtypes = self._queries[name]
+        options = "format json, analyze true" if self.analyze else "format json"
+        plan = self.plpy_wrapper.prepare(f"explain ({options}) {query}", argtypes)
+        if self.analyze:
+            try:
+                with self.plpy_wrapper.subtransaction():
+                    result = self.plpy_wrapper.execute_plan(plan, args)
+                    raise _Rollback
+            except _Rollback:
+                pass
+        else:
+            result = self.plpy_wrapper.execute_plan(plan, args)
+        explained = result[0].row_dict["QUERY PLAN"]
+        # json (as opposed to jsonb) comes back as text
+        if isinstance(explained, str):
+            explained = json.loads(explained)
+        root = explained[0]
+        return PlanCapture(
+            normalize_plan(root["Plan"]),
+            root["Plan"]["Total Cost"],
+            root.get("Execution Time"),
+        )
+
+    def record_baselines(self, names: Union[List[str], None] = None) -> int:
+        """stores the current plans as the baselines, replacing the previous ones
+
+        :param names: the queries to record, all registered queries if not given
+        :return: the number of baselines recorded
+        """
+        names = names if names is not None else list(self._queries)
+        captures = [self.capture(name) for name in names]
+        self.import_baselines(
+            {
+                name: {
+                    "query": self._queries[name][0],
+                    "shape": capture.shape,
+                    "total_cost": capture.total_cost,
+                }
+                for name, capture in zip(names, captures)
+            }
+        )
+        return len(names)
+
+    def baselines(self) -> Dict[str, Dict[str, Any]]:
+        """the stored baselines by name, each with its ``query``, ``shape``, ``total_cost`` and the ``server_version`` it was recorded on"""
+        rows = self.plpy_wrapper.execute(
+            f"select name, query, shape::text, total_cost, server_version from {self.plpy_wrapper.PLAN_BASELINE_TABLE}"
+        )
+        return {
+            row.name: {
+                "query": row.query,
+                "shape": json.loads(row.shape),
+                "total_cost": row.total_cost,
+                "server_version": row.server_version,
+            }
+            for row in rows
+        }
+
+    def import_baselines(self, baselines: Dict[str, Dict[str, Any]]) -> None:
+        """stores baselines, e.g. ones exported with :meth:`.baselines` and kept in version control
+
+        :param baselines: name to a dict with the ``query``, ``shape`` and ``total_cost`` of the baseline
+        """
+        plan = self.plpy_wrapper._prepare_cached(
+            f"""insert into {self.plpy_wrapper.PLAN_BASELINE_TABLE} (name, query, shape, total_cost)
+            select name, query, shape::jsonb, total_cost from unnest($1, $2, $3, $4) as _b (name, query, shape, total_cost)
+            on conflict (name) do update set query = excluded.query, shape = excluded.shape, total_cost = excluded.total_cost,
+            server_version = excluded.server_version, recorded_at = excluded.recorded_at""",
+            ["text[]", "text[]", "text[]", "float8[]"],
+        )
+        names = list(baselines)
+        self.plpy_wrapper.execute_plan(
+            plan,
+            [
+                names,
+                [baselines[name]["query"] for name in names],
+                [json.dumps(baselines[name]["shape"]) for name in names],
+                [baselines[name]["total_cost"] for name in names],
+            ],
+        )
+
+    def check(self, names: Union[List[str], None] = None) -> List[PlanRegression]:
+        """compares the current plans to the baselines
+
+        :param names: the queries to check, all registered queries if not given
+        :return: the queries whose shape changed or whose estimated cost changed beyond the threshold (or beyond
+         ``min_cost_change`` for cheap baselines), including queries
+         without a baseline
+        """
+        names = names if names is not None else list(self._queries)
+        baselines = self.baselines()
+        regressions = []
+        for name in names:
+            baseline = baselines.get(name)
+            if baseline is None:
+                regressions.append(PlanRegression(name, ["there is no baseline"]))
+                continue
+            capture = self.capture(name)
+            differences = compare_shapes(baseline["shape"], capture.shape)
+            cost, baseline_cost = capture.total_cost, baseline["total_cost"]
+            allowed = max(self.cost_threshold * baseline_cost, self.min_cost_change)
+            if abs(cost - baseline_cost) > allowed:
+                differences.append(
+                    f"the estimated cost changed from {baseline_cost} to {cost}"
+                )
+            if differences:
+                regressions.append(PlanRegression(name, differences))
+        return regressions
+
+    def assert_no_regressions(self, names: Union[List[str], None] = None) -> None:
+        """same as :meth:`.check`
+
+        :raises: :class:`plpy_wrapper.exceptions.PlanRegressionException` describing every regression
+        """
+        regressions = self.check(names)
+        if regressions:
+            raise PlanRegressionException(
+                f"{len(regressions)} plan regressions:\n"
+                + "\n".join(str(regression) for regression in regressions)
+            )
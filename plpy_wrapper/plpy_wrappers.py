@@ -1,14 +1,77 @@
-from contextlib import contextmanager
+import functools
+import json
+import marshal
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from enum import Enum
-from dataclasses import dataclass
-from plpy_wrapper import PLPythonWrapperException, RowException
-from typing import Union, Any, List, TypeVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from plpy_wrapper import (
+    PLPythonWrapperException,
+    RowException,
+    ResultSetException,
+    MemoryBudgetException,
+    TimeBudgetException,
+    utilities,
+)
+from plpy_wrapper import (
+    blob,
+    bulk,
+    cache,
+    loader,
+    parallel,
+    profiling,
+    serialization,
+)
+from plpy_wrapper.shared_cache import SharedCache, DEFAULT_DIRECTORY_NAME
+from plpy_wrapper.stats import STATS_COLUMNS, MetricKey, StatsRegistry, to_rows
+from typing import (
+    Union,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+# lock_not_available, raised when lock_timeout expires
+_LOCK_NOT_AVAILABLE = "55P03"
+
+# query_canceled (statement_timeout) and lock_not_available (lock_timeout)
+_TIMEOUT_SQLSTATES = {"57014", _LOCK_NOT_AVAILABLE}
+
+# invalid_cursor_definition, raised when a cursor is opened for a statement that doesn't return rows
+_INVALID_CURSOR_DEFINITION = "42P11"
 
 #: internal types of the plpy library that lives in the postgres runtime
 PLyResult = TypeVar("PLyResult")
 PLyPlan = TypeVar("PLyPlan")
 
 
+def _hashable(value: Any) -> Any:
+    """turns values that plpy returns as lists (postgres arrays) into tuples so they can be used as dictionary keys"""
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _lock_order(key: tuple) -> tuple:
+    """sort key for the keys of rows written by deferred updates and increments. Sessions that write their rows in the
+    same order lock them in the same order, so concurrent statements wait for each other instead of deadlocking
+    """
+    return tuple((v is None, v) for v in key)
+
+
 class Row:
     """wrapper around an individual result from the result set or ``TD['new']`` / ``TD['old']``
     :class:`.ResultSet` contains :class:`.Row` objects are returned
@@ -60,13 +123,195 @@ class Row:
     def __repr__(self):
         return self._row_dict.__repr__()
 
+    def to_json(self) -> str:
+        """the row as a JSON object. Unlike ``json.dumps`` this handles ``Decimal`` s, dates and bytes"""
+        return serialization.encode_value(self._row_dict)
+
     def __eq__(self, other: "Row"):
-        if type(other) is not Row:
-            raise NotImplementedError
-        elif other.row_dict == self.row_dict:
-            return True
+        if not isinstance(other, Row):
+            return NotImplemented
+        # comparing the underlying dicts directly, row_dict would copy both of them
+        return self._row_dict == other._row_dict
+
+
+class MaterializedResult:
+    """a compact stand in for ``PLyResult`` for rows that outlive the query that produced them (e.g. cached results).
+    Column names are stored once and every row is a tuple, dicts are only built when a row is accessed.
+    Wrap it in a :class:`.ResultSet` to use it like any other query result
+    """
+
+    def __init__(
+        self,
+        colnames: List[str],
+        rows: List[tuple],
+        coltypes: Union[List[int], None] = None,
+        coltypmods: Union[List[int], None] = None,
+        status: Union[int, None] = None,
+        nrows: Union[int, None] = None,
+    ):
+        """
+        :param colnames: the column names
+        :param rows: one tuple of values per row, ordered like ``colnames``
+        :param coltypes: the column type ``OID`` s if known
+        :param coltypmods: the column type modifiers if known
+        :param status: the ``SPI_execute()`` return value of the original query if known
+        :param nrows: the number of rows processed by the original query, defaults to the number of rows
+        """
+        self._colnames = list(colnames)
+        self._rows = rows
+        self._coltypes = coltypes
+        self._coltypmods = coltypmods
+        self._status = status
+        self._nrows = len(rows) if nrows is None else nrows
+
+    @classmethod
+    def from_plpy_result(cls, result: PLyResult) -> "MaterializedResult":
+        """copies the rows and metadata of a ``PLyResult`` (or another :class:`.MaterializedResult`)"""
+        colnames = result.colnames()
+        return cls(
+            colnames,
+            [tuple(row[c] for c in colnames) for row in result],
+            result.coltypes(),
+            result.coltypmods(),
+            result.status(),
+            result.nrows(),
+        )
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index: int) -> dict:
+        return dict(zip(self._colnames, self._rows[index]))
+
+    def __iter__(self):
+        colnames = self._colnames
+        return (dict(zip(colnames, row)) for row in self._rows)
+
+    def __str__(self):
+        return "<MaterializedResult status={s} nrows={n} rows={r}>".format(
+            s=self._status, n=self._nrows, r=list(self)
+        )
+
+    def estimated_size(self) -> int:
+        """a rough estimate of the memory taken up by the rows, in bytes"""
+        size = sys.getsizeof(self._rows)
+        for row in self._rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+        return size
+
+    def nrows(self) -> int:
+        return self._nrows
+
+    def status(self) -> Union[int, None]:
+        return self._status
+
+    def colnames(self) -> List[str]:
+        return list(self._colnames)
+
+    def coltypes(self) -> Union[List[int], None]:
+        return self._coltypes
+
+    def coltypmods(self) -> Union[List[int], None]:
+        return self._coltypmods
+
+
+class CursorResult:
+    """a ``PLyResult`` stand in that pulls rows from a cursor batch by batch while it's iterated instead of holding all of them.
+    :meth:`.PLPYWrapper.execute` returns it (wrapped in a :class:`.ResultSet`) for queries over the memory budget when
+    :attr:`.PLPYWrapper.MemoryBudget.stream` is set. It can only be iterated once and can't be indexed, and its length
+    is only known once it was iterated (see :meth:`.nrows`)
+    """
+
+    def __init__(
+        self,
+        cursor: Any,
+        batch_size: int = 1000,
+        fetched: Union[List[PLyResult], None] = None,
+    ):
+        """
+        :param cursor: the result of ``plpy.cursor``
+        :param batch_size: how many rows are fetched at a time
+        :param fetched: batches that were already fetched from the cursor, their rows come first
+        """
+        self._cursor = cursor
+        self._batch_size = batch_size
+        if fetched:
+            self._fetched = fetched
+            # the batches may have been fetched with other sizes, only an empty one tells that the cursor is done
+            self._more = len(fetched[-1]) > 0
         else:
-            return False
+            # fetching the first batch right away since that's what tells the columns of the result
+            self._fetched = [cursor.fetch(batch_size)]
+            self._more = len(self._fetched[0]) == batch_size
+        self._colnames = self._fetched[0].colnames()
+        self._coltypes = self._fetched[0].coltypes()
+        self._coltypmods = self._fetched[0].coltypmods()
+        self._nrows = 0
+        self._iterated = False
+
+    def __iter__(self):
+        if self._iterated:
+            raise ResultSetException("A streamed result can only be iterated once")
+        self._iterated = True
+        return self._iter_rows()
+
+    def _iter_rows(self) -> Iterator[dict]:
+        fetched, self._fetched = self._fetched, None
+        try:
+            for batch in fetched:
+                self._nrows += len(batch)
+                yield from batch
+            while self._more:
+                batch = self._cursor.fetch(self._batch_size)
+                self._nrows += len(batch)
+                yield from batch
+                self._more = len(batch) == self._batch_size
+        finally:
+            self._cursor.close()
+
+    def __len__(self):
+        raise ResultSetException(
+            "The length of a streamed result isn't known before iterating over it"
+        )
+
+    def __getitem__(self, index: int) -> dict:
+        raise ResultSetException(
+            "A streamed result can't be indexed, iterate over it instead"
+        )
+
+    def __str__(self):
+        return "<CursorResult colnames={c}>".format(c=self._colnames)
+
+    def nrows(self) -> int:
+        """the number of rows fetched so far"""
+        return self._nrows
+
+    def status(self) -> Union[int, None]:
+        return None
+
+    def colnames(self) -> List[str]:
+        return list(self._colnames)
+
+    def coltypes(self) -> List[int]:
+        return self._coltypes
+
+    def coltypmods(self) -> List[int]:
+        return self._coltypmods
+
+
+@dataclass
+class ResultSetDiff:
+    """the difference between two result sets as returned by :meth:`.ResultSet.diff`"""
+
+    #: rows that are only in the source result set
+    inserted: List[Row]
+    #: rows that are only in the target result set
+    deleted: List[Row]
+    #: ``(source_row, target_row)`` pairs that share a key but differ in at least one compared column
+    changed: List[Tuple[Row, Row]]
+
+    def __bool__(self):
+        return bool(self.inserted or self.deleted or self.changed)
 
 
 class ResultSet:
@@ -78,9 +323,10 @@ class ResultSet:
         """
         self.result_set = result_set
         # nrows is the number of rows processes, not number of rows returned by query. Therefore we can't use that variable to iterate. Instead we
-        # iterate thru PLyResult object to get all rows and store that in the object
-        self._result_set_rows = [row for row in self.result_set]
-        self._iterindex = 0
+        # iterate thru the PLyResult object itself, without copying its rows
+        self._iterator = None
+        # indexes built by index_by/group_by, keyed by their columns and uniqueness
+        self._indexes = {}
 
     def __len__(self):
         return len(self.result_set)
@@ -96,17 +342,167 @@ class ResultSet:
 
     def __next__(self) -> Row:
         """this method is here for iteration support"""
-        if self._iterindex < len(self._result_set_rows):
-            return_val = Row(self._result_set_rows[self._iterindex])
-            self._iterindex += 1
-            return return_val
-        # restart index so we can iterate again next time
-        self._iterindex = 0
-        raise StopIteration()
+        if self._iterator is None:
+            self._iterator = iter(self.result_set)
+        try:
+            return Row(next(self._iterator))
+        except StopIteration:
+            # restart so we can iterate again next time
+            self._iterator = None
+            raise
 
     def __repr__(self):
         return "ResultSet=" + str([row for row in self])
 
+    def index_by(
+        self, *columns: str, unique: bool = True
+    ) -> Dict[Any, Union[Row, List[Row]]]:
+        """builds a hash index of the rows in a single pass so that rows can be looked up by key instead of scanning the result set.
+        The index is cached on the result set, so calling this again with the same arguments is free.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> companies = wrapper.execute('select id,name from customer.company').index_by('id')
+        >>> for contact in wrapper.execute('select first_name,company_id from customer.contact'):
+        >>>     company = companies.get(contact.company_id)
+
+        :param columns: the columns that make up the key. With a single column the key is the value itself, otherwise it's a tuple of the values
+        :param unique: if ``True`` each key maps to a single :class:`.Row`, otherwise each key maps to a list of :class:`.Row` objects
+        :return: a dictionary from key to row(s). Array values in the key are turned into tuples
+        :raises: :class:`plpy_wrapper.exceptions.ResultSetException` if a column doesn't exist or ``unique`` is ``True`` and a key is repeated
+        """
+        cache_key = (columns, unique)
+        if cache_key not in self._indexes:
+            self._indexes[cache_key] = self._build_index(columns, unique)
+        return self._indexes[cache_key]
+
+    def group_by(self, *columns: str) -> Dict[Any, List[Row]]:
+        """groups the rows by the given columns, see :meth:`.index_by`
+
+        :param columns: the columns to group by
+        :return: a dictionary from key to the list of :class:`.Row` objects with that key
+        """
+        return self.index_by(*columns, unique=False)
+
+    def _build_index(
+        self, columns: tuple, unique: bool
+    ) -> Dict[Any, Union[Row, List[Row]]]:
+        """does the actual work for :meth:`.index_by`"""
+        if not columns:
+            raise ResultSetException(
+                "At least one column is required to build an index"
+            )
+        index = {}
+        single_column = columns[0] if len(columns) == 1 else None
+        for row_dict in self.result_set:
+            try:
+                if single_column is not None:
+                    key = _hashable(row_dict[single_column])
+                else:
+                    key = tuple(_hashable(row_dict[c]) for c in columns)
+            except KeyError as e:
+                raise ResultSetException(
+                    f"Cannot index by {e} since it is not a column in this ResultSet. Columns: {list(row_dict.keys())}"
+                )
+            if unique:
+                if key in index:
+                    raise ResultSetException(
+                        f"Key {key} appears more than once. Use unique=False or group_by to index non unique columns"
+                    )
+                index[key] = Row(row_dict)
+            else:
+                index.setdefault(key, []).append(Row(row_dict))
+        return index
+
+    def diff(
+        self,
+        other: "ResultSet",
+        key: Sequence[str],
+        columns: Union[Sequence[str], None] = None,
+    ) -> ResultSetDiff:
+        """compares this (source) result set against ``other`` (target) by key in linear time.
+        Each row is reduced to a tuple of its compared columns so that unchanged rows are skipped without building
+        :class:`.Row` objects for them.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> source = wrapper.execute('select id,name from staging.company')
+        >>> target = wrapper.execute('select id,name from customer.company')
+        >>> wrapper.apply_diff('customer','company',source.diff(target,key=['id']),key_columns=['id'])
+
+        :param other: the target result set
+        :param key: the columns that identify a row, they must be unique in both result sets
+        :param columns: the columns to compare, defaults to all non-key columns of this result set
+        :return: the rows that would have to be inserted into, deleted from and changed in ``other`` to make it match this result set
+        :raises: :class:`plpy_wrapper.exceptions.ResultSetException` if a key is repeated or a column is missing
+        """
+        key = tuple(key)
+        if not key:
+            raise ResultSetException("At least one key column is required to diff")
+        if columns is None:
+            columns = [c for c in self.colnames if c not in key]
+        source = ResultSet._compared_values(self, key, tuple(columns))
+        target = ResultSet._compared_values(other, key, tuple(columns))
+
+        inserted = []
+        changed = []
+        for row_key, (values, row_dict) in source.items():
+            target_entry = target.get(row_key)
+            if target_entry is None:
+                inserted.append(Row(row_dict))
+            elif target_entry[0] != values:
+                changed.append((Row(row_dict), Row(target_entry[1])))
+        deleted = [
+            Row(row_dict)
+            for row_key, (_, row_dict) in target.items()
+            if row_key not in source
+        ]
+        return ResultSetDiff(inserted=inserted, deleted=deleted, changed=changed)
+
+    @staticmethod
+    def _compared_values(result_set: "ResultSet", key: tuple, columns: tuple) -> dict:
+        """maps each row's key to ``(compared values, row dict)``"""
+        compared = {}
+        for row_dict in result_set.result_set:
+            try:
+                row_key = tuple(_hashable(row_dict[c]) for c in key)
+                values = tuple(_hashable(row_dict[c]) for c in columns)
+            except KeyError as e:
+                raise ResultSetException(
+                    f"Cannot diff by {e} since it is not a column in both ResultSets. Columns: {list(row_dict.keys())}"
+                )
+            if row_key in compared:
+                raise ResultSetException(
+                    f"Key {row_key} appears more than once, diff keys must be unique"
+                )
+            compared[row_key] = (values, row_dict)
+        return compared
+
+    def to_json(self) -> str:
+        """the rows as a JSON array of objects, e.g. to return from a function returning ``json``.
+        See :meth:`.iter_json`
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> return wrapper.execute('select id,name from customer.company').to_json()
+        """
+        return "".join(self.iter_json())
+
+    def iter_json(
+        self, chunk_rows: int = serialization.DEFAULT_CHUNK_ROWS
+    ) -> Iterator[str]:
+        """encodes the rows as a JSON array of objects piece by piece, so a large result never has to be held as one string.
+        Values are encoded straight from the underlying result by an encoder chosen once per column from its type, which
+        handles ``numeric``, ``json`` / ``jsonb`` (embedded as is) and ``bytea`` columns. Uses orjson if it's installed and
+        every column is of a type it encodes the same way.
+
+        :param chunk_rows: how many rows are encoded into each piece
+        :return: pieces of JSON text that form the whole array when concatenated
+        """
+        return serialization.iter_json(
+            self.result_set, self.colnames, self.coltypes, chunk_rows
+        )
+
     @property
     def n_rows(self) -> int:
         """Returns the number of rows processed by the command"""
@@ -133,6 +529,48 @@ class ResultSet:
         return self.result_set.coltypmods()
 
 
+class _ReleaseSubtransaction(Exception):
+    """raised to roll back a subtransaction on purpose"""
+
+    pass
+
+
+def _rows_to_columns(rows: List[Row], columns: List[str]) -> Dict[str, list]:
+    """pivots rows into column arrays"""
+    return {c: [row._row_dict[c] for row in rows] for c in columns}
+
+
+def _estimate_result_size(result: PLyResult, sample_size: int = 100) -> int:
+    """a rough estimate of the memory taken up by the rows of a result in bytes, extrapolated from evenly spread sample rows"""
+    n_rows = len(result)
+    if not n_rows:
+        return 0
+    step = max(1, n_rows // sample_size)
+    sample = [result[i] for i in range(0, n_rows, step)]
+    sample_bytes = sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        for row in sample
+    )
+    return sample_bytes * n_rows // len(sample)
+
+
+def _pack_events(events: Iterable[str], limit: int) -> List[str]:
+    """packs JSON encoded events into as few JSON arrays as possible, each at most ``limit`` bytes long"""
+    batches = []
+    batch, size = [], 2
+    for event in events:
+        # the event itself plus the comma separating it from the previous one
+        event_size = len(event.encode()) + 1
+        if batch and size + event_size - 1 > limit:
+            batches.append("[" + ",".join(batch) + "]")
+            batch, size = [], 2
+        batch.append(event)
+        size += event_size
+    if batch:
+        batches.append("[" + ",".join(batch) + "]")
+    return batches
+
+
 class PLPYWrapper:
     """much documentation is taken from https://www.postgresql.org/docs/11/
     wrapper around plpython plpy library which is included by default in each plpython language procedure/function"""
@@ -185,10 +623,63 @@ class PLPYWrapper:
         datatype_name: str = None
         constraint_name: str = None
 
+    @dataclass
+    class MemoryBudget:
+        """limits on the results of :meth:`.PLPYWrapper.execute` and :meth:`.PLPYWrapper.execute_plan`, see :attr:`.PLPYWrapper.memory_budget`"""
+
+        #: the most rows a result may have, ``None`` for no limit
+        max_rows: int = None
+        #: the most bytes a result may (by estimate) take up, ``None`` for no limit
+        max_bytes: int = None
+        #: instead of raising, stream a ``SELECT`` result that is over budget from a cursor, see :class:`.CursorResult`
+        stream: bool = False
+        #: how many rows are fetched at a time when streaming
+        stream_batch_size: int = 1000
+        #: the fraction of calls whose peak python allocation is measured with ``tracemalloc``, see :attr:`.PLPYWrapper.memory_stats`
+        trace_rate: float = 0.0
+
+    @dataclass
+    class BatchResult:
+        """the outcome of :meth:`.PLPYWrapper.apply_in_batches`"""
+
+        #: ``(item, return value)`` for every item that was applied, in the order of the items
+        succeeded: List[Tuple[Any, Any]] = field(default_factory=list)
+        #: ``(item, exception)`` for every item that failed on its own
+        failed: List[Tuple[Any, Exception]] = field(default_factory=list)
+        #: the number of subtransactions (savepoints) that were used
+        subtransactions: int = 0
+
     _INIT_ERROR = """plpy-wrapper has been initiated outside of the postgres runtime.\
 Ensure that you've tried to init this from within a postgres database function with plpython3u\
 installed as a language extension."""
 
+    # the key in GD under which plpy_wrapper keeps its session-wide state
+    _GD_KEY = "_plpy_wrapper"
+
+    #: where :meth:`.process_in_chunks` keeps checkpoints, see :func:`plpy_wrapper.utilities.install_job_checkpoint_table`
+    JOB_CHECKPOINT_TABLE = '"public".plpy_wrapper_job_checkpoint'
+
+    #: the schema of the table :meth:`.flush_stats` writes to, see :func:`plpy_wrapper.utilities.install_stats`
+    STATS_SCHEMA = "public"
+
+    #: the table :meth:`.flush_stats` writes to
+    STATS_TABLE_NAME = "plpy_wrapper_stats"
+
+    #: the maximum size in bytes of the payloads sent by :meth:`.notify`, postgres requires them to be shorter than 8000 bytes
+    NOTIFY_PAYLOAD_LIMIT = 7999
+
+    #: the most entries each of the plan and column type caches in ``GD`` keeps, the least recently used are dropped first
+    SESSION_CACHE_SIZE = 256
+
+    #: where :meth:`.enable_module_loader` imports modules from, see :func:`plpy_wrapper.utilities.install_module_table`
+    MODULE_TABLE = '"public".plpy_wrapper_modules'
+
+    #: where :class:`plpy_wrapper.plans.PlanRegressionHarness` keeps its baselines, see :func:`plpy_wrapper.utilities.install_plan_baseline_table`
+    PLAN_BASELINE_TABLE = '"public".plpy_wrapper_plan_baselines'
+
+    #: where :meth:`.single_flight` publishes its values, see :func:`plpy_wrapper.utilities.install_single_flight_table`
+    SINGLE_FLIGHT_TABLE = '"public".plpy_wrapper_single_flight'
+
     def __init__(self, postgres_runtime_globals: dict):
         """
         :param postgres_runtime_globals: called from within the postgres plpython runtime by using
@@ -225,55 +716,2103 @@ installed as a language extension."""
         else:
             return self.plpy.prepare(query)
 
-    def execute_plan(self, plan: PLyPlan, args: List[Any], row_limit=None) -> ResultSet:
-        """see https://www.postgresql.org/docs/11/plpython-database.html for more information"""
-        if row_limit:
-            return ResultSet(self.plpy.execute(plan, args, row_limit))
+    @property
+    def _wrapper_state(self) -> dict:
+        """the part of ``GD`` that plpy_wrapper keeps its own session-wide state (e.g. cached plans) in"""
+        return self.global_data.setdefault(PLPYWrapper._GD_KEY, {})
+
+    def _prepare_cached(self, query: str, argtypes: List[str]) -> PLyPlan:
+        """same as :meth:`.prepare` except that the plan is kept in ``GD`` and reused for the rest of the session.
+        At most :attr:`.SESSION_CACHE_SIZE` plans are kept"""
+        return self._session_cached(
+            "plans", (query, tuple(argtypes)), lambda: self.prepare(query, argtypes)
+        )
+
+    def _session_cached(
+        self, name: str, key: Hashable, compute: Callable[[], Any]
+    ) -> Any:
+        """the value of ``key`` in the LRU cache ``name`` kept in ``GD``, ``compute`` is called on a miss.
+        The least recently used entries are dropped once there are more than :attr:`.SESSION_CACHE_SIZE`
+        """
+        entries = self._wrapper_state.get(name)
+        if entries is None:
+            entries = self._wrapper_state[name] = OrderedDict()
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+        value = entries[key] = compute()
+        while len(entries) > PLPYWrapper.SESSION_CACHE_SIZE:
+            entries.popitem(last=False)
+        return value
+
+    def insert_arrays(
+        self,
+        schema: str,
+        table_name: str,
+        columns: Dict[str, Sequence],
+        column_types: Union[Dict[str, str], None] = None,
+        memory_budget: int = bulk.DEFAULT_MEMORY_BUDGET,
+    ) -> int:
+        """inserts rows given as column arrays using one ``INSERT ... SELECT unnest(...)`` per chunk instead of one statement per row.
+        The amount of rows in each chunk is derived from ``memory_budget``.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> wrapper.insert_arrays('analytics','score',{'contact_id':[1,2,3],'score':numpy.array([0.5,0.2,0.9])})
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to insert into
+        :param columns: column name to column values. Values can be lists, ``array.array`` or NumPy arrays of equal length
+        :param column_types: the postgres element type per column (e.g. ``{'score':'float8'}``). Types that aren't given are inferred from the values
+        :param memory_budget: roughly how many bytes the array parameters of a single statement may take up
+        :return: the number of rows inserted
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the columns are of uneven length, a type can't be inferred or a column is an array
+        """
+        lists, column_types = bulk.prepare_columns(columns, column_types)
+        column_names = list(lists.keys())
+        plan = self._prepare_cached(
+            bulk.build_insert_sql(
+                utilities.make_qualified_schema_name(schema, table_name), column_names
+            ),
+            bulk.parameter_types(column_types, column_names),
+        )
+        return self._execute_array_chunks(plan, lists, column_types, memory_budget)
+
+    def update_arrays(
+        self,
+        schema: str,
+        table_name: str,
+        key_columns: List[str],
+        columns: Dict[str, Sequence],
+        column_types: Union[Dict[str, str], None] = None,
+        memory_budget: int = bulk.DEFAULT_MEMORY_BUDGET,
+    ) -> int:
+        """updates rows given as column arrays using one ``UPDATE ... FROM unnest(...)`` per chunk instead of one statement per row.
+        Rows are matched on ``key_columns`` and every other column in ``columns`` is set.
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to update
+        :param key_columns: the columns used to match rows, they must also be present in ``columns``
+        :param columns: column name to column values. Values can be lists, ``array.array`` or NumPy arrays of equal length
+        :param column_types: the postgres element type per column. Types that aren't given are inferred from the values
+        :param memory_budget: roughly how many bytes the array parameters of a single statement may take up
+        :return: the number of rows updated
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if a key column is missing, there is nothing to update, the columns are of uneven length, a type can't be inferred or a column is an array
+        """
+        missing_keys = [k for k in key_columns if k not in columns]
+        if not key_columns or missing_keys:
+            raise PLPythonWrapperException(
+                f"Key columns must be given and present in columns. Missing: {missing_keys}"
+            )
+        if len(columns) == len(key_columns):
+            raise PLPythonWrapperException("There are no non-key columns to update")
+        lists, column_types = bulk.prepare_columns(columns, column_types)
+        column_names = list(lists.keys())
+        plan = self._prepare_cached(
+            bulk.build_update_sql(
+                utilities.make_qualified_schema_name(schema, table_name),
+                column_names,
+                key_columns,
+            ),
+            bulk.parameter_types(column_types, column_names),
+        )
+        return self._execute_array_chunks(plan, lists, column_types, memory_budget)
+
+    def delete_arrays(
+        self,
+        schema: str,
+        table_name: str,
+        columns: Dict[str, Sequence],
+        column_types: Union[Dict[str, str], None] = None,
+        memory_budget: int = bulk.DEFAULT_MEMORY_BUDGET,
+    ) -> int:
+        """deletes the rows matching the given column arrays using one ``DELETE ... USING unnest(...)`` per chunk.
+        A row is deleted if it matches every column of one of the array entries.
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to delete from
+        :param columns: column name to column values (usually just the primary key)
+        :param column_types: the postgres element type per column. Types that aren't given are inferred from the values
+        :param memory_budget: roughly how many bytes the array parameters of a single statement may take up
+        :return: the number of rows deleted
+        """
+        lists, column_types = bulk.prepare_columns(columns, column_types)
+        column_names = list(lists.keys())
+        plan = self._prepare_cached(
+            bulk.build_delete_sql(
+                utilities.make_qualified_schema_name(schema, table_name), column_names
+            ),
+            bulk.parameter_types(column_types, column_names),
+        )
+        return self._execute_array_chunks(plan, lists, column_types, memory_budget)
+
+    def apply_diff(
+        self,
+        schema: str,
+        table_name: str,
+        diff: ResultSetDiff,
+        key_columns: List[str],
+        column_types: Union[Dict[str, str], None] = None,
+        memory_budget: int = bulk.DEFAULT_MEMORY_BUDGET,
+    ) -> Dict[str, int]:
+        """applies a :class:`.ResultSetDiff` to a table with batched set-based statements: deletes, then updates, then inserts.
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to synchronize, usually the one the target result set of the diff was read from
+        :param diff: the output of :meth:`.ResultSet.diff`
+        :param key_columns: the columns used to match rows, usually the ``key`` given to :meth:`.ResultSet.diff`
+        :param column_types: the postgres element type per column, defaults to the types of the table's columns
+        :param memory_budget: roughly how many bytes the array parameters of a single statement may take up
+        :return: the number of rows ``deleted``, ``updated`` and ``inserted``
+        """
+        column_types = column_types or self._table_column_types(schema, table_name)
+        counts = {"deleted": 0, "updated": 0, "inserted": 0}
+        if diff.deleted:
+            counts["deleted"] = self.delete_arrays(
+                schema,
+                table_name,
+                _rows_to_columns(diff.deleted, key_columns),
+                column_types,
+                memory_budget,
+            )
+        if diff.changed:
+            source_rows = [source for source, _ in diff.changed]
+            counts["updated"] = self.update_arrays(
+                schema,
+                table_name,
+                key_columns,
+                _rows_to_columns(source_rows, list(source_rows[0]._row_dict.keys())),
+                column_types,
+                memory_budget,
+            )
+        if diff.inserted:
+            counts["inserted"] = self.insert_arrays(
+                schema,
+                table_name,
+                _rows_to_columns(
+                    diff.inserted, list(diff.inserted[0]._row_dict.keys())
+                ),
+                column_types,
+                memory_budget,
+            )
+        return counts
+
+    def lookup(
+        self, schema: str, table_name: str, key_columns: Sequence[str], key: Any
+    ) -> Union[Row, None]:
+        """fetches a single row by key through a cache that lives until the end of the current transaction.
+        Repeated lookups of the same key (e.g. the parent company of every contact touched by a statement) only hit the
+        database once. On a cache miss, every key queued by :meth:`.prefetch` is fetched in the same ``= ANY($1)`` query.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> company = wrapper.lookup('customer','company',['id'],TD['new']['company_id'])
+
+        .. note::
+
+         Changes made to the table later in the same transaction are not reflected in cached rows. Use :meth:`.clear_lookup_cache` after writing to a looked up table.
+         A cache hit runs no query in triggers on tables with statement level triggers (see :meth:`.open_deferred`),
+         elsewhere every lookup checks which transaction it runs in with one query.
+         The cache is dropped when a :meth:`.subtransaction` is rolled back, but not when a subtransaction started with ``plpy.subtransaction()`` is
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to look up
+        :param key_columns: the columns making up the key, they should be unique
+        :param key: the key value, a tuple of values if there is more than one key column
+        :return: the matching :class:`.Row` or ``None`` if there is none
+        """
+        cache = self._lookup_cache(schema, table_name, key_columns)
+        if key not in cache["rows"]:
+            cache["pending"].add(key)
+            self._load_pending_lookups(schema, table_name, key_columns, cache)
+        row_dict = cache["rows"][key]
+        # copying since changes to a Row are written to its dict
+        return Row(dict(row_dict)) if row_dict is not None else None
+
+    def prefetch(
+        self,
+        schema: str,
+        table_name: str,
+        key_columns: Sequence[str],
+        keys: Iterable[Any],
+    ) -> None:
+        """queues keys to be fetched together with the next cache miss of :meth:`.lookup` on the same table and key columns
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to look up
+        :param key_columns: the columns making up the key
+        :param keys: the key values, tuples of values if there is more than one key column
+        """
+        cache = self._lookup_cache(schema, table_name, key_columns)
+        cache["pending"].update(k for k in keys if k not in cache["rows"])
+
+    def clear_lookup_cache(self) -> None:
+        """drops every row cached by :meth:`.lookup` in the current transaction"""
+        self._statement_transaction_state().pop("lookups", None)
+
+    def _lookup_cache(
+        self, schema: str, table_name: str, key_columns: Sequence[str]
+    ) -> dict:
+        """the transaction scoped cache of :meth:`.lookup` for a single table and key"""
+        return (
+            self._statement_transaction_state()
+            .setdefault("lookups", {})
+            .setdefault(
+                (schema, table_name, tuple(key_columns)),
+                {"rows": {}, "pending": set()},
+            )
+        )
+
+    def _load_pending_lookups(
+        self, schema: str, table_name: str, key_columns: Sequence[str], cache: dict
+    ) -> None:
+        """fetches every pending key of a lookup cache in a single query"""
+        pending = list(cache["pending"])
+        cache["pending"] = set()
+        column_types = self._table_column_types(schema, table_name)
+        missing = [c for c in key_columns if c not in column_types]
+        if missing:
+            raise PLPythonWrapperException(
+                f"Cannot look up by {missing} since they are not columns of {schema}.{table_name}"
+            )
+        qualified_table_name = utilities.make_qualified_schema_name(schema, table_name)
+        quoted_keys = [utilities.quote_identifier(c) for c in key_columns]
+        if len(key_columns) == 1:
+            query = "select * from {t} where {k} = ANY($1)".format(
+                t=qualified_table_name, k=quoted_keys[0]
+            )
+            args = [pending]
         else:
-            return ResultSet(self.plpy.execute(plan, args))
+            query = (
+                "select * from {t} where ({k}) in (select * from unnest({p}))".format(
+                    t=qualified_table_name,
+                    k=", ".join(quoted_keys),
+                    p=", ".join(f"${i}" for i in range(1, len(key_columns) + 1)),
+                )
+            )
+            args = [[key[i] for key in pending] for i in range(len(key_columns))]
+        plan = self._prepare_cached(
+            query, bulk.parameter_types(column_types, key_columns)
+        )
+        for key in pending:
+            # keys that aren't found are cached as None so they aren't queried again
+            cache["rows"][key] = None
+        for row_dict in self.plpy.execute(plan, args):
+            if len(key_columns) == 1:
+                key = _hashable(row_dict[key_columns[0]])
+            else:
+                key = tuple(_hashable(row_dict[c]) for c in key_columns)
+            cache["rows"][key] = row_dict
 
-    def execute(self, query: str) -> ResultSet:
+    @property
+    def query_cache(self) -> cache.QueryCache:
+        """the session wide cache used by :meth:`.execute_cached` and :meth:`.cached_query`. Its ``stats`` show hits, misses and evictions
+        and its ``max_bytes``, ``default_ttl`` and ``check_interval`` can be changed at any time
         """
+        return self._wrapper_state.setdefault("query_cache", cache.QueryCache())
+
+    def execute_cached(
+        self,
+        query: str,
+        args: Union[List[Any], None] = None,
+        argtypes: Union[List[str], None] = None,
+        ttl: Union[float, None] = None,
+        depends_on: Sequence[cache.TableName] = (),
+    ) -> ResultSet:
+        """executes a read only query once per session and serves later calls from :attr:`.query_cache`.
+        Results are stored compactly as a :class:`.MaterializedResult` rather than as live ``PLyResult`` objects.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> settings = wrapper.execute_cached('select * from config.setting',ttl=60,depends_on=[('config','setting')])
 
         :param query: the SQL string to execute
-        :return: a ResultSet
+        :param args: values for the query's parameters
+        :param argtypes: types of the query's parameters, required if ``args`` is given
+        :param ttl: seconds the result stays valid, defaults to the cache's ``default_ttl``
+        :param depends_on: ``(schema, table_name)`` of tables whose changes invalidate the result. Each table must have been set up with :func:`plpy_wrapper.utilities.install_cache_invalidation`
+        :return: the (possibly cached) ResultSet
+        """
+        key = ("query", query, _hashable(list(args or [])), tuple(argtypes or []))
+
+        def run_query():
+            if args:
+                return self.execute_plan(self._prepare_cached(query, argtypes), args)
+            return self.execute(query)
+
+        return self._execute_through_cache(key, run_query, ttl, depends_on)
+
+    def cached_query(
+        self,
+        ttl: Union[float, None] = None,
+        depends_on: Sequence[cache.TableName] = (),
+    ) -> Callable[[Callable[..., ResultSet]], Callable[..., ResultSet]]:
+        """decorator version of :meth:`.execute_cached` for functions returning a :class:`.ResultSet`.
+        Results are cached per function and arguments
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> @wrapper.cached_query(ttl=300,depends_on=[('auth','permission')])
+        >>> def permissions(role):
+        >>>     return wrapper.execute_plan(wrapper.prepare('select * from auth.permission where role=$1',['text']),[role])
+
+        :param ttl: seconds a result stays valid, defaults to the cache's ``default_ttl``
+        :param depends_on: ``(schema, table_name)`` of tables whose changes invalidate the results
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                key = (
+                    "function",
+                    func.__module__,
+                    func.__qualname__,
+                    _hashable(list(args)),
+                    _hashable(sorted(kwargs.items())),
+                )
+                return self._execute_through_cache(
+                    key, lambda: func(*args, **kwargs), ttl, depends_on
+                )
+
+            return inner
+
+        return decorator
+
+    def _execute_through_cache(
+        self,
+        key: tuple,
+        run: Callable[[], ResultSet],
+        ttl: Union[float, None],
+        depends_on: Sequence[cache.TableName],
+    ) -> ResultSet:
+        """returns the cached result under ``key`` if it's still valid, otherwise calls ``run`` and caches its result.
+        Results are cached per role and ``search_path``, which decide what the same query returns
         """
-        result = self.plpy.execute(query)
+        query_cache = self.query_cache
+        dependencies = tuple(tuple(t) for t in depends_on)
+        identity, table_versions = self._cache_context(dependencies)
+        key = key + identity
+        if not dependencies:
+            dependencies = query_cache.dependencies(key)
+            if dependencies:
+                table_versions = self._cache_context(dependencies)[1]
+        hit, result = query_cache.get(key, table_versions)
+        if not hit:
+            result = MaterializedResult.from_plpy_result(run().result_set)
+            query_cache.put(key, result, result.estimated_size(), ttl, table_versions)
         return ResultSet(result)
 
-    def execute_with_transaction(self, query: str) -> ResultSet:
-        """see https://www.postgresql.org/docs/11/plpython-transactions.html
-        executes a the given query in a transaction and commits. If an exception is encountered, the transaction is rolled back
-        :param query: the SQL to run
-        :return: the ResultSets
-        :raises ```plpy.SPIError``
+    def _cache_context(
+        self, tables: Sequence[cache.TableName]
+    ) -> Tuple[Tuple[str, str], Union[Dict[cache.TableName, str], None]]:
+        """the current role and ``search_path`` and the current version of each table (``None`` without tables), read with a
+        single query. Within the :attr:`plpy_wrapper.cache.QueryCache.check_interval` of the cache the previous answer is reused
         """
-        try:
-            result_set = self.execute(query)
-            self.commit()
-            return result_set
-        except self.plpy.SPIError as e:
-            self.rollback()
-            raise e
+        check_interval = self.query_cache.check_interval
+        # what was read last: (read at, identity) and table to (read at, version)
+        known = self._wrapper_state.setdefault(
+            "query_cache_context", {"identity": None, "versions": {}}
+        )
+        if check_interval is not None:
+            now = time.monotonic()
+            fresh = [known["identity"]] + [known["versions"].get(t) for t in tables]
+            if all(f is not None and now - f[0] < check_interval for f in fresh):
+                return known["identity"][1], (
+                    {t: known["versions"][t][1] for t in tables} if tables else None
+                )
+        if tables:
+            rows = self.execute_plan(
+                self._prepare_cached(
+                    f"""select current_user::text as role_name, current_setting('search_path') as search_path,
+                    t.schema_name, t.table_name, coalesce((select string_agg(v.slot || ':' || v.version, ',' order by v.slot)
+                    from {cache.TABLE_VERSION_TABLE} v where v.schema_name = t.schema_name and v.table_name = t.table_name), '') as version
+                    from unnest($1::text[], $2::text[]) as t(schema_name, table_name)""",
+                    ["text[]", "text[]"],
+                ),
+                [[t[0] for t in tables], [t[1] for t in tables]],
+            )
+        else:
+            rows = self.execute_plan(
+                self._prepare_cached(
+                    "select current_user::text as role_name, current_setting('search_path') as search_path",
+                    [],
+                ),
+                [],
+            )
+        read_at = time.monotonic()
+        identity = (rows[0].role_name, rows[0].search_path)
+        known["identity"] = (read_at, identity)
+        if not tables:
+            return identity, None
+        versions = {(row.schema_name, row.table_name): row.version for row in rows}
+        known["versions"].update(
+            (table, (read_at, version)) for table, version in versions.items()
+        )
+        return identity, versions
 
-    def __repr__(self):
-        return "PLPYWrapper=" + str(self.__dict__)
+    def shared_cache(self, directory: Union[str, Path, None] = None) -> SharedCache:
+        """a cache shared by every backend on the host, backed by memory mapped files.
+        Unlike ``GD``, values stored here are computed and held once for all pooled connections.
+        The instance is kept in ``GD`` so that its file mappings are reused between calls
 
-    @contextmanager
-    def subtransaction(self) -> None:
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> cache = wrapper.shared_cache()
+        >>> names = cache.get('company_names')
+        >>> if names is None:
+        >>>     names = {row.id: row.name for row in wrapper.execute('select id,name from customer.company')}
+        >>>     cache.set('company_names',names)
+
+        :param directory: the directory holding the cache files, every backend using the same directory shares the same cache.
+         Defaults to :data:`plpy_wrapper.shared_cache.DEFAULT_DIRECTORY_NAME` in the data directory of the server, which
+         only the postgres user can write to (reading ``data_directory`` requires ``pg_read_all_settings``)
+        :return: see :class:`plpy_wrapper.shared_cache.SharedCache`
+        :raises: :class:`plpy_wrapper.exceptions.SharedCacheException` if the directory can be written by other users
         """
-        ghost wrapper around plpy subtransaction.
-        Example usage:
+        caches = self._wrapper_state.setdefault("shared_caches", {})
+        if directory is None:
+            directory = Path(
+                self.execute(
+                    "select current_setting('data_directory') as data_directory"
+                )[0].data_directory,
+                DEFAULT_DIRECTORY_NAME,
+            )
+        directory = Path(directory)
+        if directory not in caches:
+            caches[directory] = SharedCache(directory)
+        return caches[directory]
+
+    def enable_module_loader(
+        self,
+        key_directory: Union[str, Path, None] = None,
+        reload: bool = True,
+    ) -> loader.DatabaseFinder:
+        """lets ``import`` find the modules of :attr:`.MODULE_TABLE` (see :meth:`.publish_module`) for the rest of the session.
+        Trigger handlers and other code kept there is compiled once per version instead of once per backend, the backends
+        share the bytecode through the table. Calling it again reloads the modules whose version was bumped since they were
+        imported, so calling it at the start of every function keeps the code up to date
 
         >>> from plpy_wrapper import PLPYWrapper
         >>> wrapper = PLPYWrapper(globals())
-        >>> with wrapper.subtransaction():
-        >>>  pass
-        >>>  #do subtransaction stuff here
+        >>> wrapper.enable_module_loader()
+        >>> from handlers.company import CompanyTrigger
+        >>> trigger_handler = CompanyTrigger(wrapper)
+
+        .. important::
+
+         importing a module runs its code in the backend, so whoever can write :attr:`.MODULE_TABLE` can run code as the
+         postgres user. :func:`plpy_wrapper.utilities.install_module_table` keeps it to the owner of the table, only grant
+         writing it to roles that may do that. Stored bytecode is only run if it's signed, see :mod:`plpy_wrapper.loader`
+
+        :param key_directory: the directory of the :meth:`.shared_cache` the key signing the bytecode is kept in,
+         the default one if ``None``
+        :param reload: whether to reload the modules that changed
+        :return: the finder in ``sys.meta_path``, which also records the imported versions
+        """
+        finder = self._wrapper_state.get("module_finder")
+        if finder is None:
+            finder = loader.DatabaseFinder(
+                self, loader.signing_key(self.shared_cache(key_directory))
+            )
+            self._wrapper_state["module_finder"] = finder
+        # the wrapper of the latest call, whose plpy is the one that's valid
+        finder.plpy_wrapper = self
+        if finder not in sys.meta_path:
+            sys.meta_path.append(finder)
+        elif reload:
+            finder.refresh()
+        return finder
+
+    def disable_module_loader(self) -> None:
+        """stops importing from :attr:`.MODULE_TABLE` and removes the modules imported from it from ``sys.modules``"""
+        finder = self._wrapper_state.pop("module_finder", None)
+        if finder is None:
+            return
+        if finder in sys.meta_path:
+            sys.meta_path.remove(finder)
+        finder.unload()
+
+    def publish_module(
+        self,
+        name: str,
+        source: str,
+        is_package: bool = False,
+        key_directory: Union[str, Path, None] = None,
+    ) -> int:
+        """stores a module in :attr:`.MODULE_TABLE` along with its signed bytecode. The version is bumped if the source
+        changed, which makes :meth:`.enable_module_loader` reload it in every backend
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> wrapper.publish_module('handlers', '', is_package=True)
+        >>> wrapper.publish_module('handlers.company', Path('handlers/company.py').read_text())
 
+        :param name: the full name of the module, e.g. ``handlers.company``
+        :param source: the python code
+        :param is_package: whether the module is a package, whose submodules are published under its name
+        :param key_directory: see :meth:`.enable_module_loader`
+        :return: the version of the module
+        :raises: ``SyntaxError`` if the source doesn't compile, nothing is stored then
         """
-        with self.plpy.subtransaction() as subtransaction:
-            yield subtransaction
+        bytecode = marshal.dumps(loader.compile_module(name, source))
+        digest = loader.source_hash(source)
+        key = loader.signing_key(self.shared_cache(key_directory))
+        rows = self.execute_plan(
+            self._prepare_cached(
+                f"""insert into {PLPYWrapper.MODULE_TABLE} as _target
+                (name, source, is_package, source_hash, bytecode, python_magic, signature)
+                values ($1, $2, $3, $4, $5, $6, $7)
+                on conflict (name) do update
+                set source = excluded.source, is_package = excluded.is_package, source_hash = excluded.source_hash,
+                bytecode = excluded.bytecode, python_magic = excluded.python_magic, signature = excluded.signature,
+                version = _target.version + 1, updated_at = now()
+                where _target.source is distinct from excluded.source or _target.is_package <> excluded.is_package
+                returning version""",
+                ["text", "text", "bool", "text", "bytea", "text", "text"],
+            ),
+            [
+                name,
+                source,
+                is_package,
+                digest,
+                bytecode,
+                loader.PYTHON_MAGIC,
+                loader.sign(key, digest, bytecode),
+            ],
+        )
+        if len(rows):
+            return rows[0].version
+        # unchanged
+        return self.execute_plan(
+            self._prepare_cached(
+                f"select version from {PLPYWrapper.MODULE_TABLE} where name = $1",
+                ["text"],
+            ),
+            [name],
+        )[0].version
+
+    def single_flight(
+        self,
+        key: str,
+        compute: Callable[[], Any],
+        max_age: float = 60,
+        timeout_ms: int = 5000,
+    ) -> Any:
+        """makes sure an expensive computation runs in only one session at a time, with every other session reusing its result.
+        The first session to arrive takes a ``pg_advisory_xact_lock`` on the key, computes the value and publishes it (as JSON)
+        to the single flight table. Sessions arriving meanwhile wait for the lock, which is released when the computing
+        transaction commits and its published value becomes visible, and then reuse that value instead of computing it again.
+        If waiting takes longer than ``timeout_ms``, or the computing session failed, the value is computed locally.
+        The table has to be created once with :func:`plpy_wrapper.utilities.install_single_flight_table`
+
+        .. note::
+
+         Under ``REPEATABLE READ`` and ``SERIALIZABLE`` the snapshot of a waiting transaction predates the computing
+         transaction's commit, so it could never see the published value. Such transactions don't wait, they compute locally
+         (counted as a fallback) unless the value was published before their snapshot was taken
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> totals = wrapper.single_flight('company_totals',lambda: expensive_aggregate(wrapper),max_age=300)
+
+        :param key: identifies the computation
+        :param compute: computes the value, which must be JSON serializable
+        :param max_age: seconds for which a published value is reused
+        :param timeout_ms: how long to wait for another session's computation before computing locally
+        :return: the computed or reused value as ``json.loads`` returns it (e.g. lists instead of tuples), whether it was
+         computed by this session or not
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the value can't be serialized as JSON
+        """
+        stats = self._single_flight_state()
+        published = self._read_single_flight(key, max_age)
+        if published is not None:
+            stats["reused"] += 1
+            return published[0]
+
+        lock_key = "plpy_wrapper.single_flight:" + key
+        attempt = self.execute_plan(
+            self._prepare_cached(
+                """select pg_try_advisory_xact_lock(hashtextextended($1, 0)) as acquired,
+                current_setting('transaction_isolation') as isolation""",
+                ["text"],
+            ),
+            [lock_key],
+        )[0]
+        if attempt.acquired:
+            # the lock is held until the end of the transaction, which is also when the published value becomes visible
+            stats["computed"] += 1
+            value = self._compute_single_flight(key, compute)
+            self.execute_plan(
+                self._prepare_cached(
+                    f"""insert into {PLPYWrapper.SINGLE_FLIGHT_TABLE} (key, value, published_at) values ($1, $2::jsonb, clock_timestamp())
+                    on conflict (key) do update set value = excluded.value, published_at = excluded.published_at""",
+                    ["text", "text"],
+                ),
+                [key, value],
+            )
+            return json.loads(value)
+        if attempt.isolation != "read committed":
+            # the snapshot won't show what the computing transaction publishes, waiting for it would be in vain
+            stats["fallbacks"] += 1
+            return json.loads(self._compute_single_flight(key, compute))
+
+        wait_started_at = time.perf_counter()
+        try:
+            with self.subtransaction():
+                self.execute_plan(
+                    self._prepare_cached(
+                        "select set_config('lock_timeout', $1, true)", ["text"]
+                    ),
+                    [f"{timeout_ms}ms"],
+                )
+                self.execute_plan(
+                    self._prepare_cached(
+                        "select pg_advisory_xact_lock(hashtextextended($1, 0))",
+                        ["text"],
+                    ),
+                    [lock_key],
+                )
+                # aborting the subtransaction releases the lock (and lock_timeout) right away
+                raise _ReleaseSubtransaction()
+        except _ReleaseSubtransaction:
+            published = self._read_single_flight(key, max_age)
+        except self.plpy.SPIError as e:
+            # only an expired lock_timeout falls back, a canceled query or a deadlock is the caller's to handle
+            if getattr(e, "sqlstate", None) != _LOCK_NOT_AVAILABLE:
+                raise
+            published = None
+        finally:
+            stats["lock_wait_seconds"] += time.perf_counter() - wait_started_at
+
+        if published is not None:
+            stats["coalesced"] += 1
+            return published[0]
+        stats["fallbacks"] += 1
+        return json.loads(self._compute_single_flight(key, compute))
+
+    @staticmethod
+    def _compute_single_flight(key: str, compute: Callable[[], Any]) -> str:
+        """computes the value of :meth:`.single_flight` as JSON, whether it's published or not, so that every path returns the
+        same ``json.loads`` shape"""
+        try:
+            return json.dumps(compute())
+        except (TypeError, ValueError) as e:
+            raise PLPythonWrapperException(
+                f"The value of single flight {key} can't be published as JSON: {e}"
+            ) from e
+
+    @property
+    def single_flight_stats(self) -> Dict[str, float]:
+        """how often :meth:`.single_flight` computed a value, reused an already published one, waited for and reused
+        (coalesced) another session's computation or fell back to computing locally, plus the total time spent waiting for locks.
+        ``coalescing_ratio`` is the share of calls that didn't compute anything"""
+        stats = dict(self._single_flight_state())
+        calls = (
+            stats["computed"]
+            + stats["reused"]
+            + stats["coalesced"]
+            + stats["fallbacks"]
+        )
+        stats["coalescing_ratio"] = (
+            (stats["reused"] + stats["coalesced"]) / calls if calls else 0.0
+        )
+        return stats
+
+    def _single_flight_state(self) -> dict:
+        return self._wrapper_state.setdefault(
+            "single_flight",
+            {
+                "computed": 0,
+                "reused": 0,
+                "coalesced": 0,
+                "fallbacks": 0,
+                "lock_wait_seconds": 0.0,
+            },
+        )
+
+    def _read_single_flight(self, key: str, max_age: float) -> Union[Tuple[Any], None]:
+        """the value published for ``key`` in the last ``max_age`` seconds, as a 1-tuple so that ``None`` can be a value"""
+        rows = self.execute_plan(
+            self._prepare_cached(
+                f"""select value::text as value from {PLPYWrapper.SINGLE_FLIGHT_TABLE}
+                where key = $1 and published_at > clock_timestamp() - $2 * interval '1 second'""",
+                ["text", "float8"],
+            ),
+            [key, max_age],
+        )
+        return (json.loads(rows[0].value),) if len(rows) else None
+
+    def enable_profiling(self, sample_rate: float = 0.01) -> profiling.Profiler:
+        """starts profiling a fraction of the invocations of every :class:`plpy_wrapper.trigger.Trigger` (and of any code run in
+        :meth:`.profile`) for the rest of the session. The stats are merged in ``GD`` per trigger class and table, see
+        :meth:`.profile_report`. Calling it again only changes the sample rate.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> wrapper.enable_profiling(sample_rate=0.1)
+        >>> wrapper.execute('update customer.contact set last_name = upper(last_name)')
+        >>> wrapper.publish_profile_report(top=10)
+
+        :param sample_rate: the fraction of invocations that are profiled, between 0 and 1
+        :return: the session's profiler
+        """
+        profiler = self.profiler
+        if profiler is None:
+            profiler = self._wrapper_state["profiler"] = profiling.Profiler(sample_rate)
+        profiler.sample_rate = sample_rate
+        return profiler
+
+    def disable_profiling(self) -> None:
+        """stops profiling and drops the collected stats"""
+        self._wrapper_state.pop("profiler", None)
+
+    @property
+    def profiler(self) -> Union[profiling.Profiler, None]:
+        """the session's profiler, ``None`` unless :meth:`.enable_profiling` was called"""
+        return self.global_data.get(PLPYWrapper._GD_KEY, {}).get("profiler")
+
+    def profile(self, name: str):
+        """a context manager that profiles its body like a trigger invocation if profiling is enabled and the invocation is sampled.
+        It does nothing when profiling is disabled
+
+        >>> with wrapper.profile('recalculate_scores'):
+        >>>     recalculate_scores()
+
+        :param name: what the stats are merged under in :meth:`.profile_report`
+        """
+        profiler = self.profiler
+        return nullcontext() if profiler is None else profiler.sample(name)
+
+    def profile_report(
+        self, name: Union[str, None] = None, top: int = 20, sort: str = "cumulative"
+    ) -> List[dict]:
+        """the hot spots of the profiled invocations of this session, suitable as the return value of a set-returning function,
+        see :func:`plpy_wrapper.utilities.install_profile_report_function`
+
+        :param name: only report this name (e.g. ``CompanyTrigger on customer.company``), all names if not given
+        :param top: how many functions to report per name
+        :param sort: ``cumulative``, ``total`` or ``calls``
+        :return: a row per function, see :meth:`plpy_wrapper.profiling.Profiler.report`
+        """
+        profiler = self.profiler
+        return profiler.report(name, top, sort) if profiler is not None else []
+
+    def publish_profile_report(
+        self,
+        name: Union[str, None] = None,
+        top: int = 20,
+        sort: str = "cumulative",
+        message_priority: MessagePriority = MessagePriority.info,
+    ) -> None:
+        """publishes :meth:`.profile_report` as a message, one line per function"""
+        lines = [
+            "{name}: {function} calls={calls} total={total_time:.6f}s cumulative={cumulative_time:.6f}s".format(
+                **row
+            )
+            for row in self.profile_report(name, top, sort)
+        ]
+        self.publish_message(
+            message_priority, "\n".join(["plpy_wrapper profile report"] + lines)
+        )
+
+    def process_in_chunks(
+        self,
+        source_query: str,
+        key_columns: List[str],
+        handler: Callable[[ResultSet], Any],
+        chunk_size: int = 1000,
+        commit_every: Union[int, None] = 1,
+        job_name: Union[str, None] = None,
+        estimate_total: bool = False,
+    ) -> Dict[str, float]:
+        """drives a long running batch job over the rows of ``source_query``, handing them to ``handler`` one chunk at a time.
+        Chunks are read with keyset pagination (``WHERE (keys) > (last keys) ORDER BY keys LIMIT n``) rather than a cursor,
+        so every chunk is a fresh query that survives :meth:`.commit`. With a ``job_name`` the last processed key is
+        checkpointed on every commit, and a job that was interrupted resumes after it the next time it runs.
+        Throughput (and the ETA if ``estimate_total`` is set) is reported with :meth:`.publish_message` on every commit.
+        The checkpoint table has to be created once with :func:`plpy_wrapper.utilities.install_job_checkpoint_table`
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> def archive(chunk):
+        >>>     wrapper.insert_arrays('archive','contact',{'id':[row.id for row in chunk]})
+        >>> wrapper.process_in_chunks('select id from customer.contact',['id'],archive,chunk_size=10000,commit_every=1,job_name='archive_contacts')
+
+        .. note::
+
+         Committing is only possible when called from a procedure (``CALL``). Pass ``commit_every=None`` to never commit
+
+        :param source_query: the rows to process, the key columns must be among its columns and be unique
+        :param key_columns: the columns to paginate by, they must not be ``NULL`` (see :meth:`.paginate`)
+        :param handler: called with a :class:`.ResultSet` per chunk
+        :param chunk_size: the number of rows per chunk
+        :param commit_every: commit (and checkpoint) after this many chunks, ``None`` to never commit
+        :param job_name: identifies the job's checkpoint, ``None`` to not checkpoint
+        :param estimate_total: count the rows up front so that progress messages include an ETA
+        :return: the number of ``rows`` and ``chunks`` processed in this run and the ``seconds`` it took
+        """
+        start_after = None
+        if job_name is not None:
+            checkpoint = self.execute_plan(
+                self._prepare_cached(
+                    f"select last_key from {PLPYWrapper.JOB_CHECKPOINT_TABLE} where job_name = $1",
+                    ["text"],
+                ),
+                [job_name],
+            )
+            if len(checkpoint):
+                start_after = json.loads(checkpoint[0].last_key)
+        total_rows = None
+        if estimate_total:
+            total_rows = self.execute(
+                f"select count(*) as count from ({source_query}) as _source"
+            )[0].count
+
+        started_at = time.perf_counter()
+        rows = chunks = 0
+        for chunk in self.paginate(
+            source_query, key_columns, chunk_size, start_after=start_after
+        ):
+            handler(chunk)
+            rows += len(chunk)
+            chunks += 1
+            last_row = chunk.result_set[len(chunk) - 1]
+            last_key = [last_row[c] for c in key_columns]
+            if commit_every is not None and chunks % commit_every == 0:
+                self._checkpoint_job(job_name, last_key)
+                self.commit()
+                self._report_progress(
+                    job_name or source_query, rows, total_rows, started_at
+                )
+        if job_name is not None:
+            # the job is done, so the next run starts from the beginning
+            self.execute_plan(
+                self._prepare_cached(
+                    f"delete from {PLPYWrapper.JOB_CHECKPOINT_TABLE} where job_name = $1",
+                    ["text"],
+                ),
+                [job_name],
+            )
+        if commit_every is not None:
+            self.commit()
+        return {
+            "rows": rows,
+            "chunks": chunks,
+            "seconds": time.perf_counter() - started_at,
+        }
+
+    def _checkpoint_job(self, job_name: Union[str, None], last_key: List[Any]) -> None:
+        if job_name is None:
+            return
+        self.execute_plan(
+            self._prepare_cached(
+                f"""insert into {PLPYWrapper.JOB_CHECKPOINT_TABLE} (job_name, last_key, updated_at) values ($1, $2, clock_timestamp())
+                on conflict (job_name) do update set last_key = excluded.last_key, updated_at = excluded.updated_at""",
+                ["text", "text"],
+            ),
+            [job_name, json.dumps(last_key, default=str)],
+        )
+
+    def _report_progress(
+        self, job: str, rows: int, total_rows: Union[int, None], started_at: float
+    ) -> None:
+        elapsed = time.perf_counter() - started_at
+        rate = rows / elapsed if elapsed else 0.0
+        message = f"{job}: {rows} rows processed, {rate:.0f} rows/s"
+        if total_rows is not None and rate:
+            message += ", ETA {eta:.0f}s".format(eta=max(total_rows - rows, 0) / rate)
+        self.publish_message(PLPYWrapper.MessagePriority.info, message)
+
+    def paginate(
+        self,
+        query: str,
+        key_columns: List[str],
+        page_size: int,
+        descending: bool = False,
+        start_after: Union[List[Any], None] = None,
+    ) -> Iterator[ResultSet]:
+        """iterates over the rows of ``query`` page by page using keyset pagination.
+        The query is rewritten into a prepared ``WHERE (keys) > ($1, ...) ORDER BY keys LIMIT n`` plan that continues after
+        the last row of the previous page, so unlike ``OFFSET`` every page costs the same no matter how deep it is
+        (given an index on the key columns).
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> for page in wrapper.paginate('select * from customer.contact',['last_name','id'],page_size=500):
+        >>>     for contact in page:
+        >>>         pass
+
+        :param query: the query to paginate, it must not have its own ``ORDER BY`` or ``LIMIT``
+        :param key_columns: the columns to order and paginate by. Together they must be unique and ``NOT NULL``: rows with a
+         ``NULL`` key are only detected when they show up in a page, ``WHERE (keys) > (...)`` skips the others silently
+        :param page_size: the maximum number of rows per page
+        :param descending: order every key column descending instead of ascending
+        :param start_after: the key values of the row to start after, e.g. a saved position. ``None`` starts at the first row
+        :return: a generator of :class:`.ResultSet` pages
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if a key column isn't a column of the query or if
+         a page has a row with a ``NULL`` key
+        """
+        if not key_columns:
+            raise PLPythonWrapperException("At least one key column is required")
+        column_types = self._query_column_types(query)
+        missing = [c for c in key_columns if c not in column_types]
+        if missing:
+            raise PLPythonWrapperException(
+                f"Cannot paginate by {missing} since they are not columns of the query. Columns: {list(column_types)}"
+            )
+        keys = ", ".join(utilities.quote_identifier(c) for c in key_columns)
+        direction = "desc" if descending else "asc"
+        order_by = ", ".join(
+            f"{utilities.quote_identifier(c)} {direction}" for c in key_columns
+        )
+        first_plan = self._prepare_cached(
+            f"select * from ({query}) as _source order by {order_by} limit {int(page_size)}",
+            [],
+        )
+        next_plan = self._prepare_cached(
+            "select * from ({q}) as _source where ({k}) {op} ({p}) order by {o} limit {n}".format(
+                q=query,
+                k=keys,
+                op="<" if descending else ">",
+                p=", ".join(f"${i}" for i in range(1, len(key_columns) + 1)),
+                o=order_by,
+                n=int(page_size),
+            ),
+            [column_types[c] for c in key_columns],
+        )
+        # the row limit keeps the pages materialized when a memory budget would stream them
+        page = (
+            self.execute_plan(first_plan, [], page_size)
+            if start_after is None
+            else self.execute_plan(next_plan, list(start_after), page_size)
+        )
+        while len(page):
+            # checked per page, scanning the whole query for NULL keys up front would cost as much as paginating it
+            if any(row[c] is None for row in page.result_set for c in key_columns):
+                raise PLPythonWrapperException(
+                    f"Cannot paginate by {key_columns} since some rows have NULL keys, which can't be paginated past"
+                )
+            yield page
+            if len(page) < page_size:
+                return
+            last_row = page.result_set[len(page) - 1]
+            page = self.execute_plan(
+                next_plan, [last_row[c] for c in key_columns], page_size
+            )
+
+    def defer_insert(self, schema: str, table_name: str, row: Dict[str, Any]) -> None:
+        """queues a row to be inserted at the end of the current statement instead of inserting it right away.
+        Meant for ``after_*`` trigger handlers that write audit or derived rows: instead of one ``INSERT`` per changed row,
+        the rows queued while a statement runs are written with one ``INSERT ... SELECT unnest(...)`` per target table by the
+        statement level triggers that :func:`plpy_wrapper.utilities.create_plpython_triggers` installs with
+        ``statement_triggers=True``.
+
+        >>> class Contact(Trigger):
+        >>>     def after_update(self):
+        >>>         self.plpy_wrapper.defer_insert('audit','contact_change',{'contact_id':self.trigger_context.new.id})
+
+        The queue is opened by the ``BEFORE`` statement level trigger (see :meth:`.open_deferred`), so queuing from a row level
+        trigger doesn't run a query of its own. It is kept in ``GD`` for the current transaction only, so nothing queued
+        survives a rollback. Rows queued by a statement that was aborted along with its subtransaction are discarded when the
+        subtransaction was started with :meth:`.subtransaction`, otherwise when the next statement on the table starts or the
+        statement it was nested in ends.
+
+        .. note::
+
+         Row level triggers find their queue without knowing their trigger depth. After a nested statement on the same table
+         was aborted in a subtransaction that wasn't started with :meth:`.subtransaction` (``plpy.subtransaction()`` or a
+         plpgsql ``EXCEPTION`` block), the rest of the outer statement queues into the aborted statement's queue, which is
+         discarded when the outer statement ends. Wrap such nested statements in :meth:`.subtransaction` instead
+
+        :param schema: the schema of the table the row is inserted into
+        :param table_name: the table the row is inserted into
+        :param row: column name to value. The column types are read from the catalog
+        """
+        inserts = self._deferred_queue().setdefault("inserts", {})
+        inserts.setdefault((schema, table_name), []).append(row)
+
+    def flush_deferred(self) -> int:
+        """writes everything queued for the current statement (see :meth:`.defer_insert`, :meth:`.defer_update`,
+        :meth:`.defer_increment` and :meth:`.notify`).
+        This is called by the ``AFTER`` statement level trigger, call it yourself only when queuing outside of a trigger
+
+        :return: the number of rows written
+        """
+        slots = self._deferred_slots()
+        if self.trigger_data and slots:
+            # statements on the table that were aborted in a subtransaction that wasn't started with subtransaction() (e.g. in
+            # a plpgsql EXCEPTION block) left their queues on top of this statement's, one query per statement finds them
+            depth = self._transaction_info().trigger_depth
+            while slots and slots[-1][0] > depth:
+                slots.pop()
+            if slots and slots[-1][0] < depth:
+                # this statement's queue was never opened, the one below belongs to an outer statement
+                return 0
+        queue = slots.pop()[1] if slots else None
+        if not queue:
+            return 0
+        written = 0
+        for (schema, table_name), rows in queue.get("inserts", {}).items():
+            written += self._insert_rows(schema, table_name, rows)
+        for target, rows in queue.get("updates", {}).items():
+            written += self._apply_updates(*target, rows)
+        for target, rows in queue.get("increments", {}).items():
+            written += self._apply_increments(*target, rows)
+        if queue.get("notifications"):
+            self._send_notifications(queue["notifications"])
+        return written
+
+    def defer_update(
+        self,
+        schema: str,
+        table_name: str,
+        key: Dict[str, Any],
+        values: Dict[str, Any],
+    ) -> None:
+        """queues setting columns of the row identified by ``key`` at the end of the current statement. The updates queued for
+        a row are merged while the statement runs, a column set more than once keeps its last value, so a row touched by
+        several handlers (e.g. a parent's ``updated_at`` and ``last_contact_id``) gets one new tuple version instead of one
+        per ``UPDATE``, and the rows of a table are written with one ``UPDATE ... FROM unnest(...)``.
+
+        >>> class Contact(Trigger):
+        >>>     def after_insert(self):
+        >>>         new = self.trigger_context.new
+        >>>         self.plpy_wrapper.defer_update('customer','company',{'id':new.company_id},{'last_contact_id':new.id})
+
+        Queued like :meth:`.defer_insert`, so outside of a trigger call :meth:`.flush_deferred` yourself.
+        Until then queries still see the old values. Use :meth:`.defer_increment` for counters, which adds up the changes
+        instead of keeping the last one.
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to update
+        :param key: column name to value of the columns identifying the row, usually the primary key
+        :param values: column name to the new value, can't contain the columns of ``key``
+        """
+        both = [c for c in values if c in key]
+        if both:
+            raise PLPythonWrapperException(
+                f"The key columns {both} can't be updated, they identify the row to update"
+            )
+        targets = self._deferred_queue().setdefault("updates", {})
+        rows = targets.setdefault((schema, table_name, tuple(key)), {})
+        row_key = tuple(_hashable(v) for v in key.values())
+        if row_key in rows:
+            rows[row_key][1].update(values)
+        else:
+            rows[row_key] = (list(key.values()), dict(values))
+
+    def _apply_updates(
+        self,
+        schema: str,
+        table_name: str,
+        key_columns: Tuple[str, ...],
+        rows: Dict[tuple, Tuple[list, Dict[str, Any]]],
+    ) -> int:
+        """writes the merged updates queued by :meth:`.defer_update` for a single table, one statement per set of updated
+        columns, in the order of their keys"""
+        groups: Dict[Tuple[str, ...], List[Tuple[list, Dict[str, Any]]]] = {}
+        for _, (key_values, values) in sorted(
+            rows.items(), key=lambda item: _lock_order(item[0])
+        ):
+            groups.setdefault(tuple(sorted(values)), []).append((key_values, values))
+        table_types = self._table_column_types(schema, table_name)
+        written = 0
+        for value_columns, group in groups.items():
+            columns = {c: [] for c in list(key_columns) + list(value_columns)}
+            for key_values, values in group:
+                for c, value in zip(key_columns, key_values):
+                    columns[c].append(value)
+                for c in value_columns:
+                    columns[c].append(values[c])
+            written += self.update_arrays(
+                schema,
+                table_name,
+                list(key_columns),
+                columns,
+                {c: table_types[c] for c in columns},
+            )
+        return written
+
+    def defer_increment(
+        self,
+        schema: str,
+        table_name: str,
+        key: Dict[str, Any],
+        increments: Dict[str, Any],
+        delete_when_zero: Union[str, None] = None,
+    ) -> None:
+        """queues adding ``increments`` to the columns of the row identified by ``key`` at the end of the current statement,
+        inserting the row if it doesn't exist yet. The increments of a row are summed up while the statement runs, so each
+        row is written once per statement (with one ``INSERT ... ON CONFLICT DO UPDATE`` for all of them) no matter how many
+        changes contributed to it, and rows whose increments cancel out aren't written at all.
+
+        >>> wrapper.defer_increment('customer','company_stats',{'company_id':7},{'contact_count':1})
+
+        Queued like :meth:`.defer_insert`, so outside of a trigger call :meth:`.flush_deferred` yourself.
+
+        :param schema: the schema the table is located in
+        :param table_name: the table to increment, ``key``'s columns must be its primary key or a unique constraint
+        :param key: column name to value of the columns identifying the row
+        :param increments: column name to the amount to add to it, the amounts must support ``+``
+        :param delete_when_zero: a column of ``increments``, rows where it's 0 after the increments are deleted (e.g. a row count)
+        """
+        targets = self._deferred_queue().setdefault("increments", {})
+        rows = targets.setdefault(
+            (schema, table_name, tuple(key), tuple(increments), delete_when_zero), {}
+        )
+        row_key = tuple(_hashable(v) for v in key.values())
+        if row_key in rows:
+            totals = rows[row_key][1]
+            for i, amount in enumerate(increments.values()):
+                totals[i] += amount
+        else:
+            rows[row_key] = (list(key.values()), list(increments.values()))
+
+    def _apply_increments(
+        self,
+        schema: str,
+        table_name: str,
+        key_columns: Tuple[str, ...],
+        increment_columns: Tuple[str, ...],
+        delete_when_zero: Union[str, None],
+        rows: Dict[tuple, Tuple[list, list]],
+    ) -> int:
+        """writes the summed up increments queued by :meth:`.defer_increment` for a single table, in the order of their keys"""
+        column_names = list(key_columns) + list(increment_columns)
+        columns = {c: [] for c in column_names}
+        for _, (key_values, totals) in sorted(
+            rows.items(), key=lambda item: _lock_order(item[0])
+        ):
+            if not any(totals):
+                continue
+            for c, value in zip(column_names, key_values + totals):
+                columns[c].append(value)
+        if not columns[column_names[0]]:
+            return 0
+        qualified_table_name = utilities.make_qualified_schema_name(schema, table_name)
+        table_types = self._table_column_types(schema, table_name)
+        column_types = {c: table_types[c] for c in column_names}
+        plan = self._prepare_cached(
+            bulk.build_increment_sql(
+                qualified_table_name, key_columns, increment_columns
+            ),
+            bulk.parameter_types(column_types, column_names),
+        )
+        written = self._execute_array_chunks(
+            plan, columns, column_types, bulk.DEFAULT_MEMORY_BUDGET
+        )
+        if delete_when_zero:
+            plan = self._prepare_cached(
+                bulk.build_delete_sql(
+                    qualified_table_name,
+                    list(key_columns),
+                    "_target.{c} = 0".format(
+                        c=utilities.quote_identifier(delete_when_zero)
+                    ),
+                ),
+                bulk.parameter_types(column_types, key_columns),
+            )
+            self._execute_array_chunks(
+                plan,
+                {c: columns[c] for c in key_columns},
+                column_types,
+                bulk.DEFAULT_MEMORY_BUDGET,
+            )
+        return written
+
+    def notify(self, channel: str, payload: Any) -> None:
+        """queues a notification that is sent at the end of the current statement together with the other notifications of
+        the statement. Instead of one ``pg_notify`` per row, the events of a channel are deduplicated and packed into as few
+        JSON array payloads as fit below the payload limit of postgres, so listeners wake up once per batch.
+        Like with ``NOTIFY``, listeners only receive the notifications once the transaction commits.
+
+        >>> class Contact(Trigger):
+        >>>     def after_update(self):
+        >>>         self.plpy_wrapper.notify('contact_changed',{'id':self.trigger_context.new.id})
+
+        Listeners receive payloads like ``[{"id":1},{"id":2}]``. Just like :meth:`.defer_insert`, the notifications are sent by
+        the statement level trigger, call :meth:`.flush_deferred` yourself when notifying outside of a trigger.
+
+        :param channel: the channel to notify
+        :param payload: anything ``json.dumps`` can serialize (values it can't are turned into strings)
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if the payload alone is too large for a notification
+        """
+        event = json.dumps(payload, separators=(",", ":"), sort_keys=True, default=str)
+        if len(event.encode()) + 2 > PLPYWrapper.NOTIFY_PAYLOAD_LIMIT:
+            raise PLPythonWrapperException(
+                f"The payload of a notification on channel {channel} is larger than {PLPYWrapper.NOTIFY_PAYLOAD_LIMIT} bytes"
+            )
+        notifications = self._deferred_queue().setdefault("notifications", {})
+        # a dict as an ordered set, so duplicates are dropped but the order of the events is kept
+        notifications.setdefault(channel, {})[event] = None
+
+    def _send_notifications(self, notifications: Dict[str, Dict[str, None]]) -> None:
+        """sends the queued events of every channel as batches with a single statement"""
+        channels, payloads = [], []
+        for channel, events in notifications.items():
+            for batch in _pack_events(events, PLPYWrapper.NOTIFY_PAYLOAD_LIMIT):
+                channels.append(channel)
+                payloads.append(batch)
+        self.execute_plan(
+            self._prepare_cached(
+                "select pg_notify(channel, payload) from unnest($1, $2) as n(channel, payload)",
+                ["text[]", "text[]"],
+            ),
+            [channels, payloads],
+        )
+
+    def open_deferred(self) -> None:
+        """starts the queue of deferred work of the statement the current trigger fired for.
+        This is called by the ``BEFORE`` statement level trigger. It's the only place that queries the transaction and the
+        trigger depth, so the row level triggers of the statement find their queue in ``GD`` without a query of their own.
+        Queues left behind by statements on the table that were aborted at the same or a deeper trigger depth are dropped
+        """
+        info = self._transaction_info()
+        slots = (
+            self._transaction_state(info)
+            .setdefault("deferred", {})
+            .setdefault(int(self.trigger_data["relid"]), [])
+        )
+        while slots and slots[-1][0] >= info.trigger_depth:
+            slots.pop()
+        slots.append((info.trigger_depth, {}))
+
+    def discard_deferred(self) -> None:
+        """drops everything queued for the current statement without writing it"""
+        slots = self._deferred_slots()
+        if slots:
+            slots.pop()
+
+    def _deferred_slots(self) -> Union[List[Tuple[int, dict]], None]:
+        """the ``(trigger depth, queue)`` of every open statement on the table the current trigger fired on, innermost last.
+        Outside of triggers there is a single queue per transaction
+        """
+        if not self.trigger_data:
+            return self._transaction_state().setdefault("deferred", {}).get(None)
+        # no query here, open_deferred already dropped the state of earlier transactions
+        return (
+            self.global_data.get(PLPYWrapper._GD_KEY, {})
+            .get("transaction", {})
+            .get("deferred", {})
+            .get(int(self.trigger_data["relid"]))
+        )
+
+    def _deferred_queue(self) -> dict:
+        """the deferred work of the current statement"""
+        if not self.trigger_data:
+            slots = self._transaction_state().setdefault("deferred", {})
+            return slots.setdefault(None, [(0, {})])[-1][1]
+        slots = self._deferred_slots()
+        if not slots:
+            raise PLPythonWrapperException(
+                "Work can only be deferred from triggers on tables with statement level triggers, "
+                "create them with create_plpython_triggers(..., statement_triggers=True)"
+            )
+        return slots[-1][1]
+
+    def _insert_rows(
+        self, schema: str, table_name: str, rows: List[Dict[str, Any]]
+    ) -> int:
+        """inserts rows given as dictionaries with one array insert per distinct set of columns"""
+        table_types = self._table_column_types(schema, table_name)
+        by_columns = {}
+        for row in rows:
+            by_columns.setdefault(tuple(row), []).append(row)
+        return sum(
+            self.insert_arrays(
+                schema,
+                table_name,
+                {c: [row[c] for row in group] for c in columns},
+                {c: table_types[c] for c in columns if c in table_types},
+            )
+            for columns, group in by_columns.items()
+        )
+
+    def _query_column_types(self, query: str) -> Dict[str, str]:
+        """the postgres type (without modifiers) of each column of a query's result.
+        Cached in ``GD`` for the rest of the session, at most :attr:`.SESSION_CACHE_SIZE` queries are kept
+        """
+
+        def fetch() -> Dict[str, str]:
+            result = self.plpy.execute(f"select * from ({query}) as _source limit 0")
+            type_names = self.execute_plan(
+                self._prepare_cached(
+                    "select format_type(type_oid, null) as type_name from unnest($1) with ordinality as t(type_oid, n) order by n",
+                    ["oid[]"],
+                ),
+                [result.coltypes()],
+            )
+            return {
+                name: row.type_name for name, row in zip(result.colnames(), type_names)
+            }
+
+        return self._session_cached("query_column_types", query, fetch)
+
+    def _transaction_info(self) -> Row:
+        """details about the current transaction (``started_at`` and the current ``trigger_depth``).
+        Queried on every call, a wrapper kept in ``GD`` or ``SD`` outlives the transaction it was created in
+        """
+        return self.execute_plan(
+            self._prepare_cached(
+                "select transaction_timestamp()::text as started_at, pg_trigger_depth() as trigger_depth",
+                [],
+            ),
+            [],
+        )[0]
+
+    def _statement_transaction_state(self) -> dict:
+        """same as :meth:`._transaction_state`, without a query in the triggers of a statement that :meth:`.open_deferred`
+        opened a queue for: it already brought the state up to date for the statement, so looking up a row from a row level
+        trigger costs no query on a cache hit. Other triggers and code outside of triggers query the transaction
+        """
+        if self.trigger_data and self._deferred_slots():
+            return self._wrapper_state["transaction"]
+        return self._transaction_state()
+
+    def _transaction_state(self, info: Union[Row, None] = None) -> dict:
+        """the part of ``GD`` that is only valid until the end of the current transaction.
+        GD outlives transactions, so the state is tagged with the transaction start time
+        (which, unlike the transaction id, exists for read only transactions too) and dropped as soon as another transaction
+        asks for it. This is what makes the state go away on commit and rollback alike
+
+        :param info: the result of :meth:`._transaction_info` if the caller already queried it
+        """
+        state = self._wrapper_state
+        started_at = (info or self._transaction_info()).started_at
+        if state.get("transaction_started_at") != started_at:
+            state["transaction_started_at"] = started_at
+            state["transaction"] = {}
+        return state["transaction"]
+
+    def _table_column_types(self, schema: str, table_name: str) -> Dict[str, str]:
+        """the postgres type (without modifiers) of each column of a table. Cached in ``GD`` under the table's ``OID`` and
+        the ``xmin`` of its catalog rows, which change with every ``ALTER TABLE`` and when a table is dropped and created
+        again, e.g. after a rolled back test
+        """
+        qualified_table_name = utilities.make_qualified_schema_name(schema, table_name)
+        table_types = self._wrapper_state.setdefault("column_types", {})
+        version_plan = self._prepare_cached(
+            """select c.oid::bigint as relid, c.xmin::text || ':' || string_agg(a.xmin::text, ',' order by a.attnum) as version
+            from pg_catalog.pg_class c join pg_catalog.pg_attribute a on a.attrelid = c.oid and a.attnum > 0
+            where c.oid = $1::regclass group by c.oid, c.xmin""",
+            ["text"],
+        )
+        version = self.execute_plan(version_plan, [qualified_table_name])[0]
+        cache_key = (version.relid, version.version)
+        if (
+            qualified_table_name not in table_types
+            or table_types[qualified_table_name][0] != cache_key
+        ):
+            plan = self._prepare_cached(
+                """select attname, format_type(atttypid, null) as type_name from pg_catalog.pg_attribute
+                where attrelid = $1 and attnum > 0 and not attisdropped""",
+                ["oid"],
+            )
+            table_types[qualified_table_name] = (
+                cache_key,
+                {
+                    row.attname: row.type_name
+                    for row in self.execute_plan(plan, [version.relid])
+                },
+            )
+        return table_types[qualified_table_name][1]
+
+    def _execute_array_chunks(
+        self,
+        plan: PLyPlan,
+        columns: Dict[str, list],
+        column_types: Dict[str, str],
+        memory_budget: int,
+    ) -> int:
+        """executes ``plan`` once per chunk of the columns and returns the total number of rows processed"""
+        chunk_rows = bulk.rows_per_chunk(columns, column_types, memory_budget)
+        return sum(
+            self.execute_plan(plan, chunk).n_rows
+            for chunk in bulk.iter_chunks(columns, chunk_rows)
+        )
+
+    def stream(
+        self,
+        query: str,
+        args: Union[List[Any], None] = None,
+        argtypes: Union[List[str], None] = None,
+        transform: Union[Callable[[dict], Any], None] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Any]:
+        """iterates over the rows of a query through a cursor, holding only one batch of rows in memory at a time.
+        The generator can be returned as is from a set-returning (``SETOF``/``TABLE``) function, postgres then pulls rows
+        from it one by one, so backend memory stays flat no matter how many rows the function returns.
+
+        >>> create function customer.contact_names() returns setof text as $$
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> return wrapper.stream('select first_name, last_name from customer.contact',
+        >>>                       transform=lambda row: row['first_name'] + ' ' + row['last_name'])
+        >>> $$ language plpython3u;
+
+        :param query: the SQL string
+        :param args: values for the parameters of the query (``$1``, ``$2``...), requires ``argtypes``
+        :param argtypes: the types of ``args``, the prepared plan is reused for the rest of the session
+        :param transform: called with every row as a plain ``dict`` (no :class:`.Row` is built), what it returns is yielded instead.
+            Pass :class:`.Row` to get rows like :meth:`.execute` returns them
+        :param batch_size: how many rows are fetched from the cursor at a time
+        :return: a generator of rows (``dict`` s) or whatever ``transform`` returns
+        """
+        if args:
+            cursor = self.plpy.cursor(self._prepare_cached(query, argtypes or []), args)
+        else:
+            cursor = self.plpy.cursor(query)
+        try:
+            while True:
+                batch = cursor.fetch(batch_size)
+                if transform is None:
+                    yield from batch
+                else:
+                    for row in batch:
+                        yield transform(row)
+                # a short batch means the cursor is exhausted, which saves fetching an empty batch
+                if len(batch) < batch_size:
+                    return
+        finally:
+            cursor.close()
+
+    def parallel_map(
+        self,
+        fn: Callable[[Row], Any],
+        result_set: "ResultSet",
+        workers: int = parallel.DEFAULT_WORKERS,
+        chunk_size: int = parallel.DEFAULT_CHUNK_SIZE,
+        keep_pool: bool = False,
+    ) -> List[Any]:
+        """applies ``fn`` to every row of a result in a pool of worker processes, for CPU bound python that would otherwise
+        be limited to the single core of the backend. The rows are sent to the workers in chunks of columns
+        (see :class:`plpy_wrapper.parallel.ProcessPool`). The pool is stopped when the call returns, unless ``keep_pool``
+        keeps it in ``GD`` for the next calls of the session.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> from scoring import score_contact
+        >>> wrapper = PLPYWrapper(globals())
+        >>> scores = wrapper.parallel_map(score_contact, wrapper.execute('select * from customer.contact'), workers=4)
+        >>> # several calls in a row share the pool, stop it yourself afterwards
+        >>> for query in queries:
+        >>>     scores.extend(wrapper.parallel_map(score_contact, wrapper.execute(query), workers=4, keep_pool=True))
+        >>> wrapper.close_process_pool()
+
+        ``fn`` runs in another process: it must be defined at the top level of an importable module (functions defined in
+        the body of a plpython function or lambdas can't be sent), it gets a copy of the row and it must not use ``plpy``.
+        Modules imported from :attr:`.MODULE_TABLE` must have been imported before the pool was forked.
+        Sending rows to a worker isn't free, so this pays off when ``fn`` does a lot of work per row.
+        Every backend that calls this forks its own workers, so keep ``workers`` well below the number of cores.
+
+        :param fn: called with every row as a :class:`.Row`, what it returns must be picklable
+        :param result_set: the rows, a :class:`.CursorResult` is consumed as the workers get through it
+        :param workers: the number of processes. A different number than a kept pool has replaces it
+        :param chunk_size: the number of rows sent to a worker at a time
+        :param keep_pool: don't stop the workers afterwards, until :meth:`.close_process_pool` or the end of the session
+        :return: what ``fn`` returned for each row, in the order of the rows
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if ``fn`` can't be sent to the workers or raised
+         an exception in one of them, which includes its traceback
+        """
+        # before forking, a function that can't be sent shouldn't cost a pool
+        task = parallel.dump_task(functools.partial(parallel.map_rows, fn, Row))
+        pool = self._process_pool(workers)
+        chunks = parallel.columnar_chunks(
+            result_set.result_set, result_set.colnames, chunk_size
+        )
+        results = []
+        try:
+            for chunk_results in pool.imap(task, chunks):
+                results.extend(chunk_results)
+        finally:
+            if not keep_pool:
+                self.close_process_pool()
+        return results
+
+    def close_process_pool(self) -> None:
+        """stops the workers kept by :meth:`.parallel_map`. They are also killed when the backend exits"""
+        pool = self._wrapper_state.pop("process_pool", None)
+        if pool is not None:
+            pool.close()
+
+    def _process_pool(self, workers: int) -> parallel.ProcessPool:
+        pool = self._wrapper_state.get("process_pool")
+        if pool is not None and (pool.workers != workers or not pool.alive):
+            self.close_process_pool()
+            pool = None
+        if pool is None:
+            pool = parallel.ProcessPool(workers)
+            self._wrapper_state["process_pool"] = pool
+        return pool
+
+    def open_lob(self, oid: int) -> blob.LargeObject:
+        """opens an existing large object for chunked reading and writing, see :class:`plpy_wrapper.blob.LargeObject`
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> for chunk in wrapper.open_lob(document.content_oid).read_chunks(chunk_size=4 * 1024 * 1024):
+        >>>     digest.update(chunk)
+
+        :param oid: the ``OID`` of the large object
+        """
+        return blob.LargeObject(self, oid)
+
+    def create_lob(self) -> blob.LargeObject:
+        """creates a new, empty large object
+
+        :return: the large object, its ``oid`` is what should be stored to refer to it
+        """
+        return self.open_lob(self.execute("select lo_create(0) as oid")[0].oid)
+
+    def read_chunks(
+        self,
+        schema: str,
+        table_name: str,
+        column: str,
+        key: Dict[str, Any],
+        chunk_size: int = blob.DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[memoryview]:
+        """reads a ``bytea`` value chunk by chunk with ``substring`` instead of loading all of it into python.
+        Postgres can only fetch a slice without reading the whole value if the column isn't compressed, so set
+        ``alter table ... alter column ... set storage external`` on columns holding large values
+
+        .. important::
+
+         the views point into a buffer that is reused for every chunk, copy a chunk (``bytes(chunk)``) to keep it
+
+        :param schema: the schema the table is located in
+        :param table_name: the table
+        :param column: the ``bytea`` column
+        :param key: column name to value identifying the row, e.g. ``{'id':7}``
+        :param chunk_size: the number of bytes per chunk
+        :return: a generator of ``memoryview`` s, nothing is yielded if the value is null
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if no row matches ``key``
+        """
+        return blob.read_column_chunks(
+            self, schema, table_name, column, key, chunk_size
+        )
+
+    def write_chunks(
+        self,
+        schema: str,
+        table_name: str,
+        column: str,
+        key: Dict[str, Any],
+        chunks: Iterable[blob.BytesLike],
+    ) -> int:
+        """writes a ``bytea`` value from chunks, replacing the current value. The chunks are staged in a temporary large object
+        and the row is updated once at the end, so neither python nor repeated appends ever hold the whole value
+
+        :param schema: the schema the table is located in
+        :param table_name: the table
+        :param column: the ``bytea`` column
+        :param key: column name to value identifying the row, e.g. ``{'id':7}``
+        :param chunks: the data to write, e.g. :meth:`.read_chunks` of another value
+        :return: the number of bytes written
+        :raises: :class:`plpy_wrapper.exceptions.PLPythonWrapperException` if no row matches ``key``
+        """
+        return blob.write_column_chunks(self, schema, table_name, column, key, chunks)
+
+    def execute_plan(self, plan: PLyPlan, args: List[Any], row_limit=None) -> ResultSet:
+        """see https://www.postgresql.org/docs/11/plpython-database.html for more information.
+        The result is checked against the :attr:`.memory_budget` if there is one"""
+        started_at = time.perf_counter()
+        budget = self.memory_budget
+        with self._within_time_budget():
+            if budget is not None:
+                result = self._execute_within_budget(
+                    budget,
+                    lambda limit: self.plpy.execute(plan, args, limit),
+                    lambda: self.plpy.cursor(plan, args),
+                    row_limit,
+                )
+            elif row_limit:
+                result = ResultSet(self.plpy.execute(plan, args, row_limit))
+            else:
+                result = ResultSet(self.plpy.execute(plan, args))
+        self._count_query(result, started_at)
+        return result
+
+    def execute(self, query: str) -> ResultSet:
+        """
+
+        :param query: the SQL string to execute
+        :return: a ResultSet
+        :raises: :class:`plpy_wrapper.exceptions.MemoryBudgetException` if the result is over the :attr:`.memory_budget`
+        :raises: :class:`plpy_wrapper.exceptions.TimeBudgetException` if the query runs past the :meth:`.time_budget`
+        """
+        started_at = time.perf_counter()
+        budget = self.memory_budget
+        with self._within_time_budget():
+            if budget is not None:
+                result = self._execute_within_budget(
+                    budget,
+                    lambda limit: self.plpy.execute(query, limit),
+                    lambda: self.plpy.cursor(query),
+                )
+            else:
+                result = ResultSet(self.plpy.execute(query))
+        self._count_query(result, started_at)
+        return result
+
+    @contextmanager
+    def time_budget(self, milliseconds: float):
+        """bounds how long the queries run through :meth:`.execute` and :meth:`.execute_plan` inside the ``with`` block may take
+        in total. Before each query ``statement_timeout`` and ``lock_timeout`` are set locally to what's left of the budget,
+        and the previous settings are restored when the block ends, also when it raises anything but a failed query.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> with wrapper.time_budget(200):
+        >>>     contacts = wrapper.execute('select * from customer.contact where company_id = 1')
+        >>>     companies = wrapper.execute('select * from customer.company')
+
+        The budget is kept in ``GD``, so it also bounds the queries of triggers and functions called from the block.
+        A nested budget can't outlast the one around it, it only ever shortens the time that's left.
+
+        .. important::
+
+         a query canceled by a timeout aborts the transaction like any other error, run the block in a
+         :meth:`.subtransaction` to recover from a :class:`plpy_wrapper.exceptions.TimeBudgetException`
+
+        :param milliseconds: the time the block may spend in queries, counted from entering it
+        :raises: :class:`plpy_wrapper.exceptions.TimeBudgetException` when a query runs past the budget or starts after it ran out
+        """
+        budgets = self._wrapper_state.setdefault("time_budgets", [])
+        deadline = time.monotonic() + milliseconds / 1000
+        if budgets:
+            deadline = min(deadline, budgets[-1])
+            previous = None
+        else:
+            previous = self.plpy.execute(
+                "select current_setting('statement_timeout') as statement_timeout, "
+                "current_setting('lock_timeout') as lock_timeout"
+            )[0]
+        budgets.append(deadline)
+        try:
+            yield
+        except BaseException as e:
+            # a failed query aborts the transaction or rolls back the subtransaction the settings were made in,
+            # which leaves nothing to restore and no way to run the query that would
+            if isinstance(e, self.plpy.SPIError) or isinstance(
+                e.__cause__, self.plpy.SPIError
+            ):
+                previous = None
+            raise
+        finally:
+            budgets.pop()
+            if previous is not None:
+                self.plpy.execute(
+                    self._prepare_cached(
+                        "select set_config('statement_timeout', $1, true), set_config('lock_timeout', $2, true)",
+                        ["text", "text"],
+                    ),
+                    [previous["statement_timeout"], previous["lock_timeout"]],
+                )
+
+    @contextmanager
+    def _within_time_budget(self):
+        """applies what's left of the innermost :meth:`.time_budget` to the query run in the ``with`` block"""
+        budgets = self.global_data.get(PLPYWrapper._GD_KEY, {}).get("time_budgets")
+        if not budgets:
+            yield
+            return
+        remaining = budgets[-1] - time.monotonic()
+        if remaining <= 0:
+            raise TimeBudgetException(
+                f"The time budget ran out {-remaining * 1000:.0f}ms ago"
+            )
+        # a timeout of 0 turns it off, so at least 1ms
+        timeout = str(max(1, int(remaining * 1000)))
+        self.plpy.execute(
+            self._prepare_cached(
+                "select set_config('statement_timeout', $1, true), set_config('lock_timeout', $1, true)",
+                ["text"],
+            ),
+            [timeout],
+        )
+        try:
+            yield
+        except self.plpy.SPIError as e:
+            if getattr(e, "sqlstate", None) in _TIMEOUT_SQLSTATES:
+                raise TimeBudgetException(
+                    f"The query ran past the time budget ({timeout}ms were left)"
+                ) from e
+            raise
+
+    @property
+    def stats_registry(self) -> StatsRegistry:
+        """the counters of this session, kept in ``GD``. Use :meth:`.stats` to read them"""
+        return self._wrapper_state.setdefault("stats", StatsRegistry())
+
+    def stats(self) -> List[dict]:
+        """metrics about plpy_wrapper in this session: the number of ``queries`` run through :meth:`.execute` and
+        :meth:`.execute_plan`, the ``rows`` they returned and the ``query_seconds`` they took, ``trigger_invocations`` and
+        ``trigger_seconds`` per table, timing, event and level (e.g. ``customer.company AFTER UPDATE ROW``), plus the
+        counters of :attr:`.query_cache`, :attr:`.single_flight_stats` and :attr:`.memory_stats` of the features that were used.
+        See :func:`plpy_wrapper.utilities.install_stats` for querying them with SQL
+
+        :return: a row per metric and label, see :data:`plpy_wrapper.stats.STATS_COLUMNS`
+        """
+        return to_rows(self._stats_values())
+
+    def reset_stats(self) -> None:
+        """sets the counters of :attr:`.stats_registry` back to 0"""
+        self.stats_registry.reset()
+
+    def enable_stats_flush(
+        self, interval: float = 60, release: Union[str, None] = None
+    ) -> None:
+        """flushes the stats to :attr:`.STATS_TABLE_NAME` (see :func:`plpy_wrapper.utilities.install_stats`) whenever a query
+        runs and ``interval`` seconds passed since the last flush, so the metrics of every backend end up in one place.
+        A flush is part of the transaction it happens in, if that rolls back the next flush writes its values again
+
+        :param interval: the minimum number of seconds between flushes
+        :param release: stored with every flushed value, e.g. the version of the code, so that releases can be compared
+        """
+        registry = self.stats_registry
+        registry.flush_interval = interval
+        registry.release = release
+
+    def flush_stats(self) -> int:
+        """writes how much every metric grew since the last flush to :attr:`.STATS_TABLE_NAME`.
+        Summing up the ``value`` column by ``metric`` and ``label`` gives the totals over all backends.
+        The rows of a flush carry its id, the growth is counted from the last flush whose rows are still there, so a flush
+        that failed or was rolled back along with its (sub)transaction is written again by the next one
+
+        :return: the number of rows written
+        """
+        registry = self.stats_registry
+        registry.last_flush = time.monotonic()
+        values = self._stats_values()
+        started_at = self._transaction_info().started_at
+        visible = set()
+        if registry.pending_flushes():
+            visible = set(
+                self.execute_plan(
+                    self._prepare_cached(
+                        "select coalesce(array_agg(distinct flush_id), '{{}}') as flush_ids from {t} where flush_id = any($1)".format(
+                            t=utilities.make_qualified_schema_name(
+                                PLPYWrapper.STATS_SCHEMA, PLPYWrapper.STATS_TABLE_NAME
+                            )
+                        ),
+                        ["text[]"],
+                    ),
+                    [registry.pending_flushes()],
+                )[0].flush_ids
+            )
+        deltas = registry.unflushed(values, registry.settle(visible, started_at))
+        if not deltas:
+            return 0
+        flush_id = uuid.uuid4().hex
+        rows = to_rows(deltas)
+        columns = {c: [row[c] for row in rows] for c in STATS_COLUMNS}
+        columns["release"] = [registry.release] * len(rows)
+        columns["flush_id"] = [flush_id] * len(rows)
+        written = self.insert_arrays(
+            PLPYWrapper.STATS_SCHEMA,
+            PLPYWrapper.STATS_TABLE_NAME,
+            columns,
+            {
+                "metric": "text",
+                "label": "text",
+                "value": "float8",
+                "release": "text",
+                "flush_id": "text",
+            },
+        )
+        registry.flushed(flush_id, started_at, values)
+        return written
+
+    def _stats_values(self) -> Dict[MetricKey, float]:
+        """the registry's counters plus those of the other features that are in use"""
+        values = self.stats_registry.values()
+        state = self._wrapper_state
+        if "query_cache" in state:
+            cache_stats = state["query_cache"].stats
+            for name in ["hits", "misses", "evictions", "expirations", "invalidations"]:
+                values[("query_cache_" + name, "")] = cache_stats[name]
+        if "single_flight" in state:
+            for name, value in state["single_flight"].items():
+                values[("single_flight_" + name, "")] = value
+        if "memory_stats" in state:
+            for name in ["traced", "peak_bytes_total", "over_budget", "streamed"]:
+                values[("memory_" + name, "")] = state["memory_stats"][name]
+        return values
+
+    def _count_query(self, result: ResultSet, started_at: float) -> None:
+        """counts a query in :attr:`.stats_registry` and flushes the stats if that's due"""
+        registry = self.stats_registry
+        registry.increment("queries")
+        registry.increment("query_seconds", time.perf_counter() - started_at)
+        if type(result.result_set) is not CursorResult:
+            registry.increment("rows", len(result))
+        if registry.flush_due():
+            registry.flushing = True
+            try:
+                with self.subtransaction():
+                    self.flush_stats()
+            except self.plpy.SPIError:
+                # e.g. a read only transaction, the values are flushed next time
+                pass
+            finally:
+                registry.flushing = False
+
+    @property
+    def memory_budget(self) -> Union[MemoryBudget, None]:
+        """limits on the size of the results of :meth:`.execute` and :meth:`.execute_plan` for the rest of the session,
+        ``None`` (the default) for no limits. Set it to guard against a careless query materializing a huge result in the backend.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> wrapper.memory_budget = PLPYWrapper.MemoryBudget(max_rows=100000, max_bytes=64 * 1024 * 1024, stream=True)
+        >>> for contact in wrapper.execute('select * from customer.contact'):
+        >>>     pass
+
+        With only ``max_rows`` set, queries run with a row limit of ``max_rows + 1``, so no more than that many rows are ever
+        materialized. With ``max_bytes`` or ``stream`` set, the rows of a query are fetched from a cursor in batches of
+        ``stream_batch_size`` and the budget is checked after every batch. A result over budget raises
+        :class:`plpy_wrapper.exceptions.MemoryBudgetException`, or with ``stream`` set, the rest of its rows are streamed from
+        the same cursor (see :class:`.CursorResult`), so the query never runs twice. A result is only streamed when
+        :meth:`.execute_plan` is called without a ``row_limit``, which is how :meth:`.paginate` keeps its pages indexable.
+        Statements that can't be run through a cursor, e.g. an ``INSERT`` without ``RETURNING``, only get the row limit.
+
+        .. warning::
+
+         a data modifying statement with ``RETURNING`` stops after ``max_rows + 1`` rows as well, so let the exception abort the (sub)transaction
+        """
+        return self.global_data.get(PLPYWrapper._GD_KEY, {}).get("memory_budget")
+
+    @memory_budget.setter
+    def memory_budget(self, budget: Union[MemoryBudget, None]) -> None:
+        self._wrapper_state["memory_budget"] = budget
+
+    @property
+    def memory_stats(self) -> Dict[str, int]:
+        """the number of calls ``traced`` with ``tracemalloc`` and their ``peak_bytes_max``, ``peak_bytes_total`` and
+        ``last_peak_bytes``, plus the number of results that were ``over_budget`` and how many of them were ``streamed``
+        """
+        return dict(self._memory_stats)
+
+    @property
+    def _memory_stats(self) -> Dict[str, int]:
+        return self._wrapper_state.setdefault(
+            "memory_stats",
+            dict.fromkeys(
+                [
+                    "traced",
+                    "peak_bytes_max",
+                    "peak_bytes_total",
+                    "last_peak_bytes",
+                    "over_budget",
+                    "streamed",
+                ],
+                0,
+            ),
+        )
+
+    def _execute_within_budget(
+        self,
+        budget: MemoryBudget,
+        run: Callable[[int], PLyResult],
+        open_cursor: Callable[[], Any],
+        row_limit: Union[int, None] = None,
+    ) -> ResultSet:
+        """runs a query within the budget and measures it if it's sampled, see :attr:`.memory_budget`"""
+        # tracemalloc may already be in use by someone else, whose measurements shouldn't be disturbed
+        traced = (
+            budget.trace_rate > 0
+            and random.random() < budget.trace_rate
+            and not tracemalloc.is_tracing()
+        )
+        if traced:
+            tracemalloc.start()
+        try:
+            if budget.max_bytes is None and not budget.stream:
+                return self._run_within_row_budget(budget, run, row_limit)
+            return self._fetch_within_budget(budget, run, open_cursor, row_limit)
+        finally:
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                stats = self._memory_stats
+                stats["traced"] += 1
+                stats["last_peak_bytes"] = peak
+                stats["peak_bytes_total"] += peak
+                stats["peak_bytes_max"] = max(stats["peak_bytes_max"], peak)
+
+    def _run_within_row_budget(
+        self,
+        budget: MemoryBudget,
+        run: Callable[[int], PLyResult],
+        row_limit: Union[int, None] = None,
+    ) -> ResultSet:
+        """runs a query with the row limit of the budget and checks its number of rows"""
+        limit = budget.max_rows + 1 if budget.max_rows is not None else 0
+        if row_limit:
+            limit = min(limit, row_limit) if limit else row_limit
+        result = run(limit)
+        if budget.max_rows is not None and len(result) > budget.max_rows:
+            self._memory_stats["over_budget"] += 1
+            raise MemoryBudgetException(
+                f"The result has more than {budget.max_rows} rows, which is over the memory budget of the session"
+            )
+        return ResultSet(result)
+
+    def _fetch_within_budget(
+        self,
+        budget: MemoryBudget,
+        run: Callable[[int], PLyResult],
+        open_cursor: Callable[[], Any],
+        row_limit: Union[int, None] = None,
+    ) -> ResultSet:
+        """fetches the rows of a query from a cursor batch by batch until it's done or over the budget, which it then either
+        streams the rest of from the same cursor or raises for"""
+        try:
+            cursor = open_cursor()
+        except self.plpy.SPIError as e:
+            if getattr(e, "sqlstate", None) != _INVALID_CURSOR_DEFINITION:
+                raise
+            # the statement doesn't return rows, the cursor was refused before it ran
+            return self._run_within_row_budget(budget, run, row_limit)
+        batches, fetched, size, over = [], 0, 0, None
+        while True:
+            wanted = budget.stream_batch_size
+            if budget.max_rows is not None:
+                wanted = min(wanted, budget.max_rows + 1 - fetched)
+            if row_limit:
+                wanted = min(wanted, row_limit - fetched)
+            batch = cursor.fetch(wanted)
+            batches.append(batch)
+            fetched += len(batch)
+            if budget.max_bytes is not None:
+                size += _estimate_result_size(batch)
+            if budget.max_rows is not None and fetched > budget.max_rows:
+                over = f"more than {budget.max_rows} rows"
+            elif budget.max_bytes is not None and size > budget.max_bytes:
+                over = f"more than {budget.max_bytes} bytes"
+            elif len(batch) == wanted and fetched != row_limit:
+                continue
+            break
+        if over is None:
+            cursor.close()
+            if len(batches) == 1:
+                return ResultSet(batches[0])
+            colnames = batches[0].colnames()
+            return ResultSet(
+                MaterializedResult(
+                    colnames,
+                    [tuple(row[c] for c in colnames) for b in batches for row in b],
+                    batches[0].coltypes(),
+                    batches[0].coltypmods(),
+                )
+            )
+        self._memory_stats["over_budget"] += 1
+        if budget.stream and not row_limit:
+            self._memory_stats["streamed"] += 1
+            return ResultSet(CursorResult(cursor, budget.stream_batch_size, batches))
+        cursor.close()
+        raise MemoryBudgetException(
+            f"The result has {over}, which is over the memory budget of the session"
+        )
+
+    def execute_with_transaction(self, query: str) -> ResultSet:
+        """see https://www.postgresql.org/docs/11/plpython-transactions.html
+        executes a the given query in a transaction and commits. If an exception is encountered, the transaction is rolled back
+        :param query: the SQL to run
+        :return: the ResultSets
+        :raises ```plpy.SPIError``
+        """
+        try:
+            result_set = self.execute(query)
+            self.commit()
+            return result_set
+        except self.plpy.SPIError as e:
+            self.rollback()
+            raise e
+
+    def __repr__(self):
+        return "PLPYWrapper=" + str(self.__dict__)
+
+    @contextmanager
+    def subtransaction(self) -> None:
+        """
+        ghost wrapper around plpy subtransaction.
+        Example usage:
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> with wrapper.subtransaction():
+        >>>  pass
+        >>>  #do subtransaction stuff here
+
+        Rows cached by :meth:`.lookup` are dropped when the subtransaction is rolled back, since they may have been read
+        after writes that were rolled back with it. So is the work deferred by the statements started in it
+        (see :meth:`.defer_insert`), whose ``AFTER`` statement level triggers never ran
+        """
+        deferred = self._wrapper_state.get("transaction", {}).get("deferred", {})
+        open_statements = {relid: len(slots) for relid, slots in deferred.items()}
+        try:
+            with self.plpy.subtransaction() as subtransaction:
+                yield subtransaction
+        except BaseException:
+            transaction = self._wrapper_state.get("transaction", {})
+            transaction.pop("lookups", None)
+            # a state created within the subtransaction only holds statements started in it
+            if transaction.get("deferred") is not deferred:
+                open_statements = {}
+            for relid, slots in transaction.get("deferred", {}).items():
+                del slots[open_statements.get(relid, 0) :]
+            raise
+
+    def apply_in_batches(
+        self, items: Iterable[Any], fn: Callable[[Any], Any], batch_size: int = 100
+    ) -> BatchResult:
+        """applies ``fn`` to every item with one subtransaction per batch instead of one per item, which saves savepoints and
+        subtransaction ids. When a batch fails it is rolled back and split in half, and each half is retried on its own
+        until every failing item is isolated. A failing item costs ``O(log(batch_size))`` subtransactions instead of the
+        whole batch being lost.
+
+        >>> from plpy_wrapper import PLPYWrapper
+        >>> wrapper = PLPYWrapper(globals())
+        >>> plan = wrapper.prepare('insert into customer.contact (first_name,last_name) values ($1,$2)',['text','text'])
+        >>> result = wrapper.apply_in_batches(names,lambda name: wrapper.execute_plan(plan,name),batch_size=500)
+        >>> for name, error in result.failed:
+        >>>     wrapper.publish_message(PLPYWrapper.MessagePriority.warning,f'skipped {name}: {error}')
+
+        .. note::
+
+         ``fn`` runs again for the items of a batch that is retried, so it shouldn't have side effects outside of the database
+
+        :param items: the items to apply ``fn`` to
+        :param fn: called once per item, an exception marks the item as failed
+        :param batch_size: how many items share a subtransaction
+        :return: see :class:`.PLPYWrapper.BatchResult`
+        """
+        if batch_size < 1:
+            raise PLPythonWrapperException("batch_size must be at least 1")
+        items = list(items)
+        result = PLPYWrapper.BatchResult()
+        for start in range(0, len(items), batch_size):
+            self._apply_batch(items[start : start + batch_size], fn, result)
+        return result
+
+    def _apply_batch(
+        self, items: List[Any], fn: Callable[[Any], Any], result: BatchResult
+    ) -> None:
+        """applies a single batch, bisecting it on failure"""
+        result.subtransactions += 1
+        try:
+            with self.subtransaction():
+                outputs = [fn(item) for item in items]
+        except Exception as e:
+            if len(items) == 1:
+                result.failed.append((items[0], e))
+            else:
+                middle = len(items) // 2
+                self._apply_batch(items[:middle], fn, result)
+                self._apply_batch(items[middle:], fn, result)
+            return
+        result.succeeded.extend(zip(items, outputs))
 
     def commit(self) -> None:
         """commits the current transaction"""
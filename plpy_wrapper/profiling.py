@@ -0,0 +1,113 @@
+"""sampling profiler behind :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.enable_profiling`.
+A configurable fraction of invocations is run under ``cProfile`` and the stats are merged per name (e.g. per trigger),
+so a hot spot shows up in the report after enough invocations without paying for profiling every one of them.
+"""
+
+import cProfile
+import pstats
+import random
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Union
+
+#: the columns of a row of :meth:`.Profiler.report`
+REPORT_COLUMNS = [
+    "name",
+    "function",
+    "calls",
+    "primitive_calls",
+    "total_time",
+    "cumulative_time",
+    "sampled_invocations",
+]
+
+_SORT_KEYS = {"cumulative": 3, "total": 2, "calls": 1}
+
+
+class Profiler:
+    """samples invocations with ``cProfile`` and keeps the merged stats per name"""
+
+    def __init__(self, sample_rate: float):
+        """
+        :param sample_rate: the fraction of invocations that are profiled, between 0 and 1
+        """
+        self.sample_rate = sample_rate
+        #: the number of invocations per name, sampled or not
+        self.invocations = Counter()
+        #: the number of sampled invocations per name
+        self.sampled = Counter()
+        self._stats: Dict[str, pstats.Stats] = {}
+        # cProfile can't nest, an invocation inside a sampled one is already part of its profile
+        self._active = False
+
+    def __repr__(self):
+        return "Profiler=" + str(dict(self.sampled))
+
+    @contextmanager
+    def sample(self, name: str):
+        """profiles the body of the ``with`` statement if this invocation is sampled
+
+        :param name: what the stats are merged under
+        """
+        self.invocations[name] += 1
+        if self._active or random.random() >= self.sample_rate:
+            yield
+            return
+        profile = cProfile.Profile()
+        self._active = True
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active = False
+            self.sampled[name] += 1
+            if name in self._stats:
+                self._stats[name].add(profile)
+            else:
+                self._stats[name] = pstats.Stats(profile)
+
+    def report(
+        self, name: Union[str, None] = None, top: int = 20, sort: str = "cumulative"
+    ) -> List[dict]:
+        """the functions that took the most time
+
+        :param name: only report the stats of this name, all names if not given
+        :param top: how many functions to report per name
+        :param sort: ``cumulative`` (time including called functions), ``total`` (time excluding them) or ``calls``
+        :return: a row per function with the keys of :data:`.REPORT_COLUMNS`, hottest first
+        """
+        sort_index = _SORT_KEYS[sort]
+        rows = []
+        names = [name] if name is not None else sorted(self._stats)
+        for stats_name in names:
+            stats = self._stats.get(stats_name)
+            if stats is None:
+                continue
+            entries = sorted(
+                stats.stats.items(), key=lambda item: item[1][sort_index], reverse=True
+            )
+            for (file_name, line, function), (cc, nc, tt, ct, _) in entries[:top]:
+                rows.append(
+                    dict(
+                        zip(
+                            REPORT_COLUMNS,
+                            [
+                                stats_name,
+                                f"{function} ({file_name}:{line})",
+                                nc,
+                                cc,
+                                tt,
+                                ct,
+                                self.sampled[stats_name],
+                            ],
+                        )
+                    )
+                )
+        return rows
+
+    def reset(self) -> None:
+        """drops the collected stats"""
+        self.invocations.clear()
+        self.sampled.clear()
+        self._stats.clear()
@@ -0,0 +1,181 @@
+"""JSON encoding of query results used by :meth:`plpy_wrapper.plpy_wrappers.ResultSet.to_json` and
+:meth:`plpy_wrapper.plpy_wrappers.ResultSet.iter_json`.
+An encoder is chosen once per column from its type ``OID`` instead of inspecting every value, and rows are written
+straight to JSON text without building intermediate dicts or :class:`plpy_wrapper.plpy_wrappers.Row` objects.
+If `orjson <https://github.com/ijl/orjson>`_ is installed it's used for results whose columns it can encode on its own.
+"""
+
+import datetime
+import math
+from decimal import Decimal
+from json.encoder import encode_basestring
+from typing import Any, Callable, Iterable, Iterator, List, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#: default number of rows encoded per chunk of :func:`.iter_json`
+DEFAULT_CHUNK_ROWS = 1000
+
+# type OIDs, see pg_catalog.pg_type
+_BOOL = 16
+_INTEGERS = {20, 21, 23, 26}
+_FLOATS = {700, 701}
+_NUMERIC = 1700
+_JSON = {114, 3802}
+_BYTEA = 17
+# types plpython hands over as str that are encoded as JSON strings
+_STRINGS = {18, 19, 25, 1042, 1043, 1082, 1083, 1114, 1184, 1186, 1266, 2950}
+
+# types orjson encodes the same way as the encoders below
+_ORJSON_TYPES = {_BOOL} | _INTEGERS | _FLOATS | _STRINGS
+
+Encoder = Callable[[Any], str]
+
+
+def _encode_bool(value: bool) -> str:
+    return "true" if value else "false"
+
+
+def _encode_float(value: float) -> str:
+    # JSON has no NaN or infinity
+    return repr(value) if math.isfinite(value) else "null"
+
+
+def _encode_numeric(value: Decimal) -> str:
+    return str(value) if value.is_finite() else "null"
+
+
+def _encode_raw(value: str) -> str:
+    # json and jsonb values already are JSON text
+    return value
+
+
+def _encode_bytea(value: bytes) -> str:
+    # the same hex format postgres uses for bytea in json
+    return '"\\\\x' + value.hex() + '"'
+
+
+def encode_value(value: Any) -> str:
+    """encodes any value by looking at its python type. This is the fallback for columns of other types (e.g. arrays,
+    which plpython hands over as lists) and for values that didn't come from a query
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return encode_basestring(value)
+    if isinstance(value, bool):
+        return _encode_bool(value)
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return _encode_float(value)
+    if isinstance(value, Decimal):
+        return _encode_numeric(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return '"' + value.isoformat() + '"'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _encode_bytea(bytes(value))
+    if isinstance(value, dict):
+        return (
+            "{"
+            + ",".join(
+                encode_basestring(str(k)) + ":" + encode_value(v)
+                for k, v in value.items()
+            )
+            + "}"
+        )
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(encode_value(v) for v in value) + "]"
+    return encode_basestring(str(value))
+
+
+def encoder_for(type_oid: Union[int, None]) -> Encoder:
+    """the encoder for non null values of a column of the given type
+
+    :param type_oid: the type ``OID`` of the column, ``None`` if unknown
+    :return: a function turning a value into JSON text
+    """
+    if type_oid == _BOOL:
+        return _encode_bool
+    if type_oid in _INTEGERS:
+        return str
+    if type_oid in _FLOATS:
+        return _encode_float
+    if type_oid == _NUMERIC:
+        return _encode_numeric
+    if type_oid in _JSON:
+        return _encode_raw
+    if type_oid == _BYTEA:
+        return _encode_bytea
+    if type_oid in _STRINGS:
+        return encode_basestring
+    return encode_value
+
+
+def iter_json(
+    rows: Iterable[dict],
+    colnames: List[str],
+    coltypes: Union[List[int], None] = None,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Iterator[str]:
+    """encodes rows as a JSON array of objects, piece by piece
+
+    :param rows: the rows as dicts, e.g. a ``PLyResult``
+    :param colnames: the column names, in the order the keys of each object are written
+    :param coltypes: the column type ``OID`` s, values are inspected one by one if not given
+    :param chunk_rows: how many rows are encoded into each piece
+    :return: pieces of JSON text that form the whole array when concatenated
+    """
+    coltypes = coltypes or [None] * len(colnames)
+    if orjson is not None and all(t in _ORJSON_TYPES for t in coltypes):
+        chunks = _iter_orjson_chunks(rows, chunk_rows)
+    else:
+        chunks = _iter_chunks(rows, colnames, coltypes, chunk_rows)
+    yield "["
+    first = True
+    for chunk in chunks:
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]"
+
+
+def _iter_chunks(
+    rows: Iterable[dict],
+    colnames: List[str],
+    coltypes: List[Union[int, None]],
+    chunk_rows: int,
+) -> Iterator[str]:
+    """yields comma separated JSON objects, ``chunk_rows`` rows at a time"""
+    # the key of each column, prefixed with the separator from the previous column
+    columns = [
+        ("," if i else "{") + encode_basestring(name) + ":"
+        for i, name in enumerate(colnames)
+    ]
+    columns = list(zip(colnames, columns, [encoder_for(t) for t in coltypes]))
+    encoded = []
+    for row in rows:
+        parts = []
+        for name, prefix, encode in columns:
+            value = row[name]
+            parts.append(prefix + ("null" if value is None else encode(value)))
+        encoded.append("".join(parts) + "}" if parts else "{}")
+        if len(encoded) == chunk_rows:
+            yield ",".join(encoded)
+            encoded = []
+    if encoded:
+        yield ",".join(encoded)
+
+
+def _iter_orjson_chunks(rows: Iterable[dict], chunk_rows: int) -> Iterator[str]:
+    """same as :func:`._iter_chunks` using orjson"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield orjson.dumps(chunk)[1:-1].decode()
+            chunk = []
+    if chunk:
+        yield orjson.dumps(chunk)[1:-1].decode()
@@ -0,0 +1,233 @@
+"""a cache shared between every backend (and any other process) on the same host.
+``GD`` is private to a single backend, so with a connection pool every connection would otherwise compute and hold its own copy
+of the same lookup data.
+
+Each key is stored in its own memory mapped file. A file starts with a fixed size header (magic, format, version stamp and
+payload length) followed by the payload, which is either raw bytes or a pickle. Writers hold an exclusive ``flock`` on a
+lock file of their own key, so writes to different keys never wait on each other, and publish by atomically renaming a
+fully written file over the old one. Readers therefore never need a lock and never see a partial write, and a reader that
+still has the old file mapped keeps a consistent (if stale) view of it.
+
+Values stored with :meth:`.SharedCache.set` are unpickled when they're read, so whoever can write to the directory can run
+code in every process reading it. The directory is therefore created with mode ``0700`` and a directory that isn't
+owned by the current user or that others can write to is refused.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import stat
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+from plpy_wrapper import SharedCacheException
+
+#: the directory under the postgres data directory used by :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.shared_cache`
+#: when none is given
+DEFAULT_DIRECTORY_NAME = "plpy_wrapper_shared_cache"
+
+_MAGIC = b"PLPW"
+# magic, payload format, version stamp, payload length
+_HEADER = struct.Struct("<4sIQQ")
+_FORMAT_BYTES = 0
+_FORMAT_PICKLE = 1
+
+
+class SharedCache:
+    """cache backed by memory mapped files in ``directory``. Every process using the same directory sees the same entries"""
+
+    def __init__(self, directory: Union[str, Path]):
+        """
+        :param directory: where the cache files are kept, created with mode ``0700`` if it doesn't exist. Prefer a local
+         (or memory backed) file system, but not a world writable one like ``/tmp`` whose paths anyone can take first
+        :raises: :class:`plpy_wrapper.exceptions.SharedCacheException` if the directory isn't owned by the current user or
+         can be written by others
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        _check_directory(self.directory)
+        # path -> ((inode, mtime, size), mmap) of the files this process has mapped
+        self._maps: Dict[Path, Tuple[Tuple[int, int, int], mmap.mmap]] = {}
+        # key -> whether the lock this instance currently holds on it is exclusive
+        self._held_locks: Dict[str, bool] = {}
+
+    def __repr__(self):
+        return "SharedCache=" + str(self.directory)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        :param key: the cache key
+        :param default: returned if there is no entry for ``key``
+        :return: the value stored with :meth:`.set`, or a ``memoryview`` for values stored with :meth:`.set_bytes`
+        """
+        entry = self._read(key)
+        if entry is None:
+            return default
+        payload_format, _, payload = entry
+        if payload_format == _FORMAT_PICKLE:
+            return pickle.loads(payload)
+        return payload
+
+    def get_buffer(self, key: str) -> Union[memoryview, None]:
+        """zero copy access to the stored payload (the raw bytes of :meth:`.set_bytes` or the pickle of :meth:`.set`).
+        The view points straight into the memory mapped file and stays valid even after the entry is replaced
+
+        :param key: the cache key
+        :return: a read only ``memoryview`` of the payload or ``None`` if there is no entry for ``key``
+        """
+        entry = self._read(key)
+        return entry[2] if entry is not None else None
+
+    def version(self, key: str) -> int:
+        """the version stamp of the entry, incremented on every write. 0 if there is no entry for ``key``"""
+        entry = self._read(key)
+        return entry[1] if entry is not None else 0
+
+    def set(self, key: str, value: Any) -> int:
+        """stores a picklable value
+
+        :param key: the cache key
+        :param value: the value to store
+        :return: the new version stamp of the entry
+        """
+        return self._write(
+            key, _FORMAT_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        )
+
+    def set_bytes(self, key: str, data: Union[bytes, bytearray, memoryview]) -> int:
+        """stores raw bytes as they are, so they can be read back without any deserialization
+
+        :param key: the cache key
+        :param data: the bytes to store
+        :return: the new version stamp of the entry
+        """
+        return self._write(key, _FORMAT_BYTES, data)
+
+    def delete(self, key: str) -> None:
+        """removes the entry for ``key`` if there is one, along with its lock file unless the lock is held by the caller"""
+        held = key in self._held_locks
+        with self.lock(key):
+            path = self._path(key)
+            paths = [path] if held else [path, path.with_suffix(".lock")]
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    @contextmanager
+    def lock(self, key: str, exclusive: bool = True):
+        """holds the lock of a single key, e.g. so that only one process computes a missing entry.
+        The lock is reentrant within the same ``SharedCache`` instance, so :meth:`.set` can be called while holding it
+        exclusively
+
+        >>> cache = wrapper.shared_cache()
+        >>> with cache.lock('company_names'):
+        >>>     if cache.version('company_names') == 0:
+        >>>         cache.set('company_names',compute_company_names())
+
+        :param key: the cache key
+        :param exclusive: ``False`` takes a shared lock, which keeps others from writing but doesn't allow writing either
+        :raises: :class:`plpy_wrapper.exceptions.SharedCacheException` if an exclusive lock is requested while a shared one is held
+        """
+        if key in self._held_locks:
+            if exclusive and not self._held_locks[key]:
+                raise SharedCacheException(
+                    f"The lock of {key} is held shared, it can't be taken exclusively"
+                )
+            yield
+            return
+        lock_path = self._path(key).with_suffix(".lock")
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                # delete() unlinks the lock file, a lock on the unlinked file doesn't keep anyone out
+                if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        self._held_locks[key] = exclusive
+        try:
+            yield
+        finally:
+            del self._held_locks[key]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _path(self, key: str) -> Path:
+        # hashing so any string can be a key without worrying about the file system
+        return Path(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".cache")
+
+    def _read(self, key: str) -> Union[Tuple[int, int, memoryview], None]:
+        """maps the file of ``key`` (reusing the existing mapping if the file wasn't replaced) and parses its header"""
+        path = self._path(key)
+        try:
+            identity = _identity(os.stat(path))
+        except FileNotFoundError:
+            self._maps.pop(path, None)
+            return None
+        mapped = self._maps.get(path)
+        if mapped is None or mapped[0] != identity:
+            try:
+                with open(path, "rb") as f:
+                    # the file may have been replaced since the stat, so identify it by the open file
+                    mapped = (
+                        _identity(os.fstat(f.fileno())),
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                    )
+            except FileNotFoundError:
+                return None
+            # not closing the old map since views handed out by get_buffer may still point into it
+            self._maps[path] = mapped
+        buffer = memoryview(mapped[1])
+        magic, payload_format, version, length = _HEADER.unpack_from(buffer)
+        if magic != _MAGIC:
+            return None
+        return payload_format, version, buffer[_HEADER.size : _HEADER.size + length]
+
+    def _write(
+        self,
+        key: str,
+        payload_format: int,
+        payload: Union[bytes, bytearray, memoryview],
+    ) -> int:
+        path = self._path(key)
+        with self.lock(key):
+            version = self.version(key) + 1
+            temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(
+                os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb"
+            ) as f:
+                f.write(
+                    _HEADER.pack(
+                        _MAGIC, payload_format, version, memoryview(payload).nbytes
+                    )
+                )
+                f.write(payload)
+            os.replace(temp_path, path)
+        return version
+
+
+def _identity(stat_result: os.stat_result) -> Tuple[int, int, int]:
+    """what tells two versions of a cache file apart, a replaced file always has a new inode"""
+    return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def _check_directory(directory: Path) -> None:
+    """refuses directories that another user could have planted files in"""
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode):
+        raise SharedCacheException(f"{directory} is not a directory")
+    if directory_stat.st_uid != os.getuid():
+        raise SharedCacheException(
+            f"{directory} is owned by uid {directory_stat.st_uid} instead of the current user"
+        )
+    if directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise SharedCacheException(
+            f"{directory} can be written by other users (mode {stat.S_IMODE(directory_stat.st_mode):o})"
+        )
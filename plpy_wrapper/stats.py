@@ -0,0 +1,116 @@
+"""session wide metrics about plpy_wrapper itself, see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.stats`.
+Every metric is a counter identified by its name and a label (e.g. the table of a trigger), so the values of several
+sessions can simply be added up.
+"""
+
+import time
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple, Union
+
+#: the keys of a row of :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.stats`
+STATS_COLUMNS = ["metric", "label", "value"]
+
+#: a metric name and its label
+MetricKey = Tuple[str, str]
+
+
+class StatsRegistry:
+    """the counters of a session, kept in ``GD`` by :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`"""
+
+    def __init__(self):
+        self._counters: Dict[MetricKey, float] = defaultdict(float)
+        # the values as of the last flush that is known to be committed, a flush writes what was added since
+        self._flushed: Dict[MetricKey, float] = {}
+        # (flush id, start of its transaction, values) of the flushes whose transaction may still roll back
+        self._pending: List[Tuple[str, str, Dict[MetricKey, float]]] = []
+        #: seconds between automatic flushes, ``None`` if they're off
+        self.flush_interval: Union[float, None] = None
+        #: written along with the flushed values so that releases can be compared
+        self.release: Union[str, None] = None
+        self.last_flush = time.monotonic()
+        #: set while a flush runs, since the flush runs queries itself
+        self.flushing = False
+
+    def __repr__(self):
+        return "StatsRegistry=" + str(dict(self._counters))
+
+    def increment(self, metric: str, amount: float = 1, label: str = "") -> None:
+        """adds ``amount`` to a counter
+
+        :param metric: the name of the metric, e.g. ``queries``
+        :param amount: what to add
+        :param label: what the value is about, e.g. a table name
+        """
+        self._counters[(metric, label)] += amount
+
+    def values(self) -> Dict[MetricKey, float]:
+        """the current value of every counter"""
+        return dict(self._counters)
+
+    def pending_flushes(self) -> List[str]:
+        """the ids of the flushes that aren't known to be committed yet"""
+        return [flush_id for flush_id, _, _ in self._pending]
+
+    def settle(self, visible: Set[str], started_at: str) -> Dict[MetricKey, float]:
+        """sorts out the pending flushes and returns the values the next flush is relative to.
+        A flush of an earlier transaction whose rows are visible was committed, one whose rows aren't was rolled back.
+        The flushes of the current transaction may still roll back, so they stay pending
+
+        :param visible: the ids of the pending flushes whose rows are visible
+        :param started_at: the start of the current transaction
+        """
+        since = self._flushed
+        pending = []
+        for flush_id, flushed_in, values in self._pending:
+            if flush_id not in visible:
+                continue
+            since = values
+            if flushed_in == started_at:
+                pending.append((flush_id, flushed_in, values))
+            else:
+                self._flushed = values
+        self._pending = pending
+        return since
+
+    def unflushed(
+        self, values: Dict[MetricKey, float], since: Dict[MetricKey, float]
+    ) -> Dict[MetricKey, float]:
+        """how much each of ``values`` grew since ``since``, see :meth:`.settle`"""
+        return {
+            key: value - since.get(key, 0)
+            for key, value in values.items()
+            if value != since.get(key, 0)
+        }
+
+    def flushed(self, flush_id: str, started_at: str, values: Dict[MetricKey, float]):
+        """records a flush once its rows were written, it's pending until a later transaction sees them
+
+        :param flush_id: the id the rows were written with
+        :param started_at: the start of the transaction they were written in
+        :param values: the values the flush brought the table up to
+        """
+        self._pending.append((flush_id, started_at, dict(values)))
+
+    def flush_due(self) -> bool:
+        """whether an automatic flush is enabled, isn't running already and its interval has passed"""
+        return (
+            self.flush_interval is not None
+            and not self.flushing
+            and time.monotonic() - self.last_flush >= self.flush_interval
+        )
+
+    def reset(self) -> None:
+        """sets every counter of the registry back to 0"""
+        for key in self._counters:
+            self._flushed.pop(key, None)
+            for _, _, values in self._pending:
+                values.pop(key, None)
+        self._counters.clear()
+
+
+def to_rows(values: Dict[MetricKey, float]) -> List[dict]:
+    """turns counters into rows with the keys of :data:`.STATS_COLUMNS`, sorted by metric and label"""
+    return [
+        dict(zip(STATS_COLUMNS, [metric, label, value]))
+        for (metric, label), value in sorted(values.items())
+    ]
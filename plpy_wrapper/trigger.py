@@ -1,6 +1,8 @@
-from typing import Union, List
+import re
+import time
+from typing import Dict, Tuple, Union, List
 from enum import Enum
-from plpy_wrapper import utilities, PLPYWrapper, TriggerException, Row
+from plpy_wrapper import utilities, PLPYWrapper, TriggerException, Row, ResultSetDiff
 
 
 class TriggerContext:
@@ -137,8 +139,54 @@ class Trigger:
         return "Trigger=" + str(self.__dict__)
 
     def execute(self):
-        """ executes the method corresponding to the trigger event and the trigger "when".
-        For example, if when is "BEFORE" and the event is "INSERT", before_insert would run"""
+        """executes the method corresponding to the trigger event and the trigger "when".
+        For example, if when is "BEFORE" and the event is "INSERT", before_insert would run.
+        Statement level triggers (see the ``statement_triggers`` parameter of :func:`plpy_wrapper.utilities.create_plpython_triggers`)
+        run before_statement or after_statement and manage the queue of deferred work
+        (see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.defer_insert`), which is flushed after after_statement.
+        If profiling is enabled (see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.enable_profiling`) the invocation may be profiled.
+        Invocations and their duration are counted in :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.stats`
+        """
+        started_at = time.perf_counter()
+        profiler = self.plpy_wrapper.profiler
+        if profiler is None:
+            self._dispatch()
+        else:
+            with profiler.sample(
+                "{c} on {s}.{t}".format(
+                    c=self.__class__.__name__,
+                    s=self.trigger_context.table_schema,
+                    t=self.trigger_context.table_name,
+                )
+            ):
+                self._dispatch()
+        label = "{s}.{t} {w} {e} {l}".format(
+            s=self.trigger_context.table_schema,
+            t=self.trigger_context.table_name,
+            w=self.trigger_context.when,
+            e=self.trigger_context.event,
+            l=self.trigger_context.level,
+        )
+        registry = self.plpy_wrapper.stats_registry
+        registry.increment("trigger_invocations", label=label)
+        registry.increment(
+            "trigger_seconds", time.perf_counter() - started_at, label=label
+        )
+
+    def _dispatch(self):
+        """runs the method matching the trigger event, see :meth:`.execute`"""
+        if self.trigger_context.level == "STATEMENT":
+            if self.trigger_context.when == "BEFORE":
+                self.plpy_wrapper.open_deferred()
+                self.before_statement()
+                if self.trigger_context.event == "TRUNCATE":
+                    self.before_truncate()
+            elif self.trigger_context.when == "AFTER":
+                if self.trigger_context.event == "TRUNCATE":
+                    self.after_truncate()
+                self.after_statement()
+                self.plpy_wrapper.flush_deferred()
+            return
         if (
             self.trigger_context.when == "BEFORE"
             and self.trigger_context.event == "INSERT"
@@ -195,6 +243,22 @@ class Trigger:
         '''run when the context is "after" and "delete"'''
         pass
 
+    def before_truncate(self):
+        """run when the table is truncated, before the rows are removed. ``TRUNCATE`` only fires statement level triggers"""
+        pass
+
+    def after_truncate(self):
+        """run when the table was truncated"""
+        pass
+
+    def before_statement(self):
+        """run once per statement before any row is changed, regardless of the event"""
+        pass
+
+    def after_statement(self):
+        """run once per statement after every row was changed, regardless of the event. Deferred work is written right after"""
+        pass
+
     def overwrite_td_new(self):
         """must be called to persist any changes to the trigger row
 
@@ -244,3 +308,158 @@ class Trigger:
                 raise formatted_exception
         else:
             raise formatted_exception
+
+
+class AggregateTrigger(Trigger):
+    """keeps a summary table up to date incrementally from the changes to the table the trigger is on, so reading an
+    aggregate doesn't have to scan the source table. It's declared by subclassing and setting the class attributes:
+
+    >>> from plpy_wrapper import PLPYWrapper, AggregateTrigger
+    >>> class CompanyContactStats(AggregateTrigger):
+    >>>     aggregate_schema = 'customer'
+    >>>     aggregate_table = 'company_contact_stats'
+    >>>     group_by = ('company_id',)
+    >>>     aggregates = {'contact_count':'count(*)','total_ownership':'sum(ownership_percentage)'}
+
+    The summary table needs a column per group by column, together making up its primary key (or a unique constraint),
+    and a not null column per aggregate. Each changed row adds (``after_insert``), subtracts (``after_delete``) or moves
+    (``after_update``) its contribution, and the deltas are summed up per group and written once per statement, see
+    :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.defer_increment`. Groups whose ``count(*)`` drops to 0 are deleted.
+    The writes are done by the statement level triggers, so create the triggers with
+    ``create_plpython_triggers(..., statement_triggers=True)``.
+
+    Only ``count(*)``, ``count(column)`` and ``sum(column)`` can be maintained from deltas alone (an average is
+    a sum divided by a count), and a ``count(*)`` is required so emptied groups can be told apart. Rows with a null
+    group by value aren't counted. Truncating the source table empties the summary table.
+    Override the ``after_*`` methods only if you call ``super()`` in them.
+    """
+
+    #: the schema of the summary table
+    aggregate_schema: str = None
+    #: the name of the summary table
+    aggregate_table: str = None
+    #: the columns of the source table to group by, the summary table has columns of the same names
+    group_by: Tuple[str, ...] = ()
+    #: column of the summary table to its aggregate expression, e.g. ``{'contact_count':'count(*)'}``
+    aggregates: Dict[str, str] = {}
+
+    _EXPRESSION = re.compile(r"^\s*(count|sum)\s*\(\s*(\*|\w+)\s*\)\s*$", re.IGNORECASE)
+
+    def after_insert(self):
+        """adds the new row to its group"""
+        self._add_deltas(self.trigger_context.new, 1)
+
+    def after_update(self):
+        """moves the row from its old group to its new group, which is a no-op if neither changed"""
+        self._add_deltas(self.trigger_context.old, -1)
+        self._add_deltas(self.trigger_context.new, 1)
+
+    def after_delete(self):
+        """removes the old row from its group"""
+        self._add_deltas(self.trigger_context.old, -1)
+
+    def after_truncate(self):
+        """empties the summary table, ``TRUNCATE`` doesn't fire the row level triggers that would remove the rows one by one"""
+        self.plpy_wrapper.execute(
+            "delete from {t}".format(
+                t=utilities.make_qualified_schema_name(
+                    self.aggregate_schema, self.aggregate_table
+                )
+            )
+        )
+
+    def _add_deltas(self, row: Row, sign: int):
+        group = {c: getattr(row, c) for c in self.group_by}
+        if any(value is None for value in group.values()):
+            return
+        increments = {}
+        for column, (function, argument) in self._parsed_aggregates().items():
+            value = 1 if argument == "*" else getattr(row, argument)
+            if function == "count":
+                value = 0 if value is None else 1
+            elif value is None:
+                value = 0
+            increments[column] = sign * value
+        self.plpy_wrapper.defer_increment(
+            self.aggregate_schema,
+            self.aggregate_table,
+            group,
+            increments,
+            delete_when_zero=self._count_column(),
+        )
+
+    @classmethod
+    def _parsed_aggregates(cls) -> Dict[str, Tuple[str, str]]:
+        """summary column to ``(function, argument)``"""
+        parsed = {}
+        for column, expression in cls.aggregates.items():
+            match = cls._EXPRESSION.match(expression)
+            if not match or (match.group(1).lower() == "sum" and match.group(2) == "*"):
+                raise TriggerException(
+                    f"Unsupported aggregate {expression} for column {column}. Only count(*), count(column) and sum(column) are supported"
+                )
+            parsed[column] = (match.group(1).lower(), match.group(2))
+        return parsed
+
+    @classmethod
+    def _count_column(cls) -> str:
+        """the summary column holding ``count(*)``"""
+        for column, (function, argument) in cls._parsed_aggregates().items():
+            if function == "count" and argument == "*":
+                return column
+        raise TriggerException(
+            f"{cls.__name__} needs a count(*) aggregate so that emptied groups can be deleted"
+        )
+
+    @classmethod
+    def recompute_query(cls, schema: str, table_name: str) -> str:
+        """the query computing the content of the summary table from scratch
+
+        :param schema: the schema of the source table
+        :param table_name: the source table
+        """
+        group = [utilities.quote_identifier(c) for c in cls.group_by]
+        selected = list(group)
+        for column, (function, argument) in cls._parsed_aggregates().items():
+            argument = "*" if argument == "*" else utilities.quote_identifier(argument)
+            expression = (
+                f"count({argument})"
+                if function == "count"
+                else f"coalesce(sum({argument}), 0)"
+            )
+            selected.append(f"{expression} as {utilities.quote_identifier(column)}")
+        return "select {s} from {t} where {n} group by {g}".format(
+            s=", ".join(selected),
+            t=utilities.make_qualified_schema_name(schema, table_name),
+            n=" and ".join(f"{c} is not null" for c in group),
+            g=", ".join(group),
+        )
+
+    @classmethod
+    def verify(
+        cls, plpy_wrapper: PLPYWrapper, schema: str, table_name: str
+    ) -> ResultSetDiff:
+        """compares the summary table against a full recompute from the source table.
+        This scans the source table so it's meant to be run occasionally, e.g. after installing the trigger or by a
+        scheduled check. A summary table that drifted can be repaired with
+        :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.apply_diff` using the returned diff and ``group_by`` as the key columns
+
+        :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+        :param schema: the schema of the source table
+        :param table_name: the source table
+        :return: the diff of the recomputed (source) against the summary table (target), which is empty if they match
+        """
+        cls._count_column()
+        recomputed = plpy_wrapper.execute(cls.recompute_query(schema, table_name))
+        current = plpy_wrapper.execute(
+            "select {c} from {t}".format(
+                c=", ".join(
+                    utilities.quote_identifier(c)
+                    for c in list(cls.group_by) + list(cls.aggregates)
+                ),
+                t=utilities.make_qualified_schema_name(
+                    cls.aggregate_schema, cls.aggregate_table
+                ),
+            )
+        )
+        return recomputed.diff(current, key=cls.group_by)
@@ -1,8 +1,21 @@
-from typing import Tuple, Dict, Union
+import os
+import re
+import string
+from typing import Any, Tuple, Dict, Union
 import plpy_wrapper
 from plpy_wrapper import UtilityException, TypeException
+from plpy_wrapper import cache as plpy_wrapper_cache
 from pathlib import Path
 
+_FORMATTER = string.Formatter()
+
+# path -> (modification time, template) of the templates loaded by this process
+_TEMPLATES: Dict[Path, Tuple[int, "CompiledTemplate"]] = {}
+
+# the body of a function and the language clause that tells whether it's python
+_DOLLAR_QUOTED = re.compile(r"\$(\w*)\$(.*?)\$\1\$", re.DOTALL)
+_PLPYTHON = re.compile(r"language\s+plpython", re.IGNORECASE)
+
 
 def list_to_sql_string(lst: Tuple[str]) -> str:
     """turns python lists into a string that can be put into a postgres tuple and serve as a list in postgres
@@ -24,6 +37,15 @@ def make_qualified_schema_name(schema_name: str, table_name: str) -> str:
     return '"{s}"."{t}"'.format(s=schema_name, t=table_name)
 
 
+def quote_identifier(identifier: str) -> str:
+    """quotes a single identifier (e.g. a column name) so it can be safely interpolated into SQL
+
+    :param identifier: the identifier, like ``first_name``
+    :return: the double quoted identifier with any embedded double quotes escaped ``"first_name"``
+    """
+    return '"{i}"'.format(i=identifier.replace('"', '""'))
+
+
 def check_nth_arg_is_of_type(n: int, type_to_check: type):
     """this decorator allows us to do some basic type checking
 
@@ -51,6 +73,84 @@ def check_nth_arg_is_of_type(n: int, type_to_check: type):
     return wrap
 
 
+class CompiledTemplate:
+    """a ``str.format`` template that is parsed once and rendered any number of times, see :func:`.load_template`"""
+
+    def __init__(self, text: str):
+        """
+        :param text: the template, with the same syntax as ``str.format``
+        """
+        self._parts = list(_FORMATTER.parse(text))
+        #: the names of the replacement fields of the template
+        self.fields = {field for _, field, _, _ in self._parts if field is not None}
+
+    def __repr__(self):
+        return "CompiledTemplate=" + str(sorted(self.fields))
+
+    def render(self, *args: Any, **kwargs: Any) -> str:
+        """same as calling ``str.format`` on the template text"""
+        rendered = []
+        next_index = 0
+        for literal, field, format_spec, conversion in self._parts:
+            rendered.append(literal)
+            if field is None:
+                continue
+            if field == "":
+                field = str(next_index)
+                next_index += 1
+            value, _ = _FORMATTER.get_field(field, args, kwargs)
+            value = _FORMATTER.convert_field(value, conversion)
+            if "{" in format_spec:
+                format_spec = _FORMATTER.vformat(format_spec, args, kwargs)
+            rendered.append(_FORMATTER.format_field(value, format_spec))
+        return "".join(rendered)
+
+
+def load_template(path: Union[str, Path]) -> CompiledTemplate:
+    """reads and parses a template file, the template is reused until the file is modified
+
+    :param path: the path of the template file
+    :return: the parsed template
+    """
+    path = Path(path).resolve()
+    modified_at = os.stat(path).st_mtime_ns
+    cached = _TEMPLATES.get(path)
+    if cached is None or cached[0] != modified_at:
+        cached = (modified_at, CompiledTemplate(path.read_text()))
+        _TEMPLATES[path] = cached
+    return cached[1]
+
+
+def validate_plpython_function(definition: str, name: str = "<function>") -> None:
+    """compiles the python bodies of the plpython functions created by ``definition`` the way postgres does, so that
+    mistakes surface before any SQL is run
+
+    :param definition: SQL containing ``create function ... as $$ ... $$ language plpython3u`` statements
+    :param name: shown in the error, e.g. the name of the function or template
+    :raises: :class:`plpy_wrapper.exceptions.UtilityException` if a body doesn't compile
+    """
+    for match in _DOLLAR_QUOTED.finditer(definition):
+        # the language clause is either before or after the body of the statement
+        statement_start = definition.rfind(";", 0, match.start()) + 1
+        statement = (
+            definition[statement_start : match.start()]
+            + definition[match.end() :].split(";", 1)[0]
+        )
+        if not _PLPYTHON.search(statement):
+            continue
+        body = match.group(2)
+        # plpython wraps the body in a function, indenting every line with a tab
+        source = "def _plpython_function():\n" + "".join(
+            "\t" + line for line in body.splitlines(True)
+        )
+        try:
+            compile(source, name, "exec", dont_inherit=True)
+        except SyntaxError as e:
+            raise UtilityException(
+                f"The python of {name} doesn't compile: {e.msg} (line {(e.lineno or 1) - 1}: {(e.text or '').strip()})"
+            ) from e
+
+
 def create_plpython_triggers(
     plpy_wrapper: "plpy_wrapper.PLPYWrapper",
     schema: str,
@@ -60,10 +160,12 @@ def create_plpython_triggers(
     ),
     trigger_func_definition: Union[str, None] = "",
     trigger_func_name: Union[str, None] = "",
+    statement_triggers: bool = False,
 ):
     """
     sets up triggers and the trigger function for a table.
     After running this function, triggers will now be routed to the custom function where you can run arbitrary python inside of the :class:`plpython.trigger.Trigger` methods.
+    With ``statement_triggers``, statement level triggers that run the same function are created besides the row level triggers.
     Should be executed from the DB like so::
 
         do $$
@@ -74,10 +176,16 @@ def create_plpython_triggers(
 
     :param trigger_func_name: if you provided a ``trigger_func_definition`` and your function name is different than the default function name generated by this function, provide the value for the function name
     :param trigger_func_definition: if provided, the value from ``trigger_template_path`` is ignored. The ``trigger_func_definition`` is sql that will be run before the CREATE trigger statements
-    :param trigger_template_path: the path of the template that will be the base for trigger procedures. The file text must contain the following keyword parameters: ``schema``, ``table``, ``func_name`` otherwise unexpected behavior can be expected
+    :param trigger_template_path: the path of the template that will be the base for trigger procedures. The file text must contain the following keyword parameters: ``schema``, ``table``, ``func_name`` otherwise unexpected behavior can be expected.
+     The template is parsed once and reused until the file changes (see :func:`.load_template`)
     :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrapper.PLPYWrapper`
     :param schema: the schema name the table is located in
     :param table_name: the table to add the triggers and function to
+    :param statement_triggers: also create statement level triggers (which fire on ``TRUNCATE`` too), they open and flush the
+     queue of the work deferred by the row level triggers (see :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.defer_insert`) and are required by
+     :class:`plpy_wrapper.trigger.AggregateTrigger`. They run the function twice more per statement, so leave them out
+     when nothing is deferred
+    :raises: :class:`plpy_wrapper.exceptions.UtilityException` if the table doesn't exist or the python of the function doesn't compile, nothing is changed then
     """
 
     # adding the underscore to avoid keyword collisions
@@ -92,15 +200,17 @@ def create_plpython_triggers(
         )
     )
     # we're keeping the procedure definition in a file since it's easier to visualize and maintain proper indentation that way
-    func_definition = trigger_func_definition or open(
+    func_definition = trigger_func_definition or load_template(
         trigger_template_path
-    ).read().format(
+    ).render(
         trigger_template_path,
         capital_camel_case=capital_camel_case,
         schema=schema,
         table=table_name,
         func_name=func_name,
     )
+    # before anything is dropped, so a broken template doesn't leave the table without its triggers
+    validate_plpython_function(func_definition, func_name)
 
     trigger_commands = [
         line.format(
@@ -112,13 +222,20 @@ def create_plpython_triggers(
         for line in [
             "drop trigger if exists trig_{schema}_{table}_before on {schema_qualified_table_name};",
             "drop trigger if exists trig_{schema}_{table}_after on  {schema_qualified_table_name};",
+            "drop trigger if exists trig_{schema}_{table}_before_statement on {schema_qualified_table_name};",
+            "drop trigger if exists trig_{schema}_{table}_after_statement on {schema_qualified_table_name};",
             """create trigger trig_{schema}_{table}_before before update or insert or delete on {schema_qualified_table_name} for each row execute procedure {func_name}();""",
             """create trigger trig_{schema}_{table}_after after update or insert or delete on {schema_qualified_table_name} for each row execute procedure {func_name}();""",
+            # the statement level triggers start and flush the queue of work deferred by the row level triggers
+            """create trigger trig_{schema}_{table}_before_statement before update or insert or delete or truncate on {schema_qualified_table_name} for each statement execute procedure {func_name}();""",
+            """create trigger trig_{schema}_{table}_after_statement after update or insert or delete or truncate on {schema_qualified_table_name} for each statement execute procedure {func_name}();""",
         ]
     ]
 
-    drop_commands = trigger_commands[:2]
-    create_commands = trigger_commands[2:]
+    drop_commands = trigger_commands[:4]
+    create_commands = (
+        trigger_commands[4:] if statement_triggers else trigger_commands[4:6]
+    )
 
     all_qualified_table_names = [
         make_qualified_schema_name(table.schemaname, table.tablename)
@@ -137,6 +254,182 @@ def create_plpython_triggers(
     [plpy_wrapper.execute(sql) for sql in sql_commands]
 
 
+def install_cache_invalidation(
+    plpy_wrapper: "plpy_wrapper.PLPYWrapper", schema: str, table_name: str
+):
+    """
+    installs a small statement level trigger that gives a table a new version on every change to it.
+    Results cached with :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.execute_cached` that depend on the table are invalidated
+    when its version changes. The trigger is written in plpgsql to keep its overhead on writes minimal.
+    Versions come from a sequence, so a version seen by a transaction that was rolled back never comes back, and each
+    backend writes one of :data:`plpy_wrapper.cache.TABLE_VERSION_SLOTS` rows per table, so writers don't queue up behind
+    a single row lock.
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    :param schema: the schema the table is located in
+    :param table_name: the table whose changes should invalidate cached results
+    """
+    qualified_table_name = make_qualified_schema_name(schema, table_name)
+    version_table = plpy_wrapper_cache.TABLE_VERSION_TABLE
+    version_sequence = plpy_wrapper_cache.TABLE_VERSION_SEQUENCE
+    sql_commands = [
+        f"create sequence if not exists {version_sequence};",
+        f"""create table if not exists {version_table}
+        (
+            schema_name text   not null,
+            table_name  text   not null,
+            slot        int    not null,
+            version     bigint not null,
+            primary key (schema_name, table_name, slot)
+        );""",
+        f"""create or replace function "public".plpy_wrapper_bump_table_version() returns trigger as $$
+        begin
+            insert into {version_table} (schema_name, table_name, slot, version)
+            values (TG_TABLE_SCHEMA, TG_TABLE_NAME, pg_backend_pid() % {plpy_wrapper_cache.TABLE_VERSION_SLOTS}, nextval('{version_sequence}'))
+            on conflict (schema_name, table_name, slot) do update set version = excluded.version;
+            return null;
+        end;
+        $$ language plpgsql;""",
+        f"drop trigger if exists trig_{schema}_{table_name}_cache_version on {qualified_table_name};",
+        f"""create trigger trig_{schema}_{table_name}_cache_version after insert or update or delete or truncate on {qualified_table_name}
+        for each statement execute procedure "public".plpy_wrapper_bump_table_version();""",
+    ]
+    [plpy_wrapper.execute(sql) for sql in sql_commands]
+
+
+def install_single_flight_table(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the table that :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.single_flight` publishes computed values to.
+    It's unlogged since the values can always be recomputed. Values are stored as JSON, so writing to the table can't
+    get code run in the sessions reading it.
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(
+        f"""create unlogged table if not exists {plpy_wrapper.SINGLE_FLIGHT_TABLE}
+        (
+            key          text        not null primary key,
+            value        jsonb       not null,
+            published_at timestamptz not null
+        );"""
+    )
+
+
+def install_job_checkpoint_table(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the table that :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.process_in_chunks` keeps the checkpoints of its jobs in.
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(
+        f"""create table if not exists {plpy_wrapper.JOB_CHECKPOINT_TABLE}
+        (
+            job_name   text        not null primary key,
+            last_key   text        not null,
+            updated_at timestamptz not null
+        );"""
+    )
+
+
+def install_module_table(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the table :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.enable_module_loader` imports modules from.
+    Use :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.publish_module` to add modules, rows inserted with plain SQL work
+    as well and get their bytecode when they're first imported.
+    The modules run in every backend that imports them, so all privileges on the table are revoked from ``public`` and
+    only its owner can change it. Grant ``insert`` and ``update`` only to roles that may run code as the postgres user.
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(f"""create table if not exists {plpy_wrapper.MODULE_TABLE}
+        (
+            name         text        not null primary key,
+            source       text        not null,
+            is_package   bool        not null default false,
+            version      int         not null default 1,
+            source_hash  text,
+            bytecode     bytea,
+            python_magic text,
+            signature    text,
+            updated_at   timestamptz not null default now()
+        );""")
+    plpy_wrapper.execute(f"revoke all on {plpy_wrapper.MODULE_TABLE} from public")
+
+
+def install_plan_baseline_table(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the table :class:`plpy_wrapper.plans.PlanRegressionHarness` keeps the baseline plans of its queries in.
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(
+        f"""create table if not exists {plpy_wrapper.PLAN_BASELINE_TABLE}
+        (
+            name           text        not null primary key,
+            query          text        not null,
+            shape          jsonb       not null,
+            total_cost     float8      not null,
+            server_version int         not null default current_setting('server_version_num')::int,
+            recorded_at    timestamptz not null default now()
+        );"""
+    )
+
+
+def install_profile_report_function(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the ``"public".plpy_wrapper_profile_report(profile_name, top, sort)`` set-returning function, which returns
+    :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.profile_report` as a table. Profiles are kept per session, so it reports
+    what was profiled in the session calling it::
+
+        select * from plpy_wrapper_profile_report(top => 10);
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(
+        """create or replace function "public".plpy_wrapper_profile_report(profile_name text default null, top int default 20, sort text default 'cumulative')
+        returns table (name text, function text, calls bigint, primitive_calls bigint, total_time float8, cumulative_time float8, sampled_invocations bigint) as $$
+from plpy_wrapper import PLPYWrapper
+return PLPYWrapper(globals()).profile_report(profile_name, top, sort)
+$$ language plpython3u;"""
+    )
+
+
+def install_stats(plpy_wrapper: "plpy_wrapper.PLPYWrapper"):
+    """
+    creates the ``"public".plpy_wrapper_stats()`` set-returning function, which returns
+    :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.stats` of the calling session as a table, and the unlogged table
+    :meth:`plpy_wrapper.plpy_wrappers.PLPYWrapper.flush_stats` writes the stats of every session to::
+
+        select * from plpy_wrapper_stats();
+        select release, metric, label, sum(value) from plpy_wrapper_stats group by 1, 2, 3;
+
+    :param plpy_wrapper: instance of :class:`plpy_wrapper.plpy_wrappers.PLPYWrapper`
+    """
+    plpy_wrapper.execute(
+        """create unlogged table if not exists {t}
+        (
+            flushed_at timestamptz not null default now(),
+            pid        int         not null default pg_backend_pid(),
+            flush_id   text        not null,
+            release    text,
+            metric     text        not null,
+            label      text        not null,
+            value      float8      not null
+        );
+        create index if not exists {i} on {t} (flush_id);""".format(
+            t=make_qualified_schema_name(
+                plpy_wrapper.STATS_SCHEMA, plpy_wrapper.STATS_TABLE_NAME
+            ),
+            i=quote_identifier(plpy_wrapper.STATS_TABLE_NAME + "_flush_id_idx"),
+        )
+    )
+    plpy_wrapper.execute("""create or replace function "public".plpy_wrapper_stats()
+        returns table (metric text, label text, value float8) as $$
+from plpy_wrapper import PLPYWrapper
+return PLPYWrapper(globals()).stats()
+$$ language plpython3u;""")
+
+
 def get_all_tables(
     plpy_wrapper: "plpy_wrapper.PLPYWrapper",
     exclude_schemas: Tuple[str] = (),
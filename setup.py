@@ -13,6 +13,7 @@ setup(
             "sphinx_rtd_theme",
         ],
         "pypipublish": ["wheel"],
+        "orjson": ["orjson"],
     },
     license="MIT",
     long_description=open("README.md").read(),
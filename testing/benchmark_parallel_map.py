@@ -0,0 +1,37 @@
+"""compares PLPYWrapper.parallel_map to a plain loop over the rows, run by run_benchmarks.sql"""
+
+import math
+import os
+import time
+
+from plpy_wrapper import PLPYWrapper
+
+QUERY = "select id, random() as x from generate_series(1,$1) as id"
+
+
+def score(row) -> float:
+    # module level so the workers can import it, stands in for CPU bound python per row
+    total = 0.0
+    for i in range(2000):
+        total += math.sin(row.x * i) * math.cos(row.id + i)
+    return total
+
+
+def run(wrapper: PLPYWrapper, rows: int = 20000) -> str:
+    result = wrapper.execute_plan(wrapper.prepare(QUERY, ["int"]), [rows])
+    lines = [f"{rows} rows, {os.cpu_count()} cores"]
+    start = time.perf_counter()
+    expected = [score(row) for row in result]
+    serial = time.perf_counter() - start
+    lines.append(f"serial: {serial:.2f}s")
+    for workers in sorted({2, os.cpu_count() or 1}):
+        # includes forking the pool, which every call without keep_pool pays
+        start = time.perf_counter()
+        scores = wrapper.parallel_map(score, result, workers=workers)
+        elapsed = time.perf_counter() - start
+        if scores != expected:
+            raise AssertionError(f"parallel_map with {workers} workers differs")
+        lines.append(
+            f"parallel_map, {workers} workers: {elapsed:.2f}s ({serial / elapsed:.1f}x)"
+        )
+    return "\n".join(lines)
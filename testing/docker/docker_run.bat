@@ -49,4 +49,19 @@ python -c "a=open('%coverage_file%').read();b=a[a.index('unittest stderr and/or
 @REM captures code coverage report which is in xml format. If there was an error running the coverage report, the error will be written to this file
 python -c "a=open('%coverage_file%').read();b=a[a.index('TEST COVERAGE RESULTS:')+23:a.index('DO')];open('%coverage_file%','w+').write(b)"
 
-docker container rm -f %container_name%
\ No newline at end of file
+@REM compares the plans of the queries in plan_checks.py to plan_baselines.json, or records it on the first run
+@REM ON_ERROR_STOP makes psql exit with a non zero code when a regression is raised
+docker exec %container_name% psql -U postgres -v ON_ERROR_STOP=1 -f /mnt/docker_dir/run_plan_checks.sql 1> plan_check_results.txt 2>&1
+set plan_check_errorlevel=%errorlevel%
+
+@REM times parallel_map against a plain loop over the rows
+docker exec %container_name% psql -U postgres -f /mnt/docker_dir/run_benchmarks.sql 1> benchmark_results.txt 2>&1
+
+docker container rm -f %container_name%
+
+@REM fails the run on plan regressions, after the container has been removed
+if not %plan_check_errorlevel%==0 (
+    echo the query plans regressed, see plan_check_results.txt
+    type plan_check_results.txt
+    exit /b %plan_check_errorlevel%
+)
@@ -0,0 +1,9 @@
+do
+$$
+from plpy_wrapper import PLPYWrapper
+#testing is loaded as a package during docker run
+import benchmark_parallel_map
+
+wrapper = PLPYWrapper(globals())
+plpy.info('BENCHMARK RESULTS:\n' + benchmark_parallel_map.run(wrapper))
+$$ language plpython3u;
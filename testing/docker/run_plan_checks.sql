@@ -0,0 +1,24 @@
+do
+$$
+import json
+from plpy_wrapper import PLPYWrapper, utilities
+from plpy_wrapper.plans import PlanRegressionHarness
+#testing is loaded as a package during docker run
+import plan_checks
+
+wrapper = PLPYWrapper(globals())
+utilities.install_plan_baseline_table(wrapper)
+harness = PlanRegressionHarness(wrapper)
+plan_checks.register_queries(harness)
+
+# the first run records the baselines, commit plan_baselines.json to check against them from then on
+if plan_checks.BASELINE_FILE.exists():
+    harness.import_baselines(json.loads(plan_checks.BASELINE_FILE.read_text()))
+    # raises so that the DO block, and with it docker_run.bat, fails on a regression
+    harness.assert_no_regressions()
+    plpy.info('PLAN CHECK RESULTS:\nno plan regressions')
+else:
+    harness.record_baselines()
+    plan_checks.BASELINE_FILE.write_text(json.dumps(harness.baselines(), indent=2, sort_keys=True))
+    plpy.info('PLAN CHECK RESULTS:\nrecorded the baselines in ' + str(plan_checks.BASELINE_FILE))
+$$ language plpython3u;
@@ -0,0 +1,30 @@
+"""the queries whose plans are checked for regressions by run_plan_checks.sql, see plpy_wrapper.plans"""
+
+from pathlib import Path
+
+from plpy_wrapper.plans import PlanRegressionHarness
+
+#: kept in version control so that every run compares against the same plans
+BASELINE_FILE = Path(Path(__file__).parent, "docker", "plan_baselines.json")
+
+
+def register_queries(harness: PlanRegressionHarness) -> None:
+    harness.register(
+        "company_by_id", "select * from customer.company where id = $1", [1], ["int"]
+    )
+    harness.register(
+        "contacts_of_company",
+        "select * from customer.contact where company_id = $1",
+        [1],
+        ["int"],
+    )
+    harness.register(
+        "contacts_with_company_name",
+        """select contact.first_name, contact.last_name, company.name from customer.contact
+        join customer.company on company.id = contact.company_id""",
+    )
+    harness.register(
+        "contacts_per_company",
+        """select company_id, count(*) from customer.contact group by company_id
+        order by count(*) desc""",
+    )
@@ -1,17 +1,37 @@
 """TESTS ARE NOT MEANT TO BE RUN OUTSIDE OF THE POSTGRES RUNTIME. USE THE DOCKER SCRIPT TO RUN TESTS"""
+import importlib
+import importlib.util
 import json
+import marshal
+import os
+import shutil
+import signal
 import sys
+import tempfile
+import types
 import unittest
+from decimal import Decimal
 from pathlib import Path
 
 
-from plpy_wrapper import PLPYWrapper
+from plpy_wrapper import PLPYWrapper, bulk, cache, parallel, plans, plpy_wrappers
+from plpy_wrapper.shared_cache import SharedCache
 from plpy_wrapper import (
     utilities,
     Trigger,
+    AggregateTrigger,
     Row,
+    ResultSet,
     TriggerException,
     TriggerReturnValue,
+    PLPythonWrapperException,
+    ResultSetException,
+    MemoryBudgetException,
+    TimeBudgetException,
+    PlanRegressionException,
+    UtilityException,
+    SharedCacheException,
+    CursorResult,
 )
 
 """
@@ -39,8 +59,10 @@ class TestBase(unittest.TestCase):
             self.subtrans.exit(*sys.exc_info())
 
 
-class TriggerTests(TestBase):
-    """Tests for code in trigger.py module"""
+class TriggerSetup:
+    """creates the test triggers on customer.company and inserts the initial company before each test, mixed into the test
+    cases that run triggers. Has no tests of its own so they aren't run again by every test case that uses it
+    """
 
     COMPANY_ID = 1
     COMPANY_NAME = "Phantom Zone"
@@ -59,6 +81,10 @@ class TriggerTests(TestBase):
     TRIGGER_RUN_BEFORE_DELETE_MESSAGE = "Hello from before_delete!"
     TRIGGER_RUN_AFTER_DELETE_MESSAGE = "Hello from after_delete!"
 
+    #: whether create_triggers also creates the statement level triggers, which deferring work needs. Off like in
+    #: create_plpython_triggers, the suites that defer work turn it on
+    STATEMENT_TRIGGERS = False
+
     @classmethod
     def create_triggers(
         cls,
@@ -74,15 +100,16 @@ class TriggerTests(TestBase):
         trigger_template_path=Path(
             Path(__file__).parent, "trigger_process_template_trigger_test.txt"
         ),
+        statement_triggers=None,
     ):
+        if statement_triggers is None:
+            statement_triggers = cls.STATEMENT_TRIGGERS
         utilities.create_plpython_triggers(
             PLPY_WRAPPER,
             schema,
             table,
             None,
-            open(trigger_template_path)
-            .read()
-            .format(
+            utilities.load_template(trigger_template_path).render(
                 trigger_template_path=trigger_template_path,
                 before_insert_body=before_insert_body,
                 after_insert_body=after_insert_body,
@@ -92,8 +119,21 @@ class TriggerTests(TestBase):
                 after_delete_body=after_delete_body,
                 func_name=func_name,
             ),
+            statement_triggers=statement_triggers,
         )
 
+    def setUp(self) -> None:
+
+        super().setUp()
+        self.create_triggers()
+        PLPY_WRAPPER.execute(
+            f"INSERT INTO customer.company (id, name) VALUES(1,'{self.COMPANY_NAME}') ON CONFLICT DO NOTHING"
+        )
+
+
+class TriggerTests(TriggerSetup, TestBase):
+    """Tests for code in trigger.py module"""
+
     def get_trigger_run_log(self, when, event):
         # gets the latest trigger log, ignoring the initial company that was inserted at the beginning of the test
         return PLPY_WRAPPER.execute(
@@ -132,13 +172,11 @@ class TriggerTests(TestBase):
     def execute_sql_and_get_trigger_obj_after_delete(self, sql_command):
         return self.execute_sql_and_get_trigger_obj(sql_command, "AFTER", "DELETE")
 
-    def setUp(self) -> None:
-
-        super().setUp()
-        TriggerTests.create_triggers()
-        PLPY_WRAPPER.execute(
-            f"INSERT INTO customer.company (id, name) VALUES(1,'{self.COMPANY_NAME}') ON CONFLICT DO NOTHING"
-        )
+    def test_invalid_template_keeps_triggers(self):
+        with self.assertRaises(UtilityException):
+            TriggerTests.create_triggers(after_insert_body="def broken(:")
+        PLPY_WRAPPER.execute(self.INSERT_NEW_COMPANY_SQL)
+        self.assertTrue(self.get_trigger_run_log("AFTER", "INSERT"))
 
     def test_is_changed_returns_true_if_changed(self):
         self.assertTrue(
@@ -695,6 +733,54 @@ class UtilityTests(unittest.TestCase):
         pass
 
 
+class TemplateTests(unittest.TestCase):
+    """Tests for the templates of utilities.py"""
+
+    TEMPLATE = """create or replace function {func_name}() returns trigger as $$
+from plpy_wrapper import PLPYWrapper
+{body}
+return None
+$$ language plpython3u;"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.path = Path(self.directory, "template.txt")
+        self.path.write_text(self.TEMPLATE)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_render_matches_format(self):
+        template = utilities.CompiledTemplate(self.TEMPLATE)
+        self.assertEqual(template.fields, {"func_name", "body"})
+        self.assertEqual(
+            template.render(func_name="f", body="x = {1}"),
+            self.TEMPLATE.format(func_name="f", body="x = {1}"),
+        )
+
+    def test_template_is_cached_until_modified(self):
+        template = utilities.load_template(self.path)
+        self.assertIs(utilities.load_template(self.path), template)
+        self.path.write_text("{other}")
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(utilities.load_template(self.path).fields, {"other"})
+
+    def test_invalid_python_is_rejected(self):
+        template = utilities.load_template(self.path)
+        utilities.validate_plpython_function(
+            template.render(func_name="f", body="x = 1")
+        )
+        with self.assertRaises(UtilityException):
+            utilities.validate_plpython_function(
+                template.render(func_name="f", body="def broken(:")
+            )
+
+    def test_other_languages_are_ignored(self):
+        utilities.validate_plpython_function(
+            "create function f() returns int as $$ begin return 1; end $$ language plpgsql;"
+        )
+
+
 """
 
 """
@@ -924,3 +1010,1550 @@ class PLPYWrapperTests(unittest.TestCase):
 
     def test_publish_message_fatal_raises_exception(self):
         pass
+
+
+class RowWidthTests(unittest.TestCase):
+    """Tests for the row width estimate of bulk.py"""
+
+    def test_catalog_type_names_have_fixed_widths(self):
+        columns = {"id": [10**18], "score": [0.123456789], "at": ["x" * 100]}
+        self.assertEqual(
+            bulk.estimate_row_width(
+                columns, {"id": "int8", "score": "float8", "at": "timestamptz"}
+            ),
+            bulk.estimate_row_width(
+                columns,
+                {
+                    "id": "bigint",
+                    "score": "double precision",
+                    "at": "timestamp with time zone",
+                },
+            ),
+        )
+
+
+class ArrayWriteTests(TestBase):
+    """Tests for PLPYWrapper.insert_arrays and PLPYWrapper.update_arrays"""
+
+    def test_insert_arrays_inserts_all_rows(self):
+        inserted = PLPY_WRAPPER.insert_arrays(
+            "customer",
+            "company",
+            {"id": [200, 201, 202], "name": ["Wayne", "Stark", "Oscorp"]},
+        )
+        self.assertEqual(inserted, 3)
+        self.assertEqual(
+            [
+                row.name
+                for row in PLPY_WRAPPER.execute(
+                    "select name from customer.company where id >= 200 order by id"
+                )
+            ],
+            ["Wayne", "Stark", "Oscorp"],
+        )
+
+    def test_insert_arrays_chunks_by_memory_budget(self):
+        inserted = PLPY_WRAPPER.insert_arrays(
+            "customer",
+            "company",
+            {"id": list(range(300, 310)), "name": ["chunked"] * 10},
+            memory_budget=1,
+        )
+        self.assertEqual(inserted, 10)
+
+    def test_update_arrays_updates_matching_rows(self):
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (400,'before'),(401,'before')"
+        )
+        updated = PLPY_WRAPPER.update_arrays(
+            "customer", "company", ["id"], {"id": [400, 401], "name": ["a", "b"]}
+        )
+        self.assertEqual(updated, 2)
+        self.assertEqual(
+            PLPY_WRAPPER.execute("select name from customer.company where id=401")[
+                0
+            ].name,
+            "b",
+        )
+
+    def test_insert_arrays_with_uneven_columns_fails(self):
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.insert_arrays(
+                "customer", "company", {"id": [1, 2], "name": ["only one"]}
+            )
+
+    def test_array_columns_are_rejected(self):
+        PLPY_WRAPPER.execute("create temp table array_write_test (id int, tags text[])")
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.insert_arrays(
+                "pg_temp",
+                "array_write_test",
+                {"id": [1, 2], "tags": [["a", "b"], ["c"]]},
+                {"id": "int4", "tags": "text[]"},
+            )
+        PLPY_WRAPPER.defer_insert(
+            "pg_temp", "array_write_test", {"id": 1, "tags": ["a"]}
+        )
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.flush_deferred()
+        self.assertEqual(
+            len(PLPY_WRAPPER.execute("select * from pg_temp.array_write_test")), 0
+        )
+
+
+class ResultSetIndexTests(TestBase):
+    """Tests for ResultSet.index_by and ResultSet.group_by"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (500,'Daily Planet'),(501,'Daily Bugle')"
+        )
+        PLPY_WRAPPER.execute(
+            """insert into customer.contact (first_name,last_name,company_id) values
+            ('Clark','Kent',500),('Lois','Lane',500),('Peter','Parker',501)"""
+        )
+
+    def test_index_by_maps_key_to_row(self):
+        companies = PLPY_WRAPPER.execute(
+            "select id,name from customer.company where id >= 500"
+        ).index_by("id")
+        self.assertEqual(companies[501].name, "Daily Bugle")
+
+    def test_index_by_is_cached(self):
+        result_set = PLPY_WRAPPER.execute("select id,name from customer.company")
+        self.assertIs(result_set.index_by("id"), result_set.index_by("id"))
+
+    def test_index_by_with_repeated_key_fails(self):
+        with self.assertRaises(ResultSetException):
+            PLPY_WRAPPER.execute(
+                "select company_id from customer.contact where company_id=500"
+            ).index_by("company_id")
+
+    def test_group_by_with_composite_key(self):
+        groups = PLPY_WRAPPER.execute(
+            "select first_name,last_name,company_id from customer.contact"
+        ).group_by("company_id", "last_name")
+        self.assertEqual(len(groups[(500, "Kent")]), 1)
+        self.assertEqual(
+            sorted(len(rows) for key, rows in groups.items() if key[0] == 500), [1, 1]
+        )
+
+
+class ResultSetDiffTests(TestBase):
+    """Tests for ResultSet.diff and PLPYWrapper.apply_diff"""
+
+    SOURCE_SQL = (
+        "select * from (values (600,'kept'),(601,'renamed'),(602,'new')) as s(id,name)"
+    )
+    TARGET_SQL = "select id,name from customer.company where id >= 600 order by id"
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (600,'kept'),(601,'old name'),(603,'removed')"
+        )
+
+    def test_diff_finds_inserted_deleted_and_changed_rows(self):
+        diff = PLPY_WRAPPER.execute(self.SOURCE_SQL).diff(
+            PLPY_WRAPPER.execute(self.TARGET_SQL), key=["id"]
+        )
+        self.assertEqual([row.id for row in diff.inserted], [602])
+        self.assertEqual([row.id for row in diff.deleted], [603])
+        self.assertEqual(
+            [(source.name, target.name) for source, target in diff.changed],
+            [("renamed", "old name")],
+        )
+
+    def test_diff_of_identical_result_sets_is_empty(self):
+        self.assertFalse(
+            PLPY_WRAPPER.execute(self.TARGET_SQL).diff(
+                PLPY_WRAPPER.execute(self.TARGET_SQL), key=["id"]
+            )
+        )
+
+    def test_apply_diff_synchronizes_table(self):
+        source = PLPY_WRAPPER.execute(self.SOURCE_SQL)
+        counts = PLPY_WRAPPER.apply_diff(
+            "customer",
+            "company",
+            source.diff(PLPY_WRAPPER.execute(self.TARGET_SQL), key=["id"]),
+            key_columns=["id"],
+        )
+        self.assertEqual(counts, {"deleted": 1, "updated": 1, "inserted": 1})
+        self.assertListEqual(
+            [row for row in PLPY_WRAPPER.execute(self.TARGET_SQL)],
+            [row for row in source],
+        )
+
+    def test_column_types_follow_alter_table(self):
+        PLPY_WRAPPER.execute("create table customer.diff_types (id int, name text)")
+        self.assertEqual(
+            PLPY_WRAPPER._table_column_types("customer", "diff_types")["name"], "text"
+        )
+        PLPY_WRAPPER.execute(
+            "alter table customer.diff_types alter column name type varchar, add column score float8"
+        )
+        self.assertEqual(
+            PLPY_WRAPPER._table_column_types("customer", "diff_types"),
+            {"id": "integer", "name": "character varying", "score": "double precision"},
+        )
+
+    def test_row_compared_to_non_row_is_not_equal(self):
+        self.assertNotEqual(Row({"id": 1}), {"id": 1})
+
+
+class LookupTests(TestBase):
+    """Tests for PLPYWrapper.lookup and PLPYWrapper.prefetch"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.clear_lookup_cache()
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (700,'Queen Industries'),(701,'LexCorp')"
+        )
+
+    def test_lookup_returns_row(self):
+        self.assertEqual(
+            PLPY_WRAPPER.lookup("customer", "company", ["id"], 700).name,
+            "Queen Industries",
+        )
+
+    def test_lookup_of_missing_key_returns_none(self):
+        self.assertIsNone(PLPY_WRAPPER.lookup("customer", "company", ["id"], -1))
+
+    def test_rolled_back_subtransaction_drops_cached_rows(self):
+        with self.assertRaises(TriggerTestException):
+            with PLPY_WRAPPER.subtransaction():
+                PLPY_WRAPPER.execute(
+                    "update customer.company set name='rolled back' where id=700"
+                )
+                PLPY_WRAPPER.lookup("customer", "company", ["id"], 700)
+                raise TriggerTestException()
+        self.assertEqual(
+            PLPY_WRAPPER.lookup("customer", "company", ["id"], 700).name,
+            "Queen Industries",
+        )
+
+    def test_lookup_is_served_from_cache_until_cleared(self):
+        PLPY_WRAPPER.lookup("customer", "company", ["id"], 700)
+        PLPY_WRAPPER.execute("update customer.company set name='renamed' where id=700")
+        self.assertEqual(
+            PLPY_WRAPPER.lookup("customer", "company", ["id"], 700).name,
+            "Queen Industries",
+        )
+        PLPY_WRAPPER.clear_lookup_cache()
+        self.assertEqual(
+            PLPY_WRAPPER.lookup("customer", "company", ["id"], 700).name, "renamed"
+        )
+
+    def test_prefetched_keys_are_loaded_with_the_next_miss(self):
+        PLPY_WRAPPER.prefetch("customer", "company", ["id"], [700, 701])
+        PLPY_WRAPPER.lookup("customer", "company", ["id"], 700)
+        PLPY_WRAPPER.execute("delete from customer.company where id=701")
+        self.assertEqual(
+            PLPY_WRAPPER.lookup("customer", "company", ["id"], 701).name, "LexCorp"
+        )
+
+    def test_cache_hit_in_a_trigger_runs_no_query(self):
+        relid = PLPY_WRAPPER.execute(
+            "select 'customer.contact'::regclass::oid::bigint as relid"
+        )[0].relid
+        plpy_globals = dict(PLPY_WRAPPER._postgres_runtime_globals)
+        plpy_globals["TD"] = {"relid": str(relid)}
+        wrapper = PLPYWrapper(plpy_globals)
+        # what the BEFORE statement level trigger does
+        wrapper.open_deferred()
+        try:
+            wrapper.lookup("customer", "company", ["id"], 700)
+            executed = []
+            execute = wrapper.plpy.execute
+            wrapper.plpy = types.SimpleNamespace(
+                execute=lambda *args: executed.append(args) or execute(*args)
+            )
+            self.assertEqual(
+                wrapper.lookup("customer", "company", ["id"], 700).name,
+                "Queen Industries",
+            )
+            self.assertEqual(executed, [])
+        finally:
+            wrapper.discard_deferred()
+
+
+class QueryCacheTests(TestBase):
+    """Tests for PLPYWrapper.execute_cached and PLPYWrapper.cached_query"""
+
+    SELECT_COMPANY_SQL = "select id,name from customer.company where id=800"
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.query_cache.clear()
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (800,'Cached')"
+        )
+        utilities.install_cache_invalidation(PLPY_WRAPPER, "customer", "company")
+
+    def test_execute_cached_serves_repeated_calls_from_cache(self):
+        hits = PLPY_WRAPPER.query_cache.stats["hits"]
+        PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+        result_set = PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+        self.assertEqual(result_set[0].name, "Cached")
+        self.assertEqual(result_set.colnames, ["id", "name"])
+        self.assertEqual(PLPY_WRAPPER.query_cache.stats["hits"], hits + 1)
+
+    def test_changing_a_dependent_table_invalidates_the_result(self):
+        PLPY_WRAPPER.execute_cached(
+            self.SELECT_COMPANY_SQL, depends_on=[("customer", "company")]
+        )
+        PLPY_WRAPPER.execute("update customer.company set name='Fresh' where id=800")
+        self.assertEqual(
+            PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)[0].name, "Fresh"
+        )
+
+    def test_rolled_back_version_is_not_reused(self):
+        depends_on = [("customer", "company")]
+        with self.assertRaises(TriggerTestException):
+            with PLPY_WRAPPER.subtransaction():
+                PLPY_WRAPPER.execute(
+                    "update customer.company set name='Rolled back' where id=800"
+                )
+                PLPY_WRAPPER.execute_cached(
+                    self.SELECT_COMPANY_SQL, depends_on=depends_on
+                )
+                raise TriggerTestException()
+        PLPY_WRAPPER.execute(
+            "update customer.company set name='Committed' where id=800"
+        )
+        self.assertEqual(
+            PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL, depends_on=depends_on)[
+                0
+            ].name,
+            "Committed",
+        )
+
+    def test_results_are_cached_per_search_path(self):
+        misses = PLPY_WRAPPER.query_cache.stats["misses"]
+        PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+        PLPY_WRAPPER.execute("set local search_path = customer, public")
+        PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+        self.assertEqual(PLPY_WRAPPER.query_cache.stats["misses"], misses + 2)
+
+    def test_check_interval_reuses_the_versions(self):
+        depends_on = [("customer", "company")]
+        PLPY_WRAPPER.query_cache.check_interval = 60
+        try:
+            PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL, depends_on=depends_on)
+            PLPY_WRAPPER.execute(
+                "update customer.company set name='Fresh' where id=800"
+            )
+            # the change isn't noticed until the interval is over
+            self.assertEqual(
+                PLPY_WRAPPER.execute_cached(
+                    self.SELECT_COMPANY_SQL, depends_on=depends_on
+                )[0].name,
+                "Cached",
+            )
+        finally:
+            PLPY_WRAPPER.query_cache.check_interval = None
+            PLPY_WRAPPER._wrapper_state.pop("query_cache_context", None)
+
+    def test_expired_results_are_requeried(self):
+        PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL, ttl=0)
+        expirations = PLPY_WRAPPER.query_cache.stats["expirations"]
+        PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+        self.assertEqual(PLPY_WRAPPER.query_cache.stats["expirations"], expirations + 1)
+
+    def test_results_larger_than_max_bytes_are_not_cached(self):
+        PLPY_WRAPPER.query_cache.max_bytes = 1
+        try:
+            evictions = PLPY_WRAPPER.query_cache.stats["evictions"]
+            PLPY_WRAPPER.execute_cached(self.SELECT_COMPANY_SQL)
+            self.assertEqual(len(PLPY_WRAPPER.query_cache), 0)
+            self.assertEqual(PLPY_WRAPPER.query_cache.stats["evictions"], evictions)
+        finally:
+            PLPY_WRAPPER.query_cache.max_bytes = cache.DEFAULT_MAX_BYTES
+
+    def test_cached_query_caches_per_argument(self):
+        calls = []
+
+        @PLPY_WRAPPER.cached_query()
+        def company_name(company_id):
+            calls.append(company_id)
+            return PLPY_WRAPPER.execute(
+                f"select name from customer.company where id={company_id}"
+            )
+
+        company_name(800)
+        company_name(800)
+        company_name(1)
+        self.assertEqual(calls, [800, 1])
+
+
+class SharedCacheTests(unittest.TestCase):
+    """Tests for the memory mapped SharedCache. These don't need the database, every process only touches the cache files"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.shared_cache = SharedCache(self.directory)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run_in_child_processes(self, func, n_processes=1):
+        """forks processes that run func against their own SharedCache instance and returns their exit codes"""
+        pids = []
+        for _ in range(n_processes):
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 1
+                try:
+                    func(SharedCache(self.directory))
+                    exit_code = 0
+                finally:
+                    # skipping any cleanup inherited from the parent process
+                    os._exit(exit_code)
+            pids.append(pid)
+        return [os.WEXITSTATUS(os.waitpid(pid, 0)[1]) for pid in pids]
+
+    def test_missing_key_returns_default(self):
+        self.assertEqual(self.shared_cache.get("missing", "default"), "default")
+        self.assertEqual(self.shared_cache.version("missing"), 0)
+
+    def test_value_set_by_another_process_is_visible(self):
+        self.run_in_child_processes(lambda c: c.set("names", {1: "Wayne"}))
+        self.assertEqual(self.shared_cache.get("names"), {1: "Wayne"})
+        self.assertEqual(self.shared_cache.version("names"), 1)
+
+    def test_buffer_stays_valid_after_replace(self):
+        self.shared_cache.set_bytes("blob", b"first")
+        buffer = self.shared_cache.get_buffer("blob")
+        self.run_in_child_processes(lambda c: c.set_bytes("blob", b"second"))
+        self.assertEqual(bytes(buffer), b"first")
+        self.assertEqual(bytes(self.shared_cache.get_buffer("blob")), b"second")
+        self.assertEqual(self.shared_cache.version("blob"), 2)
+
+    def test_lock_serializes_concurrent_writers(self):
+        self.shared_cache.set("counter", 0)
+
+        def increment(shared_cache):
+            for _ in range(25):
+                with shared_cache.lock("counter"):
+                    shared_cache.set("counter", shared_cache.get("counter") + 1)
+
+        self.assertEqual(self.run_in_child_processes(increment, 4), [0] * 4)
+        self.assertEqual(self.shared_cache.get("counter"), 100)
+
+    def test_new_directory_is_private(self):
+        directory = Path(self.directory, "nested")
+        SharedCache(directory)
+        self.assertEqual(directory.stat().st_mode & 0o777, 0o700)
+
+    def test_directory_writable_by_others_is_refused(self):
+        os.chmod(self.directory, 0o777)
+        with self.assertRaises(SharedCacheException):
+            SharedCache(self.directory)
+
+    def test_write_under_shared_lock_is_refused(self):
+        with self.shared_cache.lock("names", exclusive=False):
+            with self.assertRaises(SharedCacheException):
+                self.shared_cache.set("names", {})
+
+    def test_delete_removes_lock_file(self):
+        self.shared_cache.set("names", {})
+        self.shared_cache.delete("names")
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class SingleFlightTests(TestBase):
+    """Tests for PLPYWrapper.single_flight. Waiting on another session can't be reproduced from a single session,
+    so these cover the computing and reusing paths"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        utilities.install_single_flight_table(PLPY_WRAPPER)
+
+    def test_first_call_computes_and_publishes(self):
+        computed = PLPY_WRAPPER.single_flight_stats["computed"]
+        self.assertEqual(
+            PLPY_WRAPPER.single_flight("single_flight_test", lambda: {"total": 1}),
+            {"total": 1},
+        )
+        self.assertEqual(PLPY_WRAPPER.single_flight_stats["computed"], computed + 1)
+        self.assertEqual(
+            PLPY_WRAPPER.execute(
+                f"select count(*) as count from {PLPYWrapper.SINGLE_FLIGHT_TABLE} where key='single_flight_test'"
+            )[0].count,
+            1,
+        )
+
+    def test_published_value_is_reused(self):
+        PLPY_WRAPPER.single_flight("single_flight_test", lambda: "first")
+        self.assertEqual(
+            PLPY_WRAPPER.single_flight("single_flight_test", lambda: "second"),
+            "first",
+        )
+        self.assertGreater(PLPY_WRAPPER.single_flight_stats["coalescing_ratio"], 0)
+
+    def test_value_is_returned_as_json(self):
+        self.assertEqual(
+            PLPY_WRAPPER.single_flight("single_flight_test", lambda: (1, 2)), [1, 2]
+        )
+
+    def test_value_that_is_not_json_raises(self):
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.single_flight("single_flight_test", lambda: object())
+
+    def test_stale_value_is_recomputed(self):
+        PLPY_WRAPPER.single_flight("single_flight_test", lambda: "first")
+        self.assertEqual(
+            PLPY_WRAPPER.single_flight(
+                "single_flight_test", lambda: "second", max_age=0
+            ),
+            "second",
+        )
+
+
+class ApplyInBatchesTests(TestBase):
+    """Tests for PLPYWrapper.apply_in_batches"""
+
+    def insert_company(self, company_id):
+        plan = PLPY_WRAPPER.prepare(
+            "insert into customer.company (id,name) values ($1,'batched')", ["integer"]
+        )
+        return PLPY_WRAPPER.execute_plan(plan, [company_id]).n_rows
+
+    def test_failing_items_are_isolated(self):
+        # 903 is inserted twice so its second insert violates the primary key
+        result = PLPY_WRAPPER.apply_in_batches(
+            [900, 901, 902, 903, 903, 904, 905], self.insert_company, batch_size=4
+        )
+        self.assertEqual(
+            [item for item, _ in result.succeeded], [900, 901, 902, 903, 904, 905]
+        )
+        self.assertEqual([item for item, _ in result.failed], [903])
+        self.assertEqual(
+            PLPY_WRAPPER.execute(
+                "select count(*) as count from customer.company where name='batched'"
+            )[0].count,
+            6,
+        )
+
+    def test_batches_without_failures_use_one_subtransaction_each(self):
+        result = PLPY_WRAPPER.apply_in_batches(
+            range(910, 920), self.insert_company, batch_size=5
+        )
+        self.assertEqual(result.subtransactions, 2)
+        self.assertEqual(result.failed, [])
+
+
+class ProcessInChunksTests(TestBase):
+    """Tests for PLPYWrapper.process_in_chunks. Commits aren't possible inside the test's subtransaction, so the commit path
+    is tested with a commit that only records what was checkpointed"""
+
+    SOURCE_SQL = "select id, name from customer.company where id between 1000 and 1099"
+
+    def setUp(self) -> None:
+        super().setUp()
+        utilities.install_job_checkpoint_table(PLPY_WRAPPER)
+        PLPY_WRAPPER.insert_arrays(
+            "customer",
+            "company",
+            {"id": list(range(1000, 1025)), "name": ["chunk"] * 25},
+        )
+
+    def test_handler_receives_every_row_in_key_order(self):
+        seen = []
+        summary = PLPY_WRAPPER.process_in_chunks(
+            self.SOURCE_SQL,
+            ["id"],
+            lambda chunk: seen.append([row.id for row in chunk]),
+            chunk_size=10,
+            commit_every=None,
+        )
+        self.assertEqual([len(chunk) for chunk in seen], [10, 10, 5])
+        self.assertEqual(sum(seen, []), list(range(1000, 1025)))
+        self.assertEqual((summary["rows"], summary["chunks"]), (25, 3))
+
+    def test_job_resumes_after_checkpoint(self):
+        PLPY_WRAPPER.execute(
+            f"""insert into {PLPYWrapper.JOB_CHECKPOINT_TABLE} (job_name,last_key,updated_at)
+            values ('resume_test','[1019]',now())"""
+        )
+        seen = []
+        PLPY_WRAPPER.process_in_chunks(
+            self.SOURCE_SQL,
+            ["id"],
+            lambda chunk: seen.extend(row.id for row in chunk),
+            chunk_size=10,
+            commit_every=None,
+            job_name="resume_test",
+        )
+        self.assertEqual(seen, list(range(1020, 1025)))
+        self.assertEqual(
+            PLPY_WRAPPER.execute(
+                f"select count(*) as count from {PLPYWrapper.JOB_CHECKPOINT_TABLE} where job_name='resume_test'"
+            )[0].count,
+            0,
+        )
+
+    def test_checkpoint_is_written_before_every_commit(self):
+        checkpoints = []
+
+        def commit():
+            rows = PLPY_WRAPPER.execute(
+                f"select last_key from {PLPYWrapper.JOB_CHECKPOINT_TABLE} where job_name='commit_test'"
+            )
+            checkpoints.append(rows[0].last_key if len(rows) else None)
+
+        PLPY_WRAPPER.commit = commit
+        try:
+            summary = PLPY_WRAPPER.process_in_chunks(
+                self.SOURCE_SQL,
+                ["id"],
+                lambda chunk: None,
+                chunk_size=5,
+                commit_every=2,
+                job_name="commit_test",
+            )
+        finally:
+            del PLPY_WRAPPER.commit
+        self.assertEqual(summary["chunks"], 5)
+        # after chunks 2 and 4, plus the final commit once the job is done and its checkpoint removed
+        self.assertEqual(checkpoints, ["[1009]", "[1019]", None])
+
+    def test_null_keys_are_rejected(self):
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.process_in_chunks(
+                "select * from (values (1),(null)) as s(id)",
+                ["id"],
+                lambda chunk: None,
+                commit_every=None,
+            )
+
+
+class PaginateTests(TestBase):
+    """Tests for PLPYWrapper.paginate"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.insert_arrays(
+            "customer",
+            "company",
+            {
+                "id": list(range(1100, 1107)),
+                "name": ["b", "a", "b", "a", "b", "a", "b"],
+            },
+        )
+
+    def test_pages_have_page_size_rows(self):
+        pages = list(
+            PLPY_WRAPPER.paginate(
+                "select id from customer.company where id >= 1100", ["id"], 3
+            )
+        )
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertTrue(all(type(page) is ResultSet for page in pages))
+
+    def test_composite_key_descending(self):
+        ids = [
+            row.id
+            for page in PLPY_WRAPPER.paginate(
+                "select id, name from customer.company where id >= 1100",
+                ["name", "id"],
+                2,
+                descending=True,
+            )
+            for row in page
+        ]
+        self.assertEqual(ids, [1106, 1104, 1102, 1100, 1105, 1103, 1101])
+
+    def test_start_after_skips_earlier_rows(self):
+        ids = [
+            row.id
+            for page in PLPY_WRAPPER.paginate(
+                "select id from customer.company where id >= 1100",
+                ["id"],
+                10,
+                start_after=[1104],
+            )
+            for row in page
+        ]
+        self.assertEqual(ids, [1105, 1106])
+
+    def test_unknown_key_column_fails(self):
+        with self.assertRaises(PLPythonWrapperException):
+            next(PLPY_WRAPPER.paginate("select id from customer.company", ["name"], 10))
+
+    def test_cached_plans_are_bounded(self):
+        size = PLPYWrapper.SESSION_CACHE_SIZE
+        PLPYWrapper.SESSION_CACHE_SIZE = 2
+        try:
+            for bound in range(1100, 1104):
+                list(
+                    PLPY_WRAPPER.paginate(
+                        f"select id from customer.company where id >= {bound}",
+                        ["id"],
+                        10,
+                    )
+                )
+            state = PLPY_WRAPPER._wrapper_state
+            self.assertLessEqual(len(state["plans"]), 2)
+            self.assertLessEqual(len(state["query_column_types"]), 2)
+        finally:
+            PLPYWrapper.SESSION_CACHE_SIZE = size
+
+
+class DeferredInsertTests(TriggerSetup, TestBase):
+    """Tests for the statement level queue of PLPYWrapper.defer_insert"""
+
+    STATEMENT_TRIGGERS = True
+
+    DEFERRED_MESSAGE = "Hello from the deferred queue!"
+
+    def count_log_rows(self, add_data):
+        return PLPY_WRAPPER.execute(
+            f"""select count(*) as n from "logging".trigger_run_log where add_data='{add_data}'"""
+        )[0].n
+
+    def test_rows_deferred_by_row_triggers_are_written_at_statement_end(self):
+        self.create_triggers(
+            after_insert_body=f"self.plpy_wrapper.defer_insert('logging','trigger_run_log',{{'td_data':json.dumps(TD),'add_data':'{self.DEFERRED_MESSAGE}'}})"
+        )
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (200,'a'),(201,'b'),(202,'c')"
+        )
+        self.assertEqual(self.count_log_rows(self.DEFERRED_MESSAGE), 3)
+
+    def test_statement_triggers_do_not_run_row_handlers(self):
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (200,'a'),(201,'b')"
+        )
+        self.assertEqual(self.count_log_rows(self.TRIGGER_RUN_AFTER_INSERT_MESSAGE), 2)
+
+    def test_flush_deferred_outside_of_trigger(self):
+        PLPY_WRAPPER.defer_insert(
+            "customer", "company", {"id": 210, "name": "deferred"}
+        )
+        PLPY_WRAPPER.defer_insert("customer", "company", {"id": 211})
+        self.assertEqual(PLPY_WRAPPER.flush_deferred(), 2)
+        self.assertEqual(PLPY_WRAPPER.flush_deferred(), 0)
+        self.assertEqual(
+            len(PLPY_WRAPPER.execute("select 1 from customer.company where id>=210")),
+            2,
+        )
+
+    def test_discard_deferred(self):
+        PLPY_WRAPPER.defer_insert("customer", "company", {"id": 220})
+        PLPY_WRAPPER.discard_deferred()
+        self.assertEqual(PLPY_WRAPPER.flush_deferred(), 0)
+
+    def test_deferring_without_statement_triggers_fails(self):
+        self.create_triggers(
+            after_insert_body="self.plpy_wrapper.defer_insert('customer','company',{'id':230})",
+            statement_triggers=False,
+        )
+        with self.assertRaises(PLPY_WRAPPER.plpy.SPIError):
+            PLPY_WRAPPER.execute(
+                "insert into customer.company (id,name) values (231,'a')"
+            )
+
+    def test_statement_rolled_back_in_a_subtransaction_is_dropped(self):
+        self.create_triggers(
+            after_insert_body=f"self.plpy_wrapper.defer_insert('logging','trigger_run_log',{{'add_data':'{self.DEFERRED_MESSAGE}'}}) if self.trigger_context.new.id == 240 else 1/0"
+        )
+        with self.assertRaises(PLPY_WRAPPER.plpy.SPIError):
+            with PLPY_WRAPPER.subtransaction():
+                PLPY_WRAPPER.execute(
+                    "insert into customer.company (id,name) values (240,'a'),(241,'b')"
+                )
+        deferred = PLPY_WRAPPER._wrapper_state["transaction"]["deferred"]
+        self.assertFalse(any(deferred.values()))
+        self.assertEqual(self.count_log_rows(self.DEFERRED_MESSAGE), 0)
+
+    def test_nested_statement_aborted_in_plpgsql_is_not_written(self):
+        # 250 defers a row and then inserts 251 in a plpgsql EXCEPTION block, whose row trigger defers a row and fails
+        self.create_triggers(
+            after_insert_body="self.plpy_wrapper.defer_insert('logging','trigger_run_log',{'add_data':'deferred %s' % self.trigger_context.new.id}); "
+            "1/0 if self.trigger_context.new.id == 251 else None; "
+            "self.plpy_wrapper.execute(\"do $d$ begin insert into customer.company (id,name) values (251,'b'); exception when others then null; end $d$\") if self.trigger_context.new.id == 250 else None"
+        )
+        PLPY_WRAPPER.execute("insert into customer.company (id,name) values (250,'a')")
+        self.assertEqual(self.count_log_rows("deferred 250"), 1)
+        self.assertEqual(self.count_log_rows("deferred 251"), 0)
+
+
+class DeferredUpdateTests(TriggerSetup, TestBase):
+    """Tests for the write combining of PLPYWrapper.defer_update"""
+
+    STATEMENT_TRIGGERS = True
+
+    UPDATE_COUNT_SQL = """select n_tup_upd from pg_stat_xact_user_tables
+        where relid = 'customer.company'::regclass"""
+
+    def company_name(self, company_id):
+        return PLPY_WRAPPER.execute(
+            f"select name from customer.company where id={company_id}"
+        )[0].name
+
+    def test_updates_of_a_row_are_merged(self):
+        updates = PLPY_WRAPPER.execute(self.UPDATE_COUNT_SQL)[0].n_tup_upd
+        key = {"id": self.COMPANY_ID}
+        PLPY_WRAPPER.defer_update("customer", "company", key, {"name": "first"})
+        PLPY_WRAPPER.defer_update("customer", "company", key, {"name": "second"})
+        self.assertEqual(self.company_name(self.COMPANY_ID), self.COMPANY_NAME)
+        self.assertEqual(PLPY_WRAPPER.flush_deferred(), 1)
+        self.assertEqual(self.company_name(self.COMPANY_ID), "second")
+        self.assertEqual(
+            PLPY_WRAPPER.execute(self.UPDATE_COUNT_SQL)[0].n_tup_upd, updates + 1
+        )
+
+    def test_rows_updated_by_row_triggers_are_written_at_statement_end(self):
+        self.create_triggers(
+            after_insert_body="self.plpy_wrapper.defer_update('customer','company',{'id':self.trigger_context.new.id},{'name':'deferred'})"
+        )
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (300,'a'),(301,'b')"
+        )
+        self.assertEqual(self.company_name(300), "deferred")
+        self.assertEqual(self.company_name(301), "deferred")
+
+    def test_key_columns_are_not_updated(self):
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.defer_update(
+                "customer", "company", {"id": self.COMPANY_ID}, {"id": 2, "name": "x"}
+            )
+        self.assertNotIn("updates", PLPY_WRAPPER._deferred_queue())
+
+
+class NotifyTests(TestBase):
+    """Tests for PLPYWrapper.notify"""
+
+    def test_identical_events_are_queued_once(self):
+        PLPY_WRAPPER.notify("company_changed", {"id": 1})
+        PLPY_WRAPPER.notify("company_changed", {"id": 1})
+        PLPY_WRAPPER.notify("company_changed", {"id": 2})
+        self.assertEqual(
+            list(PLPY_WRAPPER._deferred_queue()["notifications"]["company_changed"]),
+            ['{"id":1}', '{"id":2}'],
+        )
+        PLPY_WRAPPER.flush_deferred()
+        self.assertNotIn("notifications", PLPY_WRAPPER._deferred_queue())
+
+    def test_batches_stay_below_the_payload_limit(self):
+        events = [json.dumps({"id": i, "name": "x" * 50}) for i in range(1000)]
+        batches = plpy_wrappers._pack_events(events, PLPYWrapper.NOTIFY_PAYLOAD_LIMIT)
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(
+            all(len(b.encode()) <= PLPYWrapper.NOTIFY_PAYLOAD_LIMIT for b in batches)
+        )
+        self.assertEqual(
+            [e for b in batches for e in json.loads(b)],
+            [json.loads(e) for e in events],
+        )
+
+    def test_too_large_payload_fails(self):
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.notify("company_changed", "x" * 8000)
+
+
+class AggregateTriggerTests(TestBase):
+    """Tests for AggregateTrigger in trigger.py module"""
+
+    TRIGGER_FUNC_DEFINITION = """
+create or replace function "customer".func_customer_contact_trigger_controller() returns trigger as $$
+from plpy_wrapper import PLPYWrapper, AggregateTrigger
+
+class CompanyContactStats(AggregateTrigger):
+    aggregate_schema = 'customer'
+    aggregate_table = 'company_contact_stats'
+    group_by = ('company_id',)
+    aggregates = {'contact_count': 'count(*)', 'total_ownership': 'sum(ownership_percentage)'}
+
+trigger_handler = CompanyContactStats(PLPYWrapper(globals()))
+trigger_handler.execute()
+return trigger_handler.trigger_return_val
+$$ LANGUAGE plpython3u;
+    """
+
+    class CompanyContactStats(AggregateTrigger):
+        aggregate_schema = "customer"
+        aggregate_table = "company_contact_stats"
+        group_by = ("company_id",)
+        aggregates = {
+            "contact_count": "count(*)",
+            "total_ownership": "sum(ownership_percentage)",
+        }
+
+    def setUp(self) -> None:
+        super().setUp()
+        PLPY_WRAPPER.execute("""create table customer.company_contact_stats
+            (
+                company_id      integer primary key,
+                contact_count   bigint  not null,
+                total_ownership numeric not null
+            )""")
+        utilities.create_plpython_triggers(
+            PLPY_WRAPPER,
+            "customer",
+            "contact",
+            None,
+            self.TRIGGER_FUNC_DEFINITION,
+            '"customer".func_customer_contact_trigger_controller',
+            statement_triggers=True,
+        )
+        PLPY_WRAPPER.execute(
+            "insert into customer.company (id,name) values (300,'a'),(301,'b')"
+        )
+
+    def get_stats(self):
+        return {
+            row.company_id: (row.contact_count, row.total_ownership)
+            for row in PLPY_WRAPPER.execute(
+                "select * from customer.company_contact_stats"
+            )
+        }
+
+    def test_deltas_are_applied(self):
+        PLPY_WRAPPER.execute(
+            """insert into customer.contact (first_name,last_name,company_id,ownership_percentage)
+            values ('a','a',300,0.5),('b','b',300,0.25),('c','c',301,null)"""
+        )
+        self.assertEqual(self.get_stats(), {300: (2, Decimal("0.75")), 301: (1, 0)})
+        PLPY_WRAPPER.execute(
+            "update customer.contact set company_id=301 where first_name='b'"
+        )
+        self.assertEqual(
+            self.get_stats(), {300: (1, Decimal("0.5")), 301: (2, Decimal("0.25"))}
+        )
+        PLPY_WRAPPER.execute("delete from customer.contact where company_id=300")
+        self.assertEqual(self.get_stats(), {301: (2, Decimal("0.25"))})
+
+    def test_truncate_empties_the_summary(self):
+        PLPY_WRAPPER.execute(
+            """insert into customer.contact (first_name,last_name,company_id,ownership_percentage)
+            values ('a','a',300,0.5),('b','b',301,0.25)"""
+        )
+        PLPY_WRAPPER.execute("truncate customer.contact")
+        self.assertEqual(self.get_stats(), {})
+        self.assertFalse(
+            self.CompanyContactStats.verify(PLPY_WRAPPER, "customer", "contact")
+        )
+
+    def test_verify_matches_full_recompute(self):
+        PLPY_WRAPPER.execute(
+            """insert into customer.contact (first_name,last_name,company_id,ownership_percentage)
+            values ('a','a',300,0.5),('b','b',301,0.25)"""
+        )
+        self.assertFalse(
+            self.CompanyContactStats.verify(PLPY_WRAPPER, "customer", "contact")
+        )
+        PLPY_WRAPPER.execute(
+            "update customer.company_contact_stats set contact_count=5 where company_id=300"
+        )
+        diff = self.CompanyContactStats.verify(PLPY_WRAPPER, "customer", "contact")
+        self.assertEqual([source.company_id for source, _ in diff.changed], [300])
+
+    def test_unsupported_aggregate_fails(self):
+        class MaxTrigger(AggregateTrigger):
+            aggregates = {"n": "count(*)", "highest": "max(ownership_percentage)"}
+
+        with self.assertRaises(TriggerException):
+            MaxTrigger.recompute_query("customer", "contact")
+
+
+class ResultSetJsonTests(TestBase):
+    """Tests for ResultSet.to_json and ResultSet.iter_json"""
+
+    QUERY = """select 1 as id, 1.50::numeric as amount, 'a"b'::text as name, '{"x": [1, 2]}'::jsonb as data,
+        '\\x01ff'::bytea as raw, 'NaN'::float8 as ratio, array[1, null] as ids, null::text as empty"""
+
+    def test_to_json_matches_postgres(self):
+        result = PLPY_WRAPPER.execute(self.QUERY)
+        expected = PLPY_WRAPPER.execute(
+            f"select json_agg(q) as j from ({self.QUERY}) as q"
+        )[0].j
+        expected = json.loads(expected)
+        # postgres keeps NaN as a string, plain JSON has no way to express it
+        expected[0]["ratio"] = None
+        self.assertEqual(json.loads(result.to_json()), expected)
+
+    def test_iter_json_chunks(self):
+        result = PLPY_WRAPPER.execute("select generate_series(1,5) as id")
+        chunks = list(result.iter_json(chunk_rows=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads("".join(chunks)), [{"id": i} for i in range(1, 6)])
+
+    def test_empty_result(self):
+        self.assertEqual(
+            PLPY_WRAPPER.execute("select 1 as id where false").to_json(), "[]"
+        )
+
+    def test_row_to_json(self):
+        row = PLPY_WRAPPER.execute(self.QUERY)[0]
+        self.assertEqual(json.loads(row.to_json())["amount"], 1.5)
+
+
+class StreamTests(TestBase):
+    """Tests for PLPYWrapper.stream"""
+
+    def test_streams_every_row_in_batches(self):
+        rows = PLPY_WRAPPER.stream(
+            "select generate_series(1,2500) as n", batch_size=1000
+        )
+        self.assertEqual([row["n"] for row in rows], list(range(1, 2501)))
+
+    def test_transform_and_args(self):
+        rows = PLPY_WRAPPER.stream(
+            "select generate_series(1,$1) as n",
+            [3],
+            ["int"],
+            transform=lambda row: row["n"] * 10,
+        )
+        self.assertEqual(list(rows), [10, 20, 30])
+
+    def test_transform_to_row(self):
+        rows = list(PLPY_WRAPPER.stream("select 1 as n", transform=Row))
+        self.assertEqual(rows, [Row({"n": 1})])
+
+    def test_set_returning_function(self):
+        PLPY_WRAPPER.execute(
+            """create function customer.stream_test(n int) returns setof int as $$
+from plpy_wrapper import PLPYWrapper
+return PLPYWrapper(globals()).stream('select generate_series(1,$1) as n',[n],['int'],transform=lambda row: row['n'],batch_size=7)
+$$ language plpython3u"""
+        )
+        self.assertEqual(
+            PLPY_WRAPPER.execute("select count(*) as c from customer.stream_test(50)")[
+                0
+            ].c,
+            50,
+        )
+
+
+class BlobTests(TestBase):
+    """Tests for the chunked large object and bytea API in blob.py"""
+
+    DATA = bytes(range(256)) * 100
+
+    def test_large_object_round_trip(self):
+        lob = PLPY_WRAPPER.create_lob()
+        self.assertEqual(
+            lob.write_chunks(
+                self.DATA[i : i + 1000] for i in range(0, len(self.DATA), 1000)
+            ),
+            len(self.DATA),
+        )
+        chunks = [
+            bytes(chunk) for chunk in PLPY_WRAPPER.open_lob(lob.oid).read_chunks(4096)
+        ]
+        self.assertEqual(
+            [len(c) for c in chunks], [4096] * 6 + [len(self.DATA) - 4096 * 6]
+        )
+        self.assertEqual(b"".join(chunks), self.DATA)
+
+    def test_chunks_reuse_the_buffer(self):
+        lob = PLPY_WRAPPER.create_lob()
+        lob.write_chunks([self.DATA])
+        views = list(lob.read_chunks(1000))
+        self.assertTrue(all(v.obj is views[0].obj for v in views))
+
+    def test_bytea_round_trip(self):
+        PLPY_WRAPPER.execute(
+            "create table customer.document (id int primary key, body bytea)"
+        )
+        PLPY_WRAPPER.execute(
+            "insert into customer.document values (1, null), (2, null)"
+        )
+        self.assertEqual(
+            list(PLPY_WRAPPER.read_chunks("customer", "document", "body", {"id": 1})),
+            [],
+        )
+        PLPY_WRAPPER.write_chunks(
+            "customer",
+            "document",
+            "body",
+            {"id": 1},
+            [self.DATA[:5000], self.DATA[5000:]],
+        )
+        PLPY_WRAPPER.write_chunks(
+            "customer",
+            "document",
+            "body",
+            {"id": 2},
+            PLPY_WRAPPER.read_chunks("customer", "document", "body", {"id": 1}, 3000),
+        )
+        self.assertEqual(
+            PLPY_WRAPPER.execute("select body from customer.document where id=2")[
+                0
+            ].body,
+            self.DATA,
+        )
+
+    def test_missing_row_fails(self):
+        with self.assertRaises(PLPythonWrapperException):
+            list(PLPY_WRAPPER.read_chunks("customer", "company", "name", {"id": -1}))
+
+
+class ProfilingTests(TriggerSetup, TestBase):
+    """Tests for the sampling profiler of PLPYWrapper"""
+
+    STATEMENT_TRIGGERS = True
+
+    def tearDown(self) -> None:
+        # the profiler lives in GD, which isn't rolled back with the test
+        PLPY_WRAPPER.disable_profiling()
+        super().tearDown()
+
+    def test_nothing_is_collected_when_disabled(self):
+        with PLPY_WRAPPER.profile("disabled"):
+            PLPY_WRAPPER.execute("select 1")
+        self.assertIsNone(PLPY_WRAPPER.profiler)
+        self.assertEqual(PLPY_WRAPPER.profile_report(), [])
+
+    def test_trigger_invocations_are_profiled_per_trigger(self):
+        PLPY_WRAPPER.enable_profiling(sample_rate=1)
+        PLPY_WRAPPER.execute(self.UPDATE_INITIAL_COMPANY_SQL)
+        report = PLPY_WRAPPER.profile_report(top=5)
+        self.assertTrue(report)
+        self.assertEqual(
+            {row["name"] for row in report}, {"_Trigger on customer.company"}
+        )
+        # 2 row level and 2 statement level triggers
+        self.assertEqual(
+            PLPY_WRAPPER.profiler.sampled["_Trigger on customer.company"], 4
+        )
+
+    def test_sample_rate_zero_profiles_nothing(self):
+        PLPY_WRAPPER.enable_profiling(sample_rate=0)
+        with PLPY_WRAPPER.profile("never"):
+            PLPY_WRAPPER.execute("select 1")
+        self.assertEqual(PLPY_WRAPPER.profiler.invocations["never"], 1)
+        self.assertEqual(PLPY_WRAPPER.profile_report(), [])
+
+    def test_report_function(self):
+        utilities.install_profile_report_function(PLPY_WRAPPER)
+        PLPY_WRAPPER.enable_profiling(sample_rate=1)
+        with PLPY_WRAPPER.profile("report"):
+            PLPY_WRAPPER.execute("select 1")
+        rows = PLPY_WRAPPER.execute(
+            "select * from plpy_wrapper_profile_report('report', 3)"
+        )
+        self.assertTrue(0 < len(rows) <= 3)
+
+
+class MemoryBudgetTests(TestBase):
+    """Tests for PLPYWrapper.memory_budget"""
+
+    QUERY = "select generate_series(1,5000) as n, repeat('x',100) as padding"
+
+    def tearDown(self) -> None:
+        # the budget lives in GD, which isn't rolled back with the test
+        PLPY_WRAPPER.memory_budget = None
+        super().tearDown()
+
+    def test_result_within_budget(self):
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(max_rows=5000)
+        self.assertEqual(len(PLPY_WRAPPER.execute(self.QUERY)), 5000)
+
+    def test_too_many_rows_raises(self):
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(max_rows=1000)
+        with self.assertRaises(MemoryBudgetException):
+            PLPY_WRAPPER.execute(self.QUERY)
+
+    def test_too_many_bytes_streams(self):
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(
+            max_bytes=10000, stream=True, stream_batch_size=700
+        )
+        result = PLPY_WRAPPER.execute(self.QUERY)
+        self.assertIs(type(result.result_set), CursorResult)
+        self.assertEqual([row.n for row in result], list(range(1, 5001)))
+        with self.assertRaises(ResultSetException):
+            list(result)
+
+    def test_streamed_query_runs_once(self):
+        PLPY_WRAPPER.execute("create sequence customer.memory_budget_seq")
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(
+            max_rows=1000, stream=True, stream_batch_size=700
+        )
+        result = PLPY_WRAPPER.execute(
+            "select nextval('customer.memory_budget_seq') as n from generate_series(1,5000)"
+        )
+        self.assertEqual([row.n for row in result], list(range(1, 5001)))
+        PLPY_WRAPPER.memory_budget = None
+        last_value = PLPY_WRAPPER.execute(
+            "select last_value from customer.memory_budget_seq"
+        )[0].last_value
+        self.assertEqual(last_value, 5000)
+
+    def test_pages_are_not_streamed(self):
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(
+            max_rows=1000, stream=True, stream_batch_size=700
+        )
+        query = "select n from generate_series(1,5000) as n"
+        pages = list(PLPY_WRAPPER.paginate(query, ["n"], 1000))
+        self.assertEqual([len(page) for page in pages], [1000] * 5)
+        with self.assertRaises(MemoryBudgetException):
+            list(PLPY_WRAPPER.paginate(query, ["n"], 2000))
+
+    def test_peak_allocation_is_traced(self):
+        PLPY_WRAPPER.memory_budget = PLPYWrapper.MemoryBudget(trace_rate=1)
+        traced = PLPY_WRAPPER.memory_stats["traced"]
+        PLPY_WRAPPER.execute(self.QUERY)
+        stats = PLPY_WRAPPER.memory_stats
+        self.assertEqual(stats["traced"], traced + 1)
+        self.assertGreater(stats["last_peak_bytes"], 5000 * 100)
+
+
+class StatsTests(TriggerSetup, TestBase):
+    """Tests for PLPYWrapper.stats"""
+
+    STATEMENT_TRIGGERS = True
+
+    def setUp(self) -> None:
+        super().setUp()
+        # the stats live in GD, which isn't rolled back with the test
+        PLPY_WRAPPER.reset_stats()
+
+    def tearDown(self) -> None:
+        PLPY_WRAPPER.stats_registry.flush_interval = None
+        PLPY_WRAPPER.stats_registry.release = None
+        super().tearDown()
+
+    def _value(self, metric: str, label: str = "") -> float:
+        for row in PLPY_WRAPPER.stats():
+            if row["metric"] == metric and row["label"] == label:
+                return row["value"]
+        return 0
+
+    def test_queries_are_counted(self):
+        PLPY_WRAPPER.execute("select generate_series(1,10)")
+        self.assertEqual(self._value("queries"), 1)
+        self.assertEqual(self._value("rows"), 10)
+        self.assertGreater(self._value("query_seconds"), 0)
+
+    def test_trigger_invocations_are_counted(self):
+        PLPY_WRAPPER.execute(self.UPDATE_INITIAL_COMPANY_SQL)
+        for label in [
+            "customer.company BEFORE UPDATE ROW",
+            "customer.company AFTER UPDATE ROW",
+            "customer.company BEFORE UPDATE STATEMENT",
+            "customer.company AFTER UPDATE STATEMENT",
+        ]:
+            self.assertEqual(self._value("trigger_invocations", label), 1)
+
+    def test_flush_writes_deltas(self):
+        utilities.install_stats(PLPY_WRAPPER)
+        PLPY_WRAPPER.enable_stats_flush(interval=3600, release="test")
+        for _ in range(2):
+            PLPY_WRAPPER.execute("select 1")
+            queries = self._value("queries")
+            self.assertGreater(PLPY_WRAPPER.flush_stats(), 0)
+            # summing the flushed deltas gives the value at the time of the flush
+            self.assertEqual(self._flushed_queries(), queries)
+
+    def test_rolled_back_flush_is_written_again(self):
+        utilities.install_stats(PLPY_WRAPPER)
+        PLPY_WRAPPER.enable_stats_flush(interval=3600, release="test")
+        with self.assertRaises(TriggerTestException):
+            with PLPY_WRAPPER.subtransaction():
+                self.assertGreater(PLPY_WRAPPER.flush_stats(), 0)
+                raise TriggerTestException()
+        self.assertEqual(self._flushed_queries(), None)
+        queries = self._value("queries")
+        self.assertGreater(PLPY_WRAPPER.flush_stats(), 0)
+        self.assertEqual(self._flushed_queries(), queries)
+
+    def _flushed_queries(self) -> float:
+        return PLPY_WRAPPER.execute(
+            f"""select sum(value) as queries from "{PLPYWrapper.STATS_SCHEMA}"."{PLPYWrapper.STATS_TABLE_NAME}"
+            where metric = 'queries' and release = 'test'"""
+        )[0].queries
+
+    def test_stats_function(self):
+        utilities.install_stats(PLPY_WRAPPER)
+        rows = PLPY_WRAPPER.execute(
+            "select * from plpy_wrapper_stats() where metric = 'queries'"
+        )
+        self.assertEqual(len(rows), 1)
+
+
+class TimeBudgetTests(TestBase):
+    """Tests for PLPYWrapper.time_budget"""
+
+    TIMEOUT_QUERY = "select setting::int as timeout from pg_settings where name = 'statement_timeout'"
+
+    def test_slow_query_raises(self):
+        with self.assertRaises(TimeBudgetException):
+            with PLPY_WRAPPER.subtransaction():
+                with PLPY_WRAPPER.time_budget(100):
+                    PLPY_WRAPPER.execute("select pg_sleep(2)")
+
+    def test_exhausted_budget_raises_before_running(self):
+        with self.assertRaises(TimeBudgetException):
+            with PLPY_WRAPPER.time_budget(0):
+                PLPY_WRAPPER.execute("select 1")
+
+    def test_nested_budget_is_bounded_by_outer(self):
+        with PLPY_WRAPPER.time_budget(500):
+            with PLPY_WRAPPER.time_budget(60000):
+                timeout = PLPY_WRAPPER.execute(self.TIMEOUT_QUERY)[0].timeout
+        self.assertTrue(0 < timeout <= 500)
+
+    def test_settings_are_restored(self):
+        before = PLPY_WRAPPER.execute(self.TIMEOUT_QUERY)[0].timeout
+        with PLPY_WRAPPER.time_budget(1000):
+            PLPY_WRAPPER.execute("select 1")
+        self.assertEqual(PLPY_WRAPPER.execute(self.TIMEOUT_QUERY)[0].timeout, before)
+
+    def test_settings_are_restored_after_python_errors(self):
+        before = PLPY_WRAPPER.execute(self.TIMEOUT_QUERY)[0].timeout
+        with self.assertRaises(ValueError):
+            with PLPY_WRAPPER.time_budget(1000):
+                PLPY_WRAPPER.execute("select 1")
+                raise ValueError()
+        self.assertEqual(PLPY_WRAPPER.execute(self.TIMEOUT_QUERY)[0].timeout, before)
+
+
+class ModuleLoaderTests(TestBase):
+    """Tests for importing modules with PLPYWrapper.enable_module_loader"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        utilities.install_module_table(PLPY_WRAPPER)
+        self.key_directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        # the finder and the imported modules outlive the test's transaction
+        PLPY_WRAPPER.disable_module_loader()
+        shutil.rmtree(self.key_directory)
+        super().tearDown()
+
+    def publish(self, name, source, is_package=False):
+        return PLPY_WRAPPER.publish_module(
+            name, source, is_package, key_directory=self.key_directory
+        )
+
+    def enable(self):
+        return PLPY_WRAPPER.enable_module_loader(key_directory=self.key_directory)
+
+    def test_import_from_table(self):
+        self.publish("plpyw_test_module", "def double(x):\n    return x * 2")
+        self.enable()
+        module = importlib.import_module("plpyw_test_module")
+        self.assertEqual(module.double(2), 4)
+
+    def test_bytecode_is_stored(self):
+        self.publish("plpyw_test_module", "VALUE = 1")
+        row = PLPY_WRAPPER.execute(
+            f"select bytecode, python_magic, signature from {PLPYWrapper.MODULE_TABLE}"
+        )[0]
+        self.assertEqual(row.python_magic, importlib.util.MAGIC_NUMBER.hex())
+        self.assertIsInstance(marshal.loads(row.bytecode), types.CodeType)
+        self.assertTrue(row.signature)
+
+    def test_unsigned_bytecode_is_not_run(self):
+        self.publish("plpyw_test_module", "VALUE = 1")
+        PLPY_WRAPPER.execute_plan(
+            PLPY_WRAPPER.prepare(
+                f"update {PLPYWrapper.MODULE_TABLE} set bytecode = $1",
+                ["bytea"],
+            ),
+            [marshal.dumps(compile("VALUE = 2", "plpyw_test_module.py", "exec"))],
+        )
+        self.enable()
+        self.assertEqual(importlib.import_module("plpyw_test_module").VALUE, 1)
+
+    def test_version_bump_reloads(self):
+        self.assertEqual(self.publish("plpyw_test_module", "VALUE = 1"), 1)
+        self.enable()
+        module = importlib.import_module("plpyw_test_module")
+        # publishing the same source again doesn't bump the version
+        self.assertEqual(self.publish("plpyw_test_module", "VALUE = 1"), 1)
+        self.assertEqual(self.publish("plpyw_test_module", "VALUE = 2"), 2)
+        self.enable()
+        self.assertEqual(module.VALUE, 2)
+
+    def test_package(self):
+        self.publish("plpyw_test_package", "", is_package=True)
+        self.publish("plpyw_test_package.sub", "VALUE = 3")
+        self.enable()
+        self.assertEqual(importlib.import_module("plpyw_test_package.sub").VALUE, 3)
+
+    def test_syntax_error_is_not_published(self):
+        with self.assertRaises(SyntaxError):
+            self.publish("plpyw_test_module", "def broken(:")
+        self.assertEqual(
+            len(PLPY_WRAPPER.execute(f"select * from {PLPYWrapper.MODULE_TABLE}")), 0
+        )
+
+
+class PlanShapeTests(unittest.TestCase):
+    """Tests for the plan normalization of plans.py"""
+
+    PLAN = {
+        "Node Type": "Hash Join",
+        "Join Type": "Inner",
+        "Total Cost": 10.5,
+        "Plan Rows": 100,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "contact", "Total Cost": 4},
+            {
+                "Node Type": "Hash",
+                "Plans": [{"Node Type": "Seq Scan", "Relation Name": "company"}],
+            },
+        ],
+    }
+
+    def test_costs_are_left_out(self):
+        shape = plans.normalize_plan(self.PLAN)
+        self.assertNotIn("Total Cost", shape)
+        self.assertNotIn("Plan Rows", shape)
+        self.assertEqual(
+            shape["Plans"][0], {"Node Type": "Seq Scan", "Relation Name": "contact"}
+        )
+
+    def test_join_order_change_is_reported(self):
+        shape = plans.normalize_plan(self.PLAN)
+        swapped = dict(shape, Plans=list(reversed(shape["Plans"])))
+        self.assertEqual(plans.compare_shapes(shape, shape), [])
+        self.assertEqual(len(plans.compare_shapes(shape, swapped)), 2)
+
+
+class PlanRegressionTests(TestBase):
+    """Tests for plans.PlanRegressionHarness"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        utilities.install_plan_baseline_table(PLPY_WRAPPER)
+        self.harness = plans.PlanRegressionHarness(PLPY_WRAPPER)
+        self.harness.register("companies", "select * from customer.company order by id")
+
+    def test_unchanged_plan_passes(self):
+        self.harness.record_baselines()
+        self.harness.assert_no_regressions()
+
+    def test_changed_plan_is_reported(self):
+        self.harness.record_baselines()
+        PLPY_WRAPPER.execute("set local enable_seqscan = off")
+        PLPY_WRAPPER.execute("set local enable_sort = off")
+        with self.assertRaises(PlanRegressionException):
+            self.harness.assert_no_regressions()
+
+    def test_missing_baseline_is_reported(self):
+        regressions = self.harness.check()
+        self.assertEqual([regression.name for regression in regressions], ["companies"])
+
+    def test_analyze_rolls_back(self):
+        harness = plans.PlanRegressionHarness(PLPY_WRAPPER, analyze=True)
+        harness.register("delete_contacts", "delete from customer.contact")
+        count = PLPY_WRAPPER.execute("select count(*) from customer.contact")[0].count
+        capture = harness.capture("delete_contacts")
+        self.assertIsNotNone(capture.execution_time)
+        self.assertEqual(
+            PLPY_WRAPPER.execute("select count(*) from customer.contact")[0].count,
+            count,
+        )
+
+    def test_baselines_round_trip(self):
+        self.harness.record_baselines()
+        baselines = self.harness.baselines()
+        PLPY_WRAPPER.execute(f"delete from {PLPYWrapper.PLAN_BASELINE_TABLE}")
+        self.harness.import_baselines(baselines)
+        self.harness.assert_no_regressions()
+
+    def test_zero_baseline_cost(self):
+        self.harness.record_baselines()
+        baselines = self.harness.baselines()
+        baselines["companies"]["total_cost"] = 0
+        self.harness.import_baselines(baselines)
+        regressions = self.harness.check()
+        self.assertIn("estimated cost", regressions[0].differences[0])
+        harness = plans.PlanRegressionHarness(PLPY_WRAPPER, min_cost_change=1e9)
+        harness.register("companies", "select * from customer.company order by id")
+        harness.assert_no_regressions()
+
+
+# module level, the workers of parallel_map import the functions by name
+def _name_length(row: Row) -> int:
+    return len(row.name)
+
+
+def _squared_id(row: Row) -> int:
+    return row.id * row.id
+
+
+def _fail_on_second_row(row: Row) -> int:
+    if row.id == 2:
+        raise ValueError("second row")
+    return row.id
+
+
+class ParallelMapTests(TestBase):
+    """Tests for PLPYWrapper.parallel_map"""
+
+    QUERY = "select id, repeat('x', id) as name from generate_series(1,25) as id"
+
+    def tearDown(self) -> None:
+        PLPY_WRAPPER.close_process_pool()
+        super().tearDown()
+
+    def test_results_in_row_order(self):
+        rows = PLPY_WRAPPER.execute(self.QUERY)
+        self.assertEqual(
+            PLPY_WRAPPER.parallel_map(_name_length, rows, workers=2, chunk_size=3),
+            list(range(1, 26)),
+        )
+
+    def test_pool_is_closed(self):
+        rows = PLPY_WRAPPER.execute(self.QUERY)
+        PLPY_WRAPPER.parallel_map(_squared_id, rows)
+        self.assertNotIn("process_pool", PLPY_WRAPPER._wrapper_state)
+
+    def test_kept_pool_is_reused(self):
+        rows = PLPY_WRAPPER.execute(self.QUERY)
+        PLPY_WRAPPER.parallel_map(_squared_id, rows, workers=2, keep_pool=True)
+        pids = PLPY_WRAPPER._wrapper_state["process_pool"].pids
+        PLPY_WRAPPER.parallel_map(_squared_id, rows, workers=2, keep_pool=True)
+        self.assertEqual(PLPY_WRAPPER._wrapper_state["process_pool"].pids, pids)
+        PLPY_WRAPPER.parallel_map(_squared_id, rows, workers=3, keep_pool=True)
+        self.assertEqual(PLPY_WRAPPER._wrapper_state["process_pool"].workers, 3)
+
+    def test_worker_exception_is_raised(self):
+        rows = PLPY_WRAPPER.execute(self.QUERY)
+        with self.assertRaises(PLPythonWrapperException) as context:
+            PLPY_WRAPPER.parallel_map(
+                _fail_on_second_row, rows, workers=2, chunk_size=1, keep_pool=True
+            )
+        self.assertIn("second row", str(context.exception))
+        # the pool is still usable afterwards
+        self.assertEqual(
+            PLPY_WRAPPER.parallel_map(_squared_id, rows, workers=2),
+            [n * n for n in range(1, 26)],
+        )
+
+    def test_dead_worker_is_reported(self):
+        pool = parallel.ProcessPool(2)
+        os.kill(pool.pids[0], signal.SIGKILL)
+        os.waitpid(pool.pids[0], 0)
+        with self.assertRaises(PLPythonWrapperException) as context:
+            list(pool.imap(parallel.dump_task(abs), range(10)))
+        self.assertIn("died", str(context.exception))
+        self.assertFalse(pool.alive)
+
+    def test_lambda_is_rejected(self):
+        rows = PLPY_WRAPPER.execute(self.QUERY)
+        with self.assertRaises(PLPythonWrapperException):
+            PLPY_WRAPPER.parallel_map(lambda row: row.id, rows, workers=2)
+        # before a pool was forked
+        self.assertNotIn("process_pool", PLPY_WRAPPER._wrapper_state)
+
+    def test_streamed_result(self):
+        rows = ResultSet(
+            CursorResult(
+                PLPY_WRAPPER.plpy.cursor("select generate_series(1,2500) as id"), 1000
+            )
+        )
+        self.assertEqual(
+            PLPY_WRAPPER.parallel_map(_squared_id, rows, workers=2, chunk_size=300),
+            [n * n for n in range(1, 2501)],
+        )